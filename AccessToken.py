@@ -0,0 +1,81 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import secrets
+
+import Config
+
+_secret = None
+
+
+def load_secret():
+    """
+    返回签名密钥
+
+    优先使用 WEBRAW_TOKEN_SECRET；未设置时使用（或首次生成）WEBRAW_TOKEN_SECRET_PATH 中的随机密钥，
+    多个服务进程读到同一个密钥，重启后已发出的令牌仍然有效。
+    """
+    global _secret
+    if _secret is not None:
+        return _secret
+    if Config.TOKEN_SECRET:
+        _secret = Config.TOKEN_SECRET.encode('utf-8')
+        return _secret
+    path = Config.TOKEN_SECRET_PATH
+    try:
+        # O_EXCL 保证同时启动的多个进程只有一个写入密钥
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secrets.token_hex(32).encode('ascii'))
+    except FileExistsError:
+        pass
+    for _ in range(50):
+        with open(path, 'rb') as f:
+            secret = f.read().strip()
+        if secret:
+            _secret = secret
+            return _secret
+        # 其他进程刚创建文件，尚未写完
+        time.sleep(0.01)
+    raise RuntimeError(f"令牌密钥文件为空：{path}")
+
+
+def _signature(user_id, filename, expires):
+    message = f'{user_id}\0{filename}\0{expires}'.encode('utf-8')
+    digest = hmac.new(load_secret(), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode('ascii')
+
+
+def issue(user_id, filename, now=None):
+    """
+    生成文件访问令牌
+
+    过期时间按有效期取整，同一时间段内同一文件的令牌保持不变，有效时间在一到两个有效期之间。
+
+    :param user_id: 用户标识
+    :param filename: 输出目录中的唯一文件名
+    :return: 令牌字符串（过期时间.签名）
+    """
+    ttl = Config.TOKEN_TTL_SECONDS
+    now = time.time() if now is None else now
+    expires = (int(now) // ttl + 2) * ttl
+    return f'{expires}.{_signature(user_id, filename, expires)}'
+
+
+def verify(user_id, filename, token, now=None):
+    """
+    校验访问令牌（无需查询存储）
+
+    :return: 令牌有效返回True
+    """
+    if not token:
+        return False
+    expires, _, signature = token.partition('.')
+    if not expires.isdigit() or not signature:
+        return False
+    now = time.time() if now is None else now
+    if int(expires) < now:
+        return False
+    return hmac.compare_digest(signature, _signature(user_id, filename, int(expires)))
@@ -1,95 +1,361 @@
 import os
+import io
+import sys
+import math
+import time
 import argparse
-from DNGConverter import convert_raw_to_dng
-from CameraMatching import modify_camera_info
+import contextlib
+import Config
+from concurrent.futures import ProcessPoolExecutor
+from Metrics import timed
+from DNGConverter import convert_raw_to_dng, convert_many, plan_batches
+from ProcessSlots import raise_converter_limit
+from CameraMatching import modify_camera_info, modify_camera_info_batch, TARGET_MAKE, TARGET_MODEL
+from WatchFolder import Manifest, InotifyWatcher, MANIFEST_NAME, file_hash
 
-def process_file(raw_file_path, output_directory=None):
+# 支持常见的RAW文件扩展名
+RAW_EXTENSIONS = ('.raw', '.cr2', '.cr3', '.nef', '.arw', '.orf', '.rw2', '.raf')
+
+# 影响转换结果的设置（用作转换缓存键的一部分，修改转换参数时需要同步更新）
+CONVERSION_SETTINGS = {
+    'converter': Config.CONVERTER_BACKEND,
+    'preserve_exif': True,
+    'make': TARGET_MAKE,
+    'model': TARGET_MODEL
+}
+
+def expected_dng_path(raw_file_path, output_directory=None):
+    """返回RAW文件转换后DNG文件的预期路径"""
+    raw_filename_stem = os.path.splitext(os.path.basename(raw_file_path))[0]
+    dng_filename = f"{raw_filename_stem}.dng"
+    
+    if output_directory:
+        return os.path.join(output_directory, dng_filename)
+    source_dir = os.path.dirname(raw_file_path)
+    return os.path.join(source_dir if source_dir else '.', dng_filename)
+
+@timed('process_file', check_result=True)
+def process_file(raw_file_path, output_directory=None, on_stage=None):
     """
     处理单个RAW文件：转换为DNG并修改相机信息
 
     :param raw_file_path: RAW文件路径
     :param output_directory: 输出目录（可选）
+    :param on_stage: 阶段回调（可选），在每个步骤开始前以阶段名调用（'converting'、'tagging'）
     """
     # 获取输出DNG文件的预期路径
-    raw_filename_stem = os.path.splitext(os.path.basename(raw_file_path))[0]
-    dng_filename = f"{raw_filename_stem}.dng"
-    
-    if output_directory:
-        dng_file_path = os.path.join(output_directory, dng_filename)
-    else:
-        source_dir = os.path.dirname(raw_file_path)
-        dng_file_path = os.path.join(source_dir if source_dir else '.', dng_filename)
+    dng_file_path = expected_dng_path(raw_file_path, output_directory)
 
     # 第一步：转换RAW到DNG
     print(f"\n开始处理文件: {raw_file_path}")
     print("步骤1: 转换RAW到DNG格式")
+    if on_stage:
+        on_stage('converting')
     convert_raw_to_dng(raw_file_path, output_directory)
 
     # 检查DNG文件是否成功生成
     if os.path.exists(dng_file_path):
         # 第二步：修改相机信息
         print("\n步骤2: 修改相机型号信息")
+        if on_stage:
+            on_stage('tagging')
         if modify_camera_info(dng_file_path):
             print(f"\n✓ 文件处理完成: {dng_file_path}")
             return True
+        print(f"\n✗ 错误：相机信息修改失败: {dng_file_path}")
+        return False
     else:
         print(f"\n✗ 错误：DNG文件未生成，跳过相机信息修改步骤")
         return False
 
-def process_directory(directory_path, output_directory=None):
+def convert_batch(raw_file_paths, output_directory):
+    """
+    转换一组RAW文件（一个转换器进程），日志收集后交给主进程按顺序输出
+
+    可以在进程池中运行。
+
+    :return: ([DNG路径或None，与输入顺序一致], 耗时秒数, 日志文本)
+    """
+    start = time.time()
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        try:
+            results = convert_many(raw_file_paths, output_directory)
+        except Exception as e:
+            print(f"发生未知错误: {e}")
+            results = {}
+    return [results.get(path) for path in raw_file_paths], time.time() - start, log.getvalue()
+
+def process_files_batched(raw_file_paths, output_directory, jobs=1):
+    """
+    批量转换：文件分组后每组运行一个转换器进程，jobs>1 时多组并行，
+    每组转换完成后按输入顺序输出日志并合并修改相机信息。
+    每组最多 ceil(文件数/jobs) 个文件，文件足够多时至少分成 jobs 组，所有并行进程都有文件可转换。
+
+    :param raw_file_paths: RAW文件路径列表
+    :param output_directory: 输出目录
+    :param jobs: 并行进程数
+    :return: 失败列表 [(RAW路径, 原因)]
+    """
+    total_files = len(raw_file_paths)
+    max_files = min(Config.CONVERTER_BATCH_MAX_FILES, math.ceil(total_files / max(jobs, 1)))
+    batches = plan_batches(raw_file_paths, max_files=max_files)
+    failures = []
+    done_count = 0
+    start = time.time()
+
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        output_dirs = [output_directory] * len(batches)
+        # map 按提交顺序返回结果，保证日志顺序稳定
+        results = executor.map(convert_batch, batches, output_dirs) if executor else map(convert_batch, batches, output_dirs)
+        for batch, (dng_paths, elapsed, log) in zip(batches, results):
+            print(f"\n转换 {len(batch)} 个文件（耗时 {elapsed:.1f} 秒）")
+            if log:
+                print(log, end='')
+
+            converted = [(raw_path, dng_path) for raw_path, dng_path in zip(batch, dng_paths) if dng_path]
+            for raw_path, dng_path in zip(batch, dng_paths):
+                if not dng_path:
+                    failures.append((raw_path, 'DNG文件未生成'))
+
+            tag_results = modify_camera_info_batch([dng_path for _, dng_path in converted])
+            for raw_path, dng_path in converted:
+                if tag_results.get(dng_path):
+                    print(f"✓ 文件处理完成: {dng_path}")
+                else:
+                    failures.append((raw_path, '相机信息修改失败'))
+
+            done_count += len(batch)
+            rate = done_count / max(time.time() - start, 1e-6)
+            print(f"[进度] {done_count}/{total_files}，失败 {len(failures)}，{rate:.2f} 文件/秒")
+    finally:
+        if executor:
+            executor.shutdown()
+
+    # 失败列表按输入顺序排列
+    order = {path: index for index, path in enumerate(raw_file_paths)}
+    failures.sort(key=lambda failure: order[failure[0]])
+    return failures
+
+def is_raw_file(filename):
+    """按扩展名判断是否为支持的RAW文件"""
+    return os.path.splitext(filename)[1].lower() in RAW_EXTENSIONS
+
+def list_raw_files(directory_path):
+    """返回目录中的RAW文件路径（按文件名排序，不含子目录）"""
+    return [os.path.join(directory_path, f) for f in sorted(os.listdir(directory_path)) if is_raw_file(f)]
+
+def process_changed(raw_file_paths, output_directory, jobs=1, manifest=None):
+    """
+    处理一组RAW文件；提供清单时跳过清单中已处理且未变化的文件，并把本次的结果记入清单
+
+    :param raw_file_paths: RAW文件路径列表
+    :param output_directory: 输出目录
+    :param jobs: 并行运行的转换器进程数
+    :param manifest: 增量处理清单（可选）
+    :return: (实际处理的文件数, 失败列表 [(RAW路径, 原因)])
+    """
+    stats = {}
+    for path in raw_file_paths:
+        try:
+            stats[path] = os.stat(path)
+        except FileNotFoundError:
+            continue
+    pending = list(stats)
+    if manifest is not None:
+        pending = [path for path in pending if not manifest.is_current(path, stats[path])]
+    if not pending:
+        return 0, []
+    # 转换前计算哈希：处理期间文件又被修改时，修改时间与清单不符，下次会重新处理
+    hashes = {path: file_hash(path) for path in pending} if manifest is not None else {}
+
+    if len(pending) > 1:
+        # 多个文件时批量调用转换器，分摊转换器的启动开销
+        failures = process_files_batched(pending, output_directory, jobs)
+    else:
+        failures = []
+        if not process_file(pending[0], output_directory):
+            failures.append((pending[0], '处理失败'))
+
+    if manifest is not None:
+        failed = {path for path, _ in failures}
+        for path in pending:
+            manifest.record(path, stats[path], hashes[path], expected_dng_path(path, output_directory),
+                            failed=path in failed)
+        manifest.save()
+    return len(pending), failures
+
+def process_directory(directory_path, output_directory=None, jobs=1, manifest_path=None):
     """
     处理目录中的所有RAW文件
 
     :param directory_path: 包含RAW文件的目录路径
     :param output_directory: 输出目录（可选）
+    :param jobs: 并行运行的转换器进程数（默认1）
+    :param manifest_path: 增量处理清单的路径（可选），指定时只处理新增或变化的文件
+    :return: 全部成功返回True
     """
     if not os.path.isdir(directory_path):
         print(f"错误：目录不存在：{directory_path}")
-        return
+        return False
 
-    # 支持常见的RAW文件扩展名
-    raw_extensions = ('.raw', '.cr2', '.cr3', '.nef', '.arw', '.orf', '.rw2', '.raf')
-    raw_files = [f for f in os.listdir(directory_path) 
-                if os.path.splitext(f)[1].lower() in raw_extensions]
+    full_paths = list_raw_files(directory_path)
 
-    if not raw_files:
+    if not full_paths:
         print(f"在目录 {directory_path} 中未找到RAW文件。")
-        return
+        return True
+
+    print(f"\n找到 {len(full_paths)} 个RAW文件")
+    start = time.time()
+    manifest = Manifest(manifest_path) if manifest_path else None
+    total_files, failures = process_changed(full_paths, output_directory or directory_path, jobs, manifest)
+    if len(full_paths) > total_files:
+        print(f"跳过 {len(full_paths) - total_files} 个已处理且未变化的文件")
 
-    success_count = 0
-    total_files = len(raw_files)
-    print(f"\n找到 {total_files} 个RAW文件待处理")
+    success_count = total_files - len(failures)
+    elapsed = time.time() - start
+    print(f"\n批处理完成！成功处理 {success_count} 个文件，共 {total_files} 个文件。"
+          f"耗时 {elapsed:.1f} 秒（{total_files / max(elapsed, 1e-6):.2f} 文件/秒）")
+    if failures:
+        print("以下文件处理失败：")
+        for raw_path, reason in failures:
+            print(f"  {raw_path}: {reason}")
+    return not failures
 
-    for index, raw_file in enumerate(raw_files, 1):
-        print(f"\n处理文件 {index}/{total_files}")
-        full_path = os.path.join(directory_path, raw_file)
-        if process_file(full_path, output_directory):
-            success_count += 1
+def watch_directory(directory_path, output_directory=None, jobs=1, manifest_path=None,
+                    poll_interval=None, settle_seconds=None):
+    """
+    持续监视目录，新的RAW文件写入完成后立即转换（Ctrl+C 退出）
 
-    print(f"\n批处理完成！成功处理 {success_count} 个文件，共 {total_files} 个文件。")
+    inotify 报告写入完成（关闭）或移入的文件立即处理；修改时间超过 settle_seconds 秒没有变化的文件
+    也视为写入完成（用于 inotify 不可用的平台和看不到远端写入的网络共享，此时每隔 poll_interval 秒扫描一次）。
+    处理结果记录在清单中，重启后只处理新增或变化的文件，以及未达到重试上限的失败文件（见 Manifest）。
+
+    :param directory_path: 监视的目录
+    :param output_directory: 输出目录（可选，默认与监视目录相同）
+    :param jobs: 并行运行的转换器进程数
+    :param manifest_path: 清单路径（可选，默认为输出目录下的 .webraw_manifest.json）
+    :param poll_interval: 扫描间隔，单位秒
+    :param settle_seconds: 文件修改时间超过多少秒视为写入完成
+    :return: 退出时返回True，目录不存在返回False
+    """
+    if not os.path.isdir(directory_path):
+        print(f"错误：目录不存在：{directory_path}")
+        return False
+
+    output_directory = output_directory or directory_path
+    os.makedirs(output_directory, exist_ok=True)
+    poll_interval = poll_interval or Config.WATCH_POLL_INTERVAL
+    settle_seconds = Config.WATCH_SETTLE_SECONDS if settle_seconds is None else settle_seconds
+    manifest = Manifest(manifest_path or os.path.join(output_directory, MANIFEST_NAME))
+    watcher = InotifyWatcher.open(directory_path)
+    if watcher is None:
+        print(f"正在监视目录 {directory_path}（每 {poll_interval} 秒扫描一次），按 Ctrl+C 退出")
+    else:
+        print(f"正在监视目录 {directory_path}（inotify），按 Ctrl+C 退出")
+
+    # 等待写入完成的文件，以及 inotify 报告已写入完成的文件
+    waiting = set()
+    closed = set()
+    rescan = True
+    try:
+        while True:
+            if rescan:
+                waiting.update(list_raw_files(directory_path))
+            now = time.time()
+            ready = []
+            for path in sorted(waiting):
+                try:
+                    mtime = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue
+                if path in closed or now - mtime >= settle_seconds:
+                    ready.append(path)
+            waiting = {path for path in waiting if path not in ready and os.path.exists(path)}
+            closed.clear()
+
+            if ready:
+                count, failures = process_changed(ready, output_directory, jobs, manifest)
+                if count:
+                    print(f"[监视] 处理 {count} 个文件，失败 {len(failures)} 个")
+                    for raw_path, reason in failures:
+                        print(f"  {raw_path}: {reason}")
+                    given_up = manifest.given_up()
+                    if given_up:
+                        print(f"[监视] {len(given_up)} 个文件连续失败 {manifest.max_retries} 次，"
+                              f"文件内容变化之前不再重试：")
+                        for raw_path in given_up:
+                            print(f"  {raw_path}")
+
+            # 有文件正在写入时缩短等待时间
+            timeout = min(poll_interval, max(settle_seconds, 0.1)) if waiting else poll_interval
+            if watcher is None:
+                time.sleep(timeout)
+                rescan = True
+            else:
+                names, overflow = watcher.read(timeout)
+                arrived = {os.path.join(directory_path, name) for name in names if is_raw_file(name)}
+                closed |= arrived
+                waiting |= arrived
+                # 空闲时也定期扫描，补上 inotify 看不到的变化
+                rescan = overflow or not names
+    except KeyboardInterrupt:
+        print("\n已停止监视")
+    finally:
+        if watcher is not None:
+            watcher.close()
+    return True
 
 def main():
     parser = argparse.ArgumentParser(description="将RAW文件转换为DNG并修改相机信息为富士X-T5。")
     parser.add_argument("input_path", help="RAW文件的路径或包含RAW文件的目录路径")
     parser.add_argument("-o", "--output", help="输出目录路径（可选）。如果未指定，则输出到源文件所在目录。", default=None)
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="并行运行的转换器进程数（仅处理目录时有效，默认1）。与同一台机器上的服务进程共用"
+                             f"转换器进程上限 WEBRAW_CONVERTER_MAX_PROCESSES（当前 {Config.CONVERTER_MAX_PROCESSES}），"
+                             "超过时本次运行的上限提高到 --jobs。")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="持续监视目录，新文件写入完成后立即转换（使用清单，重启后只处理新增或变化的文件）。")
+    parser.add_argument("-m", "--manifest", default=None,
+                        help="增量处理清单的路径。处理目录时指定则跳过已处理的文件；监视模式默认为输出目录下的 "
+                             f"{MANIFEST_NAME}。")
+    parser.add_argument("--interval", type=float, default=None,
+                        help=f"监视模式的扫描间隔秒数（默认{Config.WATCH_POLL_INTERVAL}）。")
+    parser.add_argument("--settle", type=float, default=None,
+                        help=f"监视模式下文件多少秒未修改视为写入完成（默认{Config.WATCH_SETTLE_SECONDS}）。")
 
     args = parser.parse_args()
 
+    # 转换器进程上限小于 --jobs 时多出的进程只会等待槽位，提高本次运行的上限
+    if args.jobs > Config.CONVERTER_MAX_PROCESSES:
+        print(f"提示：--jobs {args.jobs} 超过转换器进程上限 {Config.CONVERTER_MAX_PROCESSES}"
+              f"（WEBRAW_CONVERTER_MAX_PROCESSES），本次运行的上限提高到 {args.jobs}")
+        raise_converter_limit(args.jobs)
+
     # 如果指定了输出目录，确保它存在
     if args.output:
         os.makedirs(args.output, exist_ok=True)
 
     # 根据输入路径类型选择处理方式
+    if args.watch:
+        return 0 if watch_directory(args.input_path, args.output, args.jobs, args.manifest,
+                                    args.interval, args.settle) else 1
     if os.path.isfile(args.input_path):
-        process_file(args.input_path, args.output)
+        success = process_file(args.input_path, args.output)
     else:
-        process_directory(args.input_path, args.output)
+        success = process_directory(args.input_path, args.output, args.jobs, args.manifest)
 
     print("\n所有处理已完成！")
     print(f"\n使用方法示例:")
     print(f"处理单个文件: python3 {os.path.basename(__file__)} /path/to/your/image.raw")
     print(f"处理整个目录: python3 {os.path.basename(__file__)} /path/to/your/raw_folder")
     print(f"指定输出目录: python3 {os.path.basename(__file__)} /path/to/your/image.raw -o /path/to/output_folder")
+    print(f"并行处理目录: python3 {os.path.basename(__file__)} /path/to/your/raw_folder --jobs 8")
+    print(f"持续监视目录: python3 {os.path.basename(__file__)} /path/to/ingest_folder -o /path/to/output_folder --watch")
+
+    # 有文件处理失败时返回非零退出码，便于脚本判断
+    return 0 if success else 1
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,229 @@
+import sys
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wsgi import FileWrapper
+
+import Config
+
+# 响应迭代结束的标记
+_DONE = object()
+
+
+def _next_chunk(iterator):
+    return next(iterator, _DONE)
+
+
+class AsgiBridge:
+    """
+    在 asyncio 事件循环中运行 WSGI 应用（Flask）的 ASGI 适配层
+
+    与连接相关的等待尽量在事件循环中完成：
+    - 请求体在事件循环中接收完毕后才把请求交给线程池中的 WSGI 应用，慢速上传不占用线程；
+      不超过 Config.ASGI_SPOOL_SIZE 的请求体（如分块上传的每个分块）保存在内存中，更大的写入临时文件；
+    - precheck 在接收请求体之前于事件循环中执行，可以直接发送响应（如队列已满的 429、分块过大的 413），
+      被拒绝的请求不接收上传数据；
+    - 响应数据每次只在线程池中取一块（文件下载每块 chunk_size 字节），发送时在事件循环中等待客户端，
+      慢速下载不占用线程；客户端断开时停止读取并关闭响应（流式 ZIP 等不会当作下载完成）；
+    - routes 中的路径由异步函数直接处理（如 SSE 长连接），参数为 (scope, send)。
+    """
+
+    def __init__(self, wsgi_app, routes=None, precheck=None, threads=None, chunk_size=None):
+        """
+        :param wsgi_app: WSGI 应用
+        :param routes: {(方法, 路径): 异步处理函数}
+        :param precheck: 接收请求体之前调用的异步函数 (scope, send)，已发送响应时返回True
+        :param threads: 执行 WSGI 应用的线程数，默认为 Config.ASGI_THREADS
+        :param chunk_size: 文件响应每次读取的字节数，默认为 Config.UPLOAD_CHUNK_SIZE
+        """
+        self.wsgi_app = wsgi_app
+        self.routes = dict(routes or {})
+        self.precheck = precheck
+        self.executor = ThreadPoolExecutor(max_workers=threads or Config.ASGI_THREADS, thread_name_prefix='asgi')
+        self.chunk_size = chunk_size or Config.UPLOAD_CHUNK_SIZE
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _file_wrapper(self, file, buffer_size=8192):
+        return FileWrapper(file, max(buffer_size, self.chunk_size))
+
+    def _environ(self, scope, body):
+        """按 PEP 3333 由 ASGI scope 构造 WSGI environ"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] if server[1] is not None else 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': self._file_wrapper
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+                continue
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        if 'CONTENT_LENGTH' not in environ:
+            # 分块传输编码的请求体没有 Content-Length，告诉 Werkzeug 读到末尾即可
+            environ['wsgi.input_terminated'] = True
+        return environ
+
+    async def _http(self, scope, receive, send):
+        body = _RequestBody(asyncio.get_running_loop())
+        try:
+            handler = self.routes.get((scope['method'], scope['path']))
+            if handler is None:
+                if self.precheck is not None and await self.precheck(scope, send):
+                    return
+                if not await body.receive(receive, self.executor):
+                    # 客户端在请求体收完之前断开
+                    return
+            watcher = asyncio.ensure_future(body.wait_disconnect(receive))
+            try:
+                if handler is not None:
+                    await handler(scope, _DisconnectAwareSend(send, body.disconnected))
+                else:
+                    await self._call_wsgi(scope, body, send)
+            finally:
+                watcher.cancel()
+        finally:
+            body.close()
+
+    async def _call_wsgi(self, scope, body, send):
+        loop = asyncio.get_running_loop()
+        disconnected = body.disconnected
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return self._unsupported_write
+
+        iterable = await loop.run_in_executor(self.executor, self.wsgi_app, self._environ(scope, body),
+                                              start_response)
+        try:
+            iterator = iter(iterable)
+            # 有的 WSGI 应用在第一次迭代时才调用 start_response
+            chunk = await loop.run_in_executor(self.executor, _next_chunk, iterator)
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': response['headers']})
+            while chunk is not _DONE:
+                if disconnected.done():
+                    return
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, _next_chunk, iterator)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.executor, close)
+
+    @staticmethod
+    def _unsupported_write(data):
+        raise NotImplementedError('ASGI 适配层不支持 start_response 返回的 write()')
+
+
+class _RequestBody:
+    """
+    wsgi.input：事件循环接收完整的请求体之后，执行 WSGI 应用的线程从中读取
+
+    不超过 Config.ASGI_SPOOL_SIZE 的数据保存在内存中，超过后转入临时文件，
+    写临时文件在线程池中进行（每次一块），不阻塞事件循环。
+    请求体收完之后 wait_disconnect 继续等待 http.disconnect，用于在发送响应时发现客户端已断开。
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.file = tempfile.SpooledTemporaryFile(max_size=Config.ASGI_SPOOL_SIZE)
+        self.size = 0
+        self.disconnected = loop.create_future()
+
+    async def receive(self, receive, executor):
+        """
+        在事件循环中接收整个请求体
+
+        :return: 收完返回True，客户端中途断开返回False
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                self.disconnected.set_result(True)
+                return False
+            chunk = message.get('body', b'')
+            if chunk:
+                self.size += len(chunk)
+                if self.size > Config.ASGI_SPOOL_SIZE:
+                    await self.loop.run_in_executor(executor, self.file.write, chunk)
+                else:
+                    self.file.write(chunk)
+            if not message.get('more_body', False):
+                break
+        await self.loop.run_in_executor(executor, self.file.seek, 0)
+        return True
+
+    async def wait_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+        if not self.disconnected.done():
+            self.disconnected.set_result(True)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.file.close()
+
+
+class _DisconnectAwareSend:
+    """传给异步处理函数的 send：客户端已断开时 disconnected 为 True"""
+
+    def __init__(self, send, disconnected):
+        self.send = send
+        self.disconnect_future = disconnected
+
+    @property
+    def disconnected(self):
+        return self.disconnect_future.done()
+
+    async def __call__(self, message):
+        await self.send(message)
@@ -1,7 +1,32 @@
-import subprocess
 import os
 import argparse
+import ExifToolSession
+import TiffIFD
+from Metrics import timed
 
+# 目标相机信息
+TARGET_MAKE = 'FUJIFILM'
+TARGET_MODEL = 'Fujifilm X-T5'
+
+def modify_camera_info_native(dng_file_path):
+    """
+    直接在DNG的IFD0中原地改写相机信息，只写入几KB数据而不是重写整个文件
+
+    :param dng_file_path: DNG文件的路径
+    :return: 成功返回True；文件结构不支持原地修改时返回False
+    """
+    try:
+        TiffIFD.write_ascii_tags(dng_file_path, {
+            TiffIFD.TAG_MAKE: TARGET_MAKE,
+            TiffIFD.TAG_MODEL: TARGET_MODEL,
+            TiffIFD.TAG_UNIQUE_CAMERA_MODEL: TARGET_MODEL
+        })
+        return True
+    except (TiffIFD.TiffError, OSError, ValueError) as e:
+        print(f"无法原地修改相机信息（{e}），改用exiftool")
+        return False
+
+@timed('tag', check_result=True)
 def modify_camera_info(dng_file_path):
     """
     修改DNG文件的相机信息为富士X-T5
@@ -12,33 +37,41 @@ def modify_camera_info(dng_file_path):
         print(f"错误：文件不存在：{dng_file_path}")
         return False
 
-    # 构建exiftool命令
-    command = [
-        'exiftool',
-        '-Make=FUJIFILM',
-        '-Model=Fujifilm X-T5',
-        '-UniqueCameraModel=Fujifilm X-T5'
+    # 优先原地改写标签
+    if modify_camera_info_native(dng_file_path):
+        print("EXIF信息修改成功！")
+        return True
+
+    # 构建exiftool参数（由常驻exiftool进程执行）
+    args = [
+        f'-Make={TARGET_MAKE}',
+        f'-Model={TARGET_MODEL}',
+        f'-UniqueCameraModel={TARGET_MODEL}'
     ]
     # 覆盖原文件
-    command.append('-overwrite_original')
+    args.append('-overwrite_original')
     
     # 添加文件路径
-    command.append(dng_file_path)
+    args.append(dng_file_path)
 
     try:
         # 执行exiftool命令
-        process = subprocess.run(command, check=True, capture_output=True, text=True)
+        result = ExifToolSession.execute(*args)
+        output = result.stdout.decode('utf-8', errors='replace')
+        if 'Error' in result.stderr or '1 image files updated' not in output:
+            print("修改失败。")
+            if output:
+                print(f"输出:\n{output}")
+            if result.stderr:
+                print(f"错误信息:\n{result.stderr}")
+            return False
         print("EXIF信息修改成功！")
-        if process.stdout:
-            print(f"输出信息:\n{process.stdout}")
+        if output:
+            print(f"输出信息:\n{output}")
         return True
 
-    except subprocess.CalledProcessError as e:
-        print(f"修改失败。错误码: {e.returncode}")
-        if e.stdout:
-            print(f"输出:\n{e.stdout}")
-        if e.stderr:
-            print(f"错误信息:\n{e.stderr}")
+    except ExifToolSession.ExifToolError as e:
+        print(f"修改失败。{e}")
         return False
     except FileNotFoundError:
         print("错误：未找到exiftool工具。请确保已安装exiftool。")
@@ -50,6 +83,48 @@ def modify_camera_info(dng_file_path):
         print(f"发生未知错误: {e}")
         return False
 
+@timed('tag_batch')
+def modify_camera_info_batch(dng_file_paths):
+    """
+    批量修改多个DNG文件的相机信息
+
+    能原地改写的文件逐个处理，其余文件合并为一条exiftool命令执行。
+
+    :param dng_file_paths: DNG文件路径列表
+    :return: {路径: 是否成功}
+    """
+    results = {}
+    fallback = []
+    for path in dng_file_paths:
+        if not os.path.isfile(path):
+            print(f"错误：文件不存在：{path}")
+            results[path] = False
+        elif modify_camera_info_native(path):
+            results[path] = True
+        else:
+            fallback.append(path)
+
+    if fallback:
+        args = [
+            f'-Make={TARGET_MAKE}',
+            f'-Model={TARGET_MODEL}',
+            f'-UniqueCameraModel={TARGET_MODEL}',
+            '-overwrite_original'
+        ] + fallback
+        try:
+            result = ExifToolSession.execute(*args)
+            output = result.stdout.decode('utf-8', errors='replace')
+            if result.stderr:
+                print(f"错误信息:\n{result.stderr}")
+            for path in fallback:
+                # exiftool 对出错的文件逐行报告 "Error: ... - 文件路径"
+                results[path] = path not in result.stderr and 'image files updated' in output
+        except (ExifToolSession.ExifToolError, FileNotFoundError) as e:
+            print(f"批量修改失败：{e}")
+            for path in fallback:
+                results[path] = False
+    return results
+
 def process_directory(directory_path):
     """
     处理目录中的所有DNG文件
@@ -0,0 +1,136 @@
+import os
+
+
+def _env_int(name, default):
+    """
+    从环境变量读取整数配置
+
+    :param name: 环境变量名
+    :param default: 未设置或无法解析时使用的默认值
+    """
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"警告：环境变量 {name} 的值无效：{value}，使用默认值 {default}")
+        return default
+
+
+# 同时运行的转换任务数（默认取CPU核数的一半）
+CONVERSION_WORKERS = _env_int('WEBRAW_CONVERSION_WORKERS', max(1, (os.cpu_count() or 2) // 2))
+
+# 已结束（完成/失败）的任务状态保留时间，单位秒
+JOB_RETENTION_SECONDS = _env_int('WEBRAW_JOB_RETENTION_SECONDS', 3600)
+
+# exiftool 可执行文件路径
+EXIFTOOL_PATH = os.environ.get('WEBRAW_EXIFTOOL_PATH', 'exiftool')
+
+# 常驻 exiftool 进程数（-stay_open），默认与转换并发数一致
+EXIFTOOL_WORKERS = _env_int('WEBRAW_EXIFTOOL_WORKERS', CONVERSION_WORKERS)
+
+# 单条 exiftool 命令的超时时间，单位秒
+EXIFTOOL_TIMEOUT = _env_int('WEBRAW_EXIFTOOL_TIMEOUT', 60)
+
+# 预览图尺寸档位（最长边像素）
+PREVIEW_THUMB_SIZE = _env_int('WEBRAW_PREVIEW_THUMB_SIZE', 320)
+PREVIEW_MEDIUM_SIZE = _env_int('WEBRAW_PREVIEW_MEDIUM_SIZE', 1280)
+
+# 预览图缓存的内存层和磁盘层字节预算
+PREVIEW_MEMORY_BUDGET = _env_int('WEBRAW_PREVIEW_MEMORY_BUDGET', 64 * 1024 * 1024)
+PREVIEW_DISK_BUDGET = _env_int('WEBRAW_PREVIEW_DISK_BUDGET', 1024 * 1024 * 1024)
+
+# 上传文件写盘和计算哈希时的块大小
+UPLOAD_CHUNK_SIZE = _env_int('WEBRAW_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+
+# 全局转换缓存的字节预算
+CONVERSION_CACHE_BUDGET = _env_int('WEBRAW_CONVERSION_CACHE_BUDGET', 20 * 1024 * 1024 * 1024)
+
+# 批量转换时每个 DNG Converter 进程最多处理的文件数和字节数
+CONVERTER_BATCH_MAX_FILES = _env_int('WEBRAW_CONVERTER_BATCH_MAX_FILES', 16)
+CONVERTER_BATCH_MAX_BYTES = _env_int('WEBRAW_CONVERTER_BATCH_MAX_BYTES', 1024 * 1024 * 1024)
+
+# 转换器后端：adobe（Adobe DNG Converter）、command（自定义命令行）、fake（测试用替身）
+CONVERTER_BACKEND = os.environ.get('WEBRAW_CONVERTER_BACKEND', 'adobe')
+
+# Adobe DNG Converter 的路径（默认为 macOS 上的典型路径）
+ADOBE_DNG_CONVERTER_PATH = os.environ.get(
+    'WEBRAW_ADOBE_DNG_CONVERTER_PATH',
+    "/Applications/Adobe DNG Converter.app/Contents/MacOS/Adobe DNG Converter"
+)
+
+# command 后端的命令模板，例如 "dnglab convert {input} {output}"
+CONVERTER_COMMAND = os.environ.get('WEBRAW_CONVERTER_COMMAND', '')
+
+# fake 后端模拟的进程启动耗时和单文件耗时，单位毫秒
+FAKE_CONVERTER_STARTUP_MS = _env_int('WEBRAW_FAKE_CONVERTER_STARTUP_MS', 0)
+FAKE_CONVERTER_FILE_MS = _env_int('WEBRAW_FAKE_CONVERTER_FILE_MS', 0)
+
+# 用户、文件、令牌和任务索引（SQLite）的路径，多个服务进程共享同一个文件
+INDEX_DB_PATH = os.environ.get('WEBRAW_INDEX_DB_PATH', 'webraw_index.db')
+
+# 文件访问令牌（HMAC签名）的密钥；为空时使用 TOKEN_SECRET_PATH 中自动生成的密钥
+TOKEN_SECRET = os.environ.get('WEBRAW_TOKEN_SECRET', '')
+TOKEN_SECRET_PATH = os.environ.get('WEBRAW_TOKEN_SECRET_PATH', 'webraw_token.key')
+
+# 访问令牌的有效期，单位秒（实际有效时间在一到两个有效期之间）
+TOKEN_TTL_SECONDS = max(1, _env_int('WEBRAW_TOKEN_TTL_SECONDS', 6 * 3600))
+
+# 文件被下载后（客户端未确认收到时）保留的时间，单位秒，期间可以断点续传或重新下载
+DOWNLOAD_RETENTION_SECONDS = _env_int('WEBRAW_DOWNLOAD_RETENTION_SECONDS', 3600)
+
+# 分块上传时单个分块的最大字节数，以及未完成的分块上传保留的时间（秒）
+UPLOAD_MAX_CHUNK_SIZE = _env_int('WEBRAW_UPLOAD_MAX_CHUNK_SIZE', 16 * 1024 * 1024)
+UPLOAD_PARTIAL_TTL_SECONDS = _env_int('WEBRAW_UPLOAD_PARTIAL_TTL_SECONDS', 24 * 3600)
+
+# 进度事件（SSE）的保留时间，单位秒，断线重连时可以补发这段时间内的事件
+EVENT_RETENTION_SECONDS = _env_int('WEBRAW_EVENT_RETENTION_SECONDS', 3600)
+
+# 转换完成后预先生成预览图的线程数和尺寸档位（逗号分隔，如 "thumb,medium"，为空则不预生成）
+PREVIEW_WORKERS = max(1, _env_int('WEBRAW_PREVIEW_WORKERS', 1))
+PREVIEW_WARM_VARIANTS = os.environ.get('WEBRAW_PREVIEW_WARM_VARIANTS', 'thumb')
+
+# 同一台机器上（所有服务进程和命令行进程合计）同时运行的转换器进程数和 exiftool 命令数
+# 命令行（Apply.py）同样受此限制；--jobs 大于转换器进程数时，本次运行的上限提高到 --jobs 并给出提示
+CONVERTER_MAX_PROCESSES = max(1, _env_int('WEBRAW_CONVERTER_MAX_PROCESSES', CONVERSION_WORKERS))
+EXIFTOOL_MAX_ACTIVE = max(1, _env_int('WEBRAW_EXIFTOOL_MAX_ACTIVE', os.cpu_count() or 1))
+
+# 并发槽位锁文件所在的目录（为空时使用系统临时目录下的 webraw-slots）
+PROCESS_SLOT_DIR = os.environ.get('WEBRAW_PROCESS_SLOT_DIR', '')
+
+# 每个服务进程中等待转换的任务数上限，达到上限时上传接口返回 429
+QUEUE_MAX_PENDING = max(1, _env_int('WEBRAW_QUEUE_MAX_PENDING', 256))
+
+# 监视目录模式（Apply.py --watch）的扫描间隔，以及文件多少秒未修改视为写入完成，单位秒
+WATCH_POLL_INTERVAL = max(1, _env_int('WEBRAW_WATCH_POLL_INTERVAL', 10))
+WATCH_SETTLE_SECONDS = _env_int('WEBRAW_WATCH_SETTLE_SECONDS', 5)
+# 处理失败的文件在内容不变时的重试：第n次失败后等待 WATCH_RETRY_SECONDS * 2^(n-1) 秒再试
+# （重新启动后立即重试），失败 WATCH_MAX_RETRIES 次后不再重试，直到文件内容变化
+WATCH_RETRY_SECONDS = max(1, _env_int('WEBRAW_WATCH_RETRY_SECONDS', 60))
+WATCH_MAX_RETRIES = max(1, _env_int('WEBRAW_WATCH_MAX_RETRIES', 5))
+
+# 输出目录的字节预算和输出文件的保留时间（最近一次访问之后，单位秒），由后台清理线程执行
+OUTPUT_DISK_BUDGET = _env_int('WEBRAW_OUTPUT_DISK_BUDGET', 50 * 1024 * 1024 * 1024)
+OUTPUT_TTL_SECONDS = _env_int('WEBRAW_OUTPUT_TTL_SECONDS', 7 * 24 * 3600)
+
+# 上传目录和输出目录中不属于任何任务或上传的文件，超过这段时间未修改后删除，单位秒
+ORPHAN_GRACE_SECONDS = _env_int('WEBRAW_ORPHAN_GRACE_SECONDS', 3600)
+
+# 后台清理线程的运行间隔，单位秒
+JANITOR_INTERVAL_SECONDS = max(1, _env_int('WEBRAW_JANITOR_INTERVAL_SECONDS', 60))
+
+# ASGI 服务（run_asgi.py）中执行 Flask 视图和读取响应数据的线程数
+ASGI_THREADS = max(1, _env_int('WEBRAW_ASGI_THREADS', 32))
+
+# ASGI 服务中请求体在交给 Flask 之前完整接收，不超过此字节数时保存在内存中，否则写入临时文件
+# （默认与分块上传的分块上限相同，浏览器的分块上传不经过临时文件）
+ASGI_SPOOL_SIZE = _env_int('WEBRAW_ASGI_SPOOL_SIZE', UPLOAD_MAX_CHUNK_SIZE)
+
+# 中间文件暂存区（例如 tmpfs 上的 /dev/shm/webraw，为空表示不启用）：
+# 上传的RAW、转换器输出和 exiftool 改写都在暂存区中进行，只有最终的DNG写入输出目录
+SCRATCH_DIR = os.environ.get('WEBRAW_SCRATCH_DIR', '')
+# 暂存区最多使用的字节数，超出时新文件改在磁盘上处理
+SCRATCH_BUDGET = _env_int('WEBRAW_SCRATCH_BUDGET', 2 * 1024 * 1024 * 1024)
+# 超过此大小的文件不暂存，直接在磁盘上处理
+SCRATCH_MAX_FILE_SIZE = _env_int('WEBRAW_SCRATCH_MAX_FILE_SIZE', 256 * 1024 * 1024)
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Linux 上的 FICLONE ioctl（btrfs/xfs 等支持写时复制的文件系统）
+FICLONE = 0x40049409
+
+
+def settings_key(settings):
+    """根据转换设置生成短摘要，设置不同的转换结果互不复用"""
+    encoded = json.dumps(settings, sort_keys=True).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=6).hexdigest()
+
+
+def cache_key(raw_hash, settings):
+    """
+    转换缓存的键
+
+    :param raw_hash: RAW 文件的内容哈希
+    :param settings: 影响转换结果的设置字典
+    """
+    return f'{raw_hash}-{settings_key(settings)}'
+
+
+def link_or_copy(src, dst):
+    """
+    依次尝试硬链接、reflink（写时复制）和普通复制
+
+    不会以写方式打开已有的 dst：它可能是与其他输出文件硬链接的缓存文件，截断会同时清空那些文件。
+    复制时先写入同目录下的独占临时文件，完成后用 os.replace 换上（替换目录项，不改动原有文件的内容）。
+
+    :raises FileExistsError: 硬链接时 dst 已存在
+    """
+    try:
+        os.link(src, dst)
+        return
+    except FileExistsError:
+        raise
+    except OSError:
+        pass
+    tmp_path = f'{dst}.{os.getpid()}.{threading.get_ident()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        with open(src, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+            try:
+                if fcntl is None:
+                    raise OSError('reflink 不可用')
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                shutil.copyfileobj(fsrc, fdst)
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class ConversionCache:
+    """
+    以内容为键的全局DNG转换缓存
+
+    缓存中的DNG以硬链接（或reflink/复制）的方式出现在用户的输出目录中；
+    每个条目记录引用它的输出文件，没有引用的条目在超出字节预算时按LRU淘汰。
+    多个服务进程共享同一个缓存目录：每次读取或修改索引前持有 index.lock 的文件锁，
+    并重新读取其他进程写入的索引。
+    """
+
+    def __init__(self, directory, budget):
+        """
+        :param directory: 缓存目录
+        :param budget: 缓存字节上限
+        """
+        self.directory = directory
+        self.budget = budget
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock_path = os.path.join(directory, 'index.lock')
+        self.lock = threading.Lock()
+        self.entries = {}
+        # 最近一次读取或写入的索引文件的 (inode, 修改时间, 大小)，未变化时不重新读取
+        self.index_stamp = None
+        os.makedirs(directory, exist_ok=True)
+        with self._locked():
+            self._load()
+            self._save()
+
+    @contextmanager
+    def _locked(self):
+        """持有进程内的锁和跨进程的文件锁，并读入其他进程对索引的修改"""
+        with self.lock:
+            fd = None
+            if fcntl is not None:
+                fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                self._read_index()
+                yield
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read_index(self):
+        """索引文件有变化时重新读取（调用方需持有锁）"""
+        stamp = self._stamp()
+        if stamp is None or stamp == self.index_stamp:
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"警告：转换缓存索引损坏，将重新建立：{e}")
+            self.entries = {}
+        self.index_stamp = stamp
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.dng')
+
+    def _load(self):
+        """启动时核对索引：丢弃磁盘上已经不存在的条目（调用方需持有锁）"""
+        for key in list(self.entries):
+            if not os.path.exists(self._path(key)):
+                del self.entries[key]
+                continue
+            entry = self.entries[key]
+            entry['refs'] = [path for path in entry['refs'] if os.path.exists(path)]
+        # 索引中缺失但磁盘上存在的文件也纳入管理
+        for subdir in os.listdir(self.directory):
+            subdir_path = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                key = name[:-4]
+                if name.endswith('.dng') and key not in self.entries:
+                    stat = os.stat(os.path.join(subdir_path, name))
+                    self.entries[key] = {'size': stat.st_size, 'last_access': stat.st_mtime, 'refs': []}
+
+    def _save(self):
+        """原子地写入索引（调用方需持有锁）"""
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+        self.index_stamp = self._stamp()
+
+    def contains(self, key):
+        with self._locked():
+            return key in self.entries
+
+    def materialize(self, key, dest_path):
+        """
+        把缓存中的DNG放到用户输出目录
+
+        :param key: 缓存键
+        :param dest_path: 目标路径
+        :return: 命中并成功放置返回True，未命中返回False
+        """
+        dest_path = os.path.abspath(dest_path)
+        with self._locked():
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            try:
+                link_or_copy(self._path(key), dest_path)
+            except OSError as e:
+                print(f"转换缓存放置失败：{e}")
+                return False
+            entry['last_access'] = time.time()
+            if dest_path not in entry['refs']:
+                entry['refs'].append(dest_path)
+            self._save()
+            return True
+
+    def store(self, key, dng_path):
+        """
+        把新转换出的DNG加入缓存，dng_path 本身记为第一个引用
+
+        :param key: 缓存键
+        :param dng_path: 已完成转换和相机信息修改的DNG路径
+        """
+        cache_path = self._path(key)
+        dng_path = os.path.abspath(dng_path)
+        with self._locked():
+            if key in self.entries:
+                entry = self.entries[key]
+            else:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                try:
+                    link_or_copy(dng_path, cache_path)
+                except FileExistsError:
+                    # 其他进程已经存入了相同内容的转换结果，直接使用已有的缓存文件
+                    pass
+                except OSError as e:
+                    print(f"写入转换缓存失败：{e}")
+                    return
+                entry = {'size': os.path.getsize(cache_path), 'refs': []}
+                self.entries[key] = entry
+            entry['last_access'] = time.time()
+            if dng_path not in entry['refs']:
+                entry['refs'].append(dng_path)
+            self._evict()
+            self._save()
+
+    def release(self, dest_path):
+        """输出文件被删除后解除它对缓存条目的引用"""
+        dest_path = os.path.abspath(dest_path)
+        with self._locked():
+            for entry in self.entries.values():
+                if dest_path in entry['refs']:
+                    entry['refs'].remove(dest_path)
+                    self._evict()
+                    self._save()
+                    return
+
+    def _evict(self):
+        """超出预算时按最近访问时间淘汰没有引用的条目（调用方需持有锁）"""
+        total = sum(entry['size'] for entry in self.entries.values())
+        if total <= self.budget:
+            return
+        candidates = sorted((entry['last_access'], key) for key, entry in self.entries.items() if not entry['refs'])
+        for _, key in candidates:
+            if total <= self.budget:
+                break
+            total -= self.entries.pop(key)['size']
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        """返回缓存使用情况"""
+        with self._locked():
+            return {
+                'entries': len(self.entries),
+                'bytes': sum(entry['size'] for entry in self.entries.values()),
+                'referenced': sum(1 for entry in self.entries.values() if entry['refs'])
+            }
@@ -0,0 +1,272 @@
+import io
+import os
+import time
+import shlex
+import struct
+import hashlib
+import subprocess
+from collections import namedtuple
+
+import Config
+
+# 转换器进程的执行结果
+ConverterResult = namedtuple('ConverterResult', ['returncode', 'stdout', 'stderr'])
+
+
+class ConverterBackend:
+    """
+    RAW→DNG 转换器后端
+
+    后端只负责把一组RAW文件转换为 output_directory 下同名（扩展名为 .dng）的DNG文件，
+    输出文件的检查和对应关系由 DNGConverter 统一处理。
+    """
+
+    name = 'base'
+
+    def check(self):
+        """检查后端是否可用，返回错误信息，可用时返回None"""
+        return None
+
+    def run(self, raw_file_paths, output_directory):
+        """
+        转换一组RAW文件
+
+        :param raw_file_paths: RAW文件路径列表
+        :param output_directory: DNG 输出目录
+        :return: ConverterResult
+        """
+        raise NotImplementedError
+
+
+class AdobeBackend(ConverterBackend):
+    """Adobe DNG Converter 子进程（一次调用可以转换多个文件）"""
+
+    name = 'adobe'
+
+    def __init__(self, path):
+        self.path = path
+
+    def check(self):
+        if not os.path.exists(self.path):
+            return f"找不到 Adobe DNG Converter，请确保它安装在路径：{self.path}"
+        return None
+
+    def run(self, raw_file_paths, output_directory):
+        # -c: 创建压缩的 DNG 文件 (可选)；-u: 不更新嵌入的 JPEG 预览 (可选)
+        # 不使用 -e 选项，因为它会嵌入整个原始RAW文件，导致文件过大
+        command = [self.path, '-d', output_directory] + list(raw_file_paths)
+        print(f"正在执行命令: {' '.join(command)}")
+        process = subprocess.run(command, capture_output=True, text=True)
+        return ConverterResult(process.returncode, process.stdout, process.stderr)
+
+
+class CommandBackend(ConverterBackend):
+    """
+    可配置的命令行转换器
+
+    命令模板中可以使用以下占位符（作为独立的参数）：
+    {inputs} 展开为全部输入文件，一次调用完成；
+    {input} 和 {output} 为单个输入文件和对应的DNG路径，每个文件调用一次；
+    {output_dir} 为输出目录。
+    """
+
+    name = 'command'
+
+    def __init__(self, template):
+        self.template = shlex.split(template)
+
+    def check(self):
+        if not self.template:
+            return "未配置转换命令（WEBRAW_CONVERTER_COMMAND）"
+        return None
+
+    def _expand(self, inputs, output_directory, output=None):
+        command = []
+        for arg in self.template:
+            if arg == '{inputs}':
+                command.extend(inputs)
+            else:
+                command.append(arg.replace('{input}', inputs[0])
+                               .replace('{output_dir}', output_directory)
+                               .replace('{output}', output or ''))
+        return command
+
+    def run(self, raw_file_paths, output_directory):
+        if '{inputs}' in self.template:
+            invocations = [self._expand(list(raw_file_paths), output_directory)]
+        else:
+            invocations = []
+            for path in raw_file_paths:
+                stem = os.path.splitext(os.path.basename(path))[0]
+                output = os.path.join(output_directory, f'{stem}.dng')
+                invocations.append(self._expand([path], output_directory, output))
+
+        returncode, stdout, stderr = 0, [], []
+        for command in invocations:
+            print(f"正在执行命令: {' '.join(command)}")
+            process = subprocess.run(command, capture_output=True, text=True)
+            returncode = returncode or process.returncode
+            stdout.append(process.stdout)
+            stderr.append(process.stderr)
+        return ConverterResult(returncode, ''.join(stdout), ''.join(stderr))
+
+
+class FakeBackend(ConverterBackend):
+    """
+    用于测试和基准测试的替身转换器
+
+    不依赖任何外部程序，按输入内容确定性地生成最小的合法DNG
+    （16x16 LinearRaw 主图 + JPEG 预览 SubIFD），并可模拟转换器的启动和单文件耗时。
+    """
+
+    name = 'fake'
+
+    def __init__(self, startup_latency=0.0, file_latency=0.0, preview_size=1024):
+        self.startup_latency = startup_latency
+        self.file_latency = file_latency
+        self.preview_size = preview_size
+
+    def run(self, raw_file_paths, output_directory):
+        time.sleep(self.startup_latency)
+        returncode, errors = 0, []
+        for path in raw_file_paths:
+            time.sleep(self.file_latency)
+            try:
+                with open(path, 'rb') as f:
+                    seed = hashlib.blake2b(f.read(), digest_size=16).digest()
+                stem = os.path.splitext(os.path.basename(path))[0]
+                write_minimal_dng(os.path.join(output_directory, f'{stem}.dng'), seed, self.preview_size)
+            except OSError as e:
+                returncode = 1
+                errors.append(f"{path}: {e}\n")
+        return ConverterResult(returncode, '', ''.join(errors))
+
+
+def _entry(tag, value_type, values):
+    """构造一个IFD条目：(标签, 类型, 数量, 数据字节)"""
+    if value_type == 2:
+        data = values.encode('ascii') + b'\0'
+        return tag, value_type, len(data), data
+    formats = {1: 'B', 3: 'H', 4: 'I', 5: 'II', 10: 'ii'}
+    fmt = formats[value_type]
+    if value_type in (5, 10):
+        flat = [part for pair in values for part in pair]
+        return tag, value_type, len(values), struct.pack('<' + fmt * len(values), *flat)
+    return tag, value_type, len(values), struct.pack('<' + fmt * len(values), *values)
+
+
+def _append_ifd(buf, entries):
+    """把IFD（及其超过4字节的数据）追加到 buf 末尾，返回IFD偏移"""
+    if len(buf) & 1:
+        buf.append(0)
+    entries = sorted(entries)
+    ifd_offset = len(buf)
+    data_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    table = bytearray(struct.pack('<H', len(entries)))
+    data_area = bytearray()
+    for tag, value_type, count, data in entries:
+        table += struct.pack('<HHI', tag, value_type, count)
+        if len(data) <= 4:
+            table += data.ljust(4, b'\0')
+        else:
+            table += struct.pack('<I', data_offset + len(data_area))
+            data_area += data
+            if len(data_area) & 1:
+                data_area.append(0)
+    table += struct.pack('<I', 0)
+    buf += table + data_area
+    return ifd_offset
+
+
+def write_minimal_dng(dng_path, seed, preview_size=1024):
+    """
+    写出一个最小的合法DNG文件
+
+    :param dng_path: 输出路径
+    :param seed: 决定图像颜色的字节串（相同输入得到相同输出）
+    :param preview_size: JPEG 预览图的宽度
+    """
+    from PIL import Image
+
+    width = height = 16
+    color = tuple(seed[:3])
+    raw_data = struct.pack('<HHH', *(c * 257 for c in color)) * (width * height)
+
+    preview_height = preview_size * 2 // 3
+    jpeg = io.BytesIO()
+    Image.new('RGB', (preview_size, preview_height), color).save(jpeg, 'JPEG', quality=90)
+    jpeg_data = jpeg.getvalue()
+
+    buf = bytearray(b'II*\0\0\0\0\0')
+    raw_offset = len(buf)
+    buf += raw_data
+    jpeg_offset = len(buf)
+    buf += jpeg_data
+
+    preview_ifd = _append_ifd(buf, [
+        _entry(0x00FE, 4, [1]),
+        _entry(0x0100, 4, [preview_size]),
+        _entry(0x0101, 4, [preview_height]),
+        _entry(0x0102, 3, [8, 8, 8]),
+        _entry(0x0103, 3, [7]),
+        _entry(0x0106, 3, [6]),
+        _entry(0x0111, 4, [jpeg_offset]),
+        _entry(0x0115, 3, [3]),
+        _entry(0x0116, 4, [preview_height]),
+        _entry(0x0117, 4, [len(jpeg_data)]),
+    ])
+    main_ifd = _append_ifd(buf, [
+        _entry(0x00FE, 4, [0]),
+        _entry(0x0100, 4, [width]),
+        _entry(0x0101, 4, [height]),
+        _entry(0x0102, 3, [16, 16, 16]),
+        _entry(0x0103, 3, [1]),
+        _entry(0x0106, 3, [34892]),
+        _entry(0x010F, 2, 'FakeCam'),
+        _entry(0x0110, 2, 'FakeCam Model 1'),
+        _entry(0x0111, 4, [raw_offset]),
+        _entry(0x0115, 3, [3]),
+        _entry(0x0116, 4, [height]),
+        _entry(0x0117, 4, [len(raw_data)]),
+        _entry(0x011C, 3, [1]),
+        _entry(0x014A, 4, [preview_ifd]),
+        _entry(0xC612, 1, [1, 4, 0, 0]),
+        _entry(0xC613, 1, [1, 1, 0, 0]),
+        _entry(0xC614, 2, 'FakeCam Model 1'),
+        _entry(0xC621, 10, [(1, 1), (0, 1), (0, 1), (0, 1), (1, 1), (0, 1), (0, 1), (0, 1), (1, 1)]),
+        _entry(0xC628, 5, [(1, 1), (1, 1), (1, 1)]),
+        _entry(0xC65A, 3, [21]),
+    ])
+    struct.pack_into('<I', buf, 4, main_ifd)
+
+    tmp_path = f'{dng_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(buf)
+    os.replace(tmp_path, dng_path)
+
+
+def create_backend(name=None):
+    """
+    根据配置创建转换器后端
+
+    :param name: 后端名称（adobe、command、fake），默认取 WEBRAW_CONVERTER_BACKEND
+    """
+    name = name or Config.CONVERTER_BACKEND
+    if name == 'adobe':
+        return AdobeBackend(Config.ADOBE_DNG_CONVERTER_PATH)
+    if name == 'command':
+        return CommandBackend(Config.CONVERTER_COMMAND)
+    if name == 'fake':
+        return FakeBackend(Config.FAKE_CONVERTER_STARTUP_MS / 1000, Config.FAKE_CONVERTER_FILE_MS / 1000)
+    raise ValueError(f"未知的转换器后端: {name}")
+
+
+_backend = None
+
+
+def get_backend():
+    """返回当前进程使用的转换器后端（首次调用时按配置创建）"""
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
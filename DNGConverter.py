@@ -1,38 +1,31 @@
-import subprocess
 import argparse
+import time
 import os
+import Config
+from ConverterBackends import get_backend
+from ProcessSlots import converter_slot
+from Metrics import timed
 
-# Adobe DNG Converter 在 macOS 上的典型路径
-ADOBE_DNG_CONVERTER_PATH = "/Applications/Adobe DNG Converter.app/Contents/MacOS/Adobe DNG Converter"
-
+@timed('convert')
 def convert_raw_to_dng(raw_file_path, output_directory=None, preserve_exif=True):
     """
-    使用 Adobe DNG Converter 将 RAW 文件转换为 DNG 文件。
+    使用配置的转换器后端（默认 Adobe DNG Converter）将 RAW 文件转换为 DNG 文件。
 
     :param raw_file_path: 输入的 RAW 文件的路径。
     :param output_directory: DNG 文件的输出目录。如果为 None，则输出到 RAW 文件所在的目录。
     :param preserve_exif: 是否保留原始EXIF信息。默认为True，Adobe DNG Converter会自动保留EXIF元数据。
     """
-    if not os.path.exists(ADOBE_DNG_CONVERTER_PATH):
-        print(f"错误：找不到 Adobe DNG Converter，请确保它安装在路径：{ADOBE_DNG_CONVERTER_PATH}")
+    backend = get_backend()
+    error = backend.check()
+    if error:
+        print(f"错误：{error}")
         return
 
     if not os.path.isfile(raw_file_path):
         print(f"错误：RAW 文件不存在：{raw_file_path}")
         return
 
-    command = [ADOBE_DNG_CONVERTER_PATH]
-
-    # -c: 创建压缩的 DNG 文件 (可选，根据需要添加)
-    # command.append("-c")
-
-    # -u: 不更新嵌入的 JPEG 预览 (可选)
-    # command.append("-u")
-    
     # 注意：Adobe DNG Converter 默认会保留所有EXIF元数据信息
-    # 我们不使用 -e 选项，因为它会嵌入整个原始RAW文件，导致文件过大
-    # 如果需要嵌入原始RAW文件，可以手动添加 -e 选项
-    
     if preserve_exif:
         print("信息：将保留原始EXIF元数据信息。")
 
@@ -44,50 +37,120 @@ def convert_raw_to_dng(raw_file_path, output_directory=None, preserve_exif=True)
             except OSError as e:
                 print(f"错误：无法创建输出目录 {output_directory}: {e}")
                 return
-        command.extend(["-d", output_directory])
     else:
         # 如果未指定输出目录，则输出到源文件目录
-        source_dir = os.path.dirname(raw_file_path)
-        if source_dir: # 确保源文件路径不是仅文件名
-             command.extend(["-d", source_dir])
-
-    command.append(raw_file_path)
-
-    print(f"正在执行命令: {' '.join(command)}")
+        output_directory = os.path.dirname(raw_file_path) or '.'
 
     try:
-        process = subprocess.run(command, check=True, capture_output=True, text=True)
+        with converter_slot():
+            result = backend.run([raw_file_path], output_directory)
+        if result.returncode != 0:
+            print(f"转换失败。错误码: {result.returncode}")
+            if result.stdout:
+                print(f"输出:\n{result.stdout}")
+            if result.stderr:
+                print(f"错误信息:\n{result.stderr}")
+            return
         print("转换成功!")
-        if process.stdout:
-            print(f"输出:\n{process.stdout}")
-        # Adobe DNG Converter 成功时通常没有太多标准输出，更多信息可能在日志中
-        # DNG 文件名通常与原始 RAW 文件名相同，扩展名为 .dng
+        if result.stdout:
+            print(f"输出:\n{result.stdout}")
+        # DNG 文件名与原始 RAW 文件名相同，扩展名为 .dng
         raw_filename_stem = os.path.splitext(os.path.basename(raw_file_path))[0]
-        dng_filename = f"{raw_filename_stem}.dng"
-        
-        if output_directory:
-            expected_dng_path = os.path.join(output_directory, dng_filename)
-        elif source_dir:
-            expected_dng_path = os.path.join(source_dir, dng_filename)
-        else:
-            expected_dng_path = dng_filename
-            
+        expected_dng_path = os.path.join(output_directory, f"{raw_filename_stem}.dng")
+
         if os.path.exists(expected_dng_path):
             print(f"生成的 DNG 文件位于: {expected_dng_path}")
         else:
             print(f"注意：转换过程已执行，但未在预期位置找到 DNG 文件: {expected_dng_path}。请检查转换器的输出或日志。")
 
-    except subprocess.CalledProcessError as e:
-        print(f"转换失败。错误码: {e.returncode}")
-        if e.stdout:
-            print(f"输出:\n{e.stdout}")
-        if e.stderr:
-            print(f"错误信息:\n{e.stderr}")
-    except FileNotFoundError:
-        print(f"错误：Adobe DNG Converter 执行文件未找到或无法执行。请检查路径：{ADOBE_DNG_CONVERTER_PATH}")
+    except OSError as e:
+        print(f"错误：转换器执行文件未找到或无法执行（后端 {backend.name}）：{e}")
     except Exception as e:
         print(f"发生未知错误: {e}")
 
+def plan_batches(raw_file_paths, max_files=None, max_bytes=None):
+    """
+    把待转换文件分组，每组交给一个转换器进程
+
+    同一组内不会出现同名（去掉扩展名后）的文件，避免输出的DNG互相覆盖。
+
+    :param raw_file_paths: RAW文件路径列表
+    :param max_files: 每组最多文件数（默认取配置）
+    :param max_bytes: 每组最多字节数（默认取配置，单个超大文件单独成组）
+    :return: 分组后的路径列表的列表（保持输入顺序）
+    """
+    max_files = max_files or Config.CONVERTER_BATCH_MAX_FILES
+    max_bytes = max_bytes or Config.CONVERTER_BATCH_MAX_BYTES
+    batches = []
+    current, current_bytes, current_stems = [], 0, set()
+    for path in raw_file_paths:
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        stem = os.path.splitext(os.path.basename(path))[0].lower()
+        if current and (len(current) >= max_files or current_bytes + size > max_bytes or stem in current_stems):
+            batches.append(current)
+            current, current_bytes, current_stems = [], 0, set()
+        current.append(path)
+        current_bytes += size
+        current_stems.add(stem)
+    if current:
+        batches.append(current)
+    return batches
+
+@timed('convert_batch')
+def convert_many(raw_file_paths, output_directory):
+    """
+    用尽量少的转换器进程转换多个 RAW 文件
+
+    转换器一次可以接受多个输入文件，分摊启动时加载相机数据库的开销。
+    文件按数量和大小分组，每组运行一个转换器进程，再按文件名把输出对应回输入。
+
+    :param raw_file_paths: RAW文件路径列表
+    :param output_directory: DNG 文件的输出目录
+    :return: {RAW路径: 生成的DNG路径，失败为None}
+    """
+    results = {path: None for path in raw_file_paths}
+    backend = get_backend()
+    error = backend.check()
+    if error:
+        print(f"错误：{error}")
+        return results
+
+    existing = [path for path in raw_file_paths if os.path.isfile(path)]
+    for path in raw_file_paths:
+        if path not in existing:
+            print(f"错误：RAW 文件不存在：{path}")
+    os.makedirs(output_directory, exist_ok=True)
+
+    for batch in plan_batches(existing):
+        print(f"正在批量转换 {len(batch)} 个文件")
+        # 输出文件的修改时间早于本次开始时间的视为旧文件（留出一秒的时间戳精度误差）
+        started = time.time() - 1
+        try:
+            with converter_slot():
+                result = backend.run(batch, output_directory)
+            if result.returncode != 0:
+                print(f"转换器返回错误码: {result.returncode}")
+                if result.stderr:
+                    print(f"错误信息:\n{result.stderr}")
+        except OSError as e:
+            print(f"错误：转换器无法执行（后端 {backend.name}）：{e}")
+            continue
+
+        # 即使转换器整体返回错误，也逐个检查输出，成功的文件照常使用
+        for path in batch:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            dng_path = os.path.join(output_directory, f"{stem}.dng")
+            if os.path.exists(dng_path):
+                stat = os.stat(dng_path)
+                if stat.st_size > 0 and stat.st_mtime >= started:
+                    results[path] = dng_path
+                    continue
+            print(f"转换失败：未生成 DNG 文件: {path}")
+
+    converted = sum(1 for dng_path in results.values() if dng_path)
+    print(f"批量转换完成：成功 {converted} 个，共 {len(raw_file_paths)} 个")
+    return results
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="将 RAW 文件转换为 DNG 文件。")
     parser.add_argument("raw_file", help="要转换的 RAW 文件的路径。")
@@ -1,14 +1,179 @@
-import subprocess
 import os
-from PIL import Image
 import io
+import mmap
+from collections import namedtuple
+import ExifToolSession
+import TiffIFD
+from PIL import Image
+from Metrics import timed
+
+# 嵌入在DNG中的JPEG预览图：文件偏移、字节长度、宽、高（未知时为0）
+EmbeddedJPEG = namedtuple('EmbeddedJPEG', ['offset', 'length', 'width', 'height'])
+
+# 这两种光度解释表示原始数据而不是预览图
+RAW_PHOTOMETRICS = (32803, 34892)
 
-def convert_dng_to_jpg(dng_path, jpg_path=None):
+def find_embedded_jpegs(buf):
+    """
+    遍历DNG的IFD链（包括SubIFDs），找出所有完整的嵌入JPEG
+
+    :param buf: DNG文件内容（bytes 或 mmap）
+    :return: EmbeddedJPEG 列表
+    """
+    endian, first_ifd = TiffIFD.read_header(buf)
+    previews = []
+    for _, entries in TiffIFD.iter_ifds(buf, endian, first_ifd):
+        width = _first_value(buf, endian, entries.get(TiffIFD.TAG_IMAGE_WIDTH))
+        height = _first_value(buf, endian, entries.get(TiffIFD.TAG_IMAGE_LENGTH))
+
+        if TiffIFD.TAG_JPEG_INTERCHANGE_FORMAT in entries:
+            # 旧式 JPEGInterchangeFormat 缩略图
+            offset = _first_value(buf, endian, entries[TiffIFD.TAG_JPEG_INTERCHANGE_FORMAT])
+            length = _first_value(buf, endian, entries.get(TiffIFD.TAG_JPEG_INTERCHANGE_FORMAT_LENGTH))
+        else:
+            # 单条带的JPEG压缩预览IFD（DNG的预览通常是 Compression=7 的 SubIFD）
+            compression = _first_value(buf, endian, entries.get(TiffIFD.TAG_COMPRESSION))
+            photometric = _first_value(buf, endian, entries.get(TiffIFD.TAG_PHOTOMETRIC))
+            strips = entries.get(TiffIFD.TAG_STRIP_OFFSETS)
+            counts = entries.get(TiffIFD.TAG_STRIP_BYTE_COUNTS)
+            if compression not in (6, 7) or photometric in RAW_PHOTOMETRICS:
+                continue
+            if strips is None or counts is None or strips.count != 1:
+                continue
+            offset = _first_value(buf, endian, strips)
+            length = _first_value(buf, endian, counts)
+
+        if length and offset + length <= len(buf) and buf[offset:offset + 2] == b'\xff\xd8':
+            previews.append(EmbeddedJPEG(offset, length, width or 0, height or 0))
+    return previews
+
+def _first_value(buf, endian, entry):
+    """读取整数条目的第一个值，条目不存在时返回None"""
+    if entry is None:
+        return None
+    try:
+        return TiffIFD.read_values(buf, endian, entry)[0]
+    except (TiffIFD.TiffError, IndexError):
+        return None
+
+def select_preview(previews, max_size=None):
+    """
+    选择最合适的预览图
+
+    :param previews: EmbeddedJPEG 列表
+    :param max_size: 需要的最长边（可选）。指定时选择不小于该尺寸的最小预览图，否则选最大的
+    :return: EmbeddedJPEG 或 None
+    """
+    if not previews:
+        return None
+    by_size = sorted(previews, key=lambda p: (max(p.width, p.height), p.length))
+    if max_size:
+        for preview in by_size:
+            if max(preview.width, preview.height) >= max_size:
+                return preview
+    return by_size[-1]
+
+def resize_jpeg(data, max_size=None):
+    """
+    按需缩小JPEG。不需要缩放时原样返回输入数据，需要缩放时才解码并重新编码
+
+    :param data: JPEG 字节（bytes 或 memoryview）
+    :param max_size: 输出图片的最长边（可选）
+    :return: JPEG 字节（bytes 或 memoryview）
+    """
+    if not max_size:
+        return data
+    image = Image.open(io.BytesIO(data))
+    if max(image.size) <= max_size:
+        return data
+    # draft 让解码器直接按缩小的比例解码，避免先解码全尺寸
+    image.draft('RGB', (max_size, max_size))
+    image.thumbnail((max_size, max_size))
+    output = io.BytesIO()
+    image.convert('RGB').save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+def write_jpeg(data, jpg_path, max_size=None):
+    """
+    保存JPEG数据。不需要缩放时直接写入原始字节
+
+    :param data: JPEG 字节（bytes 或 memoryview）
+    :param jpg_path: 输出路径
+    :param max_size: 输出图片的最长边（可选）
+    """
+    with open(jpg_path, 'wb') as f:
+        f.write(resize_jpeg(data, max_size))
+
+def read_embedded_jpeg(dng_path, max_size=None):
+    """
+    直接从DNG中读取嵌入的JPEG预览图，不经过exiftool
+
+    :param dng_path: DNG文件路径
+    :param max_size: 输出图片的最长边（可选）
+    :return: JPEG 字节，文件中没有可用的嵌入JPEG时返回None
+    """
+    with open(dng_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            preview = select_preview(find_embedded_jpegs(buf), max_size)
+            if preview is None:
+                return None
+            with memoryview(buf) as view, view[preview.offset:preview.offset + preview.length] as data:
+                return bytes(resize_jpeg(data, max_size))
+
+def extract_embedded_jpeg(dng_path, jpg_path, max_size=None):
+    """
+    直接从DNG中取出嵌入的JPEG预览图并保存，不经过exiftool
+
+    :param dng_path: DNG文件路径
+    :param jpg_path: JPG输出路径
+    :param max_size: 输出图片的最长边（可选）
+    :return: 成功返回True，文件中没有可用的嵌入JPEG时返回False
+    """
+    with open(dng_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            preview = select_preview(find_embedded_jpegs(buf), max_size)
+            if preview is None:
+                return False
+            # 从mmap切片直接写出，不复制整个文件
+            with memoryview(buf) as view, view[preview.offset:preview.offset + preview.length] as data:
+                write_jpeg(data, jpg_path, max_size)
+    return True
+
+@timed('preview', check_result=True)
+def read_preview(dng_path, max_size=None):
+    """
+    读取DNG的预览图字节，嵌入JPEG不可直接读取时使用exiftool
+
+    :param dng_path: DNG文件路径
+    :param max_size: 输出图片的最长边（可选）
+    :return: JPEG 字节，失败返回None
+    """
+    try:
+        data = read_embedded_jpeg(dng_path, max_size)
+        if data is not None:
+            return data
+    except (TiffIFD.TiffError, OSError, ValueError) as e:
+        print(f"无法直接读取嵌入预览图（{e}），改用exiftool")
+
+    try:
+        result = ExifToolSession.execute('-b', '-PreviewImage', dng_path)
+        if result.stdout:
+            return bytes(resize_jpeg(result.stdout, max_size))
+        print(f"警告：无法从DNG文件中提取预览图：{dng_path}")
+    except ExifToolSession.ExifToolError as e:
+        print(f"提取预览图失败。{e}")
+    except Exception as e:
+        print(f"发生未知错误: {e}")
+    return None
+
+@timed('preview', check_result=True)
+def convert_dng_to_jpg(dng_path, jpg_path=None, max_size=None):
     """
     将DNG文件转换为JPG格式
 
     :param dng_path: DNG文件路径
     :param jpg_path: JPG输出路径（可选，默认与DNG同目录）
+    :param max_size: 输出图片的最长边（可选，不指定时保持预览图原尺寸且不重新编码）
     :return: 成功返回JPG路径，失败返回None
     """
     if not os.path.exists(dng_path):
@@ -18,32 +183,30 @@ def convert_dng_to_jpg(dng_path, jpg_path=None):
     if jpg_path is None:
         jpg_path = os.path.splitext(dng_path)[0] + '.jpg'
 
+    # 优先直接读取嵌入的JPEG
+    try:
+        if extract_embedded_jpeg(dng_path, jpg_path, max_size):
+            print(f"成功将DNG转换为JPG：{jpg_path}")
+            return jpg_path
+    except (TiffIFD.TiffError, OSError, ValueError) as e:
+        print(f"无法直接读取嵌入预览图（{e}），改用exiftool")
+
     try:
-        # 使用exiftool提取DNG的预览图
-        command = [
-            'exiftool',
-            '-b',  # 二进制输出
-            '-PreviewImage',  # 提取预览图
-            dng_path
-        ]
-        
-        process = subprocess.run(command, capture_output=True, check=True)
-        
-        if process.stdout:
-            # 将二进制数据转换为图片
-            image = Image.open(io.BytesIO(process.stdout))
-            # 保存为JPG
-            image.save(jpg_path, 'JPEG', quality=95)
+        # 使用常驻exiftool进程提取DNG的预览图（二进制输出）
+        result = ExifToolSession.execute('-b', '-PreviewImage', dng_path)
+
+        if result.stdout:
+            write_jpeg(result.stdout, jpg_path, max_size)
             print(f"成功将DNG转换为JPG：{jpg_path}")
             return jpg_path
         else:
             print(f"警告：无法从DNG文件中提取预览图：{dng_path}")
+            if result.stderr:
+                print(f"错误信息:\n{result.stderr}")
             return None
 
-    except subprocess.CalledProcessError as e:
-        print(f"转换失败。错误码: {e.returncode}")
-        if e.stderr:
-            print(f"错误信息:\n{e.stderr}")
+    except ExifToolSession.ExifToolError as e:
+        print(f"转换失败。{e}")
         return None
     except Exception as e:
         print(f"发生未知错误: {e}")
@@ -54,6 +217,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="将DNG文件转换为JPG格式。")
     parser.add_argument("dng_file", help="要转换的DNG文件的路径。")
     parser.add_argument("-o", "--output", help="JPG文件的输出路径。如果未指定，则输出到DNG文件所在的目录。", default=None)
+    parser.add_argument("--max-size", type=int, default=None, help="输出图片的最长边（像素）。如果未指定，则直接输出嵌入的预览图。")
 
     args = parser.parse_args()
-    convert_dng_to_jpg(args.dng_file, args.output) 
\ No newline at end of file
+    convert_dng_to_jpg(args.dng_file, args.output, args.max_size)
@@ -0,0 +1,143 @@
+import time
+import asyncio
+import threading
+
+# 进度事件类型
+EVENT_RECEIVED = 'received'
+EVENT_HASHED = 'hashed'
+EVENT_CONVERTING = 'converting'
+EVENT_TAGGING = 'tagging'
+EVENT_DONE = 'done'
+EVENT_PREVIEW_READY = 'preview_ready'
+EVENT_FAILED = 'failed'
+
+
+class EventBus:
+    """
+    按用户分发的进度事件
+
+    事件写入共享索引（FileIndex 的 events 表），由任意服务进程的 SSE 连接读取；
+    同一进程内发布事件时立即唤醒等待中的连接，其他进程发布的事件通过定期查询获得。
+    客户端断线重连时用 Last-Event-ID 补发错过的事件。
+    """
+
+    def __init__(self, index, poll_interval=1.0, keepalive_interval=15.0):
+        """
+        :param index: 保存事件的 FileIndex
+        :param poll_interval: 没有本进程通知时查询新事件的间隔（秒）
+        :param keepalive_interval: 没有事件时发送注释行保持连接的间隔（秒）
+        """
+        self.index = index
+        self.poll_interval = poll_interval
+        self.keepalive_interval = keepalive_interval
+        self.condition = threading.Condition()
+        # stream_async 的等待者：{(事件循环, asyncio.Event)}
+        self.async_waiters = set()
+        self.async_poller = None
+
+    def publish(self, user_id, event, **data):
+        """
+        发布一个事件
+
+        :param user_id: 接收事件的用户
+        :param event: 事件类型
+        :param data: 事件数据（可JSON序列化）
+        """
+        data.setdefault('time', time.time())
+        try:
+            self.index.add_event(user_id, event, data)
+        except Exception as e:
+            # 进度事件只用于界面显示，写入失败不影响处理流程
+            print(f"记录进度事件失败: {e}")
+            return
+        with self.condition:
+            self.condition.notify_all()
+            waiters = list(self.async_waiters)
+        self._wake(waiters)
+
+    @staticmethod
+    def _wake(waiters):
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+
+    def stream(self, user_id, last_event_id=None):
+        """
+        生成 text/event-stream 格式的数据
+
+        :param user_id: 用户标识
+        :param last_event_id: 客户端已收到的最后一个事件ID，None 表示只接收之后的新事件
+        """
+        if last_event_id is None:
+            last_event_id = self.index.last_event_id()
+        yield 'retry: 3000\n\n'
+        last_sent = time.monotonic()
+        while True:
+            events = self.index.events_after(user_id, last_event_id)
+            for event_id, event, data in events:
+                yield f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
+                last_event_id = event_id
+                last_sent = time.monotonic()
+            if events:
+                continue
+            if time.monotonic() - last_sent >= self.keepalive_interval:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+            with self.condition:
+                self.condition.wait(self.poll_interval)
+
+    async def _poll_async(self):
+        """
+        发现其他进程发布的事件：每个事件循环只有一个轮询任务，没有等待者时退出
+
+        只查询最新的事件ID，有变化时唤醒所有等待者，由各连接自己读取属于自己的事件。
+        """
+        last_event_id = self.index.last_event_id()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            with self.condition:
+                waiters = list(self.async_waiters)
+                if not waiters:
+                    self.async_poller = None
+                    return
+            event_id = self.index.last_event_id()
+            if event_id != last_event_id:
+                last_event_id = event_id
+                self._wake(waiters)
+
+    async def stream_async(self, user_id, last_event_id=None):
+        """
+        stream 的 asyncio 版本（ASGI 服务使用）：等待新事件时不占用线程
+
+        :param user_id: 用户标识
+        :param last_event_id: 客户端已收到的最后一个事件ID，None 表示只接收之后的新事件
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        waiter = (loop, wakeup)
+        with self.condition:
+            self.async_waiters.add(waiter)
+            if self.async_poller is None:
+                self.async_poller = loop.create_task(self._poll_async())
+        try:
+            if last_event_id is None:
+                last_event_id = self.index.last_event_id()
+            yield 'retry: 3000\n\n'
+            while True:
+                wakeup.clear()
+                events = self.index.events_after(user_id, last_event_id)
+                for event_id, event, data in events:
+                    yield f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
+                    last_event_id = event_id
+                if events:
+                    continue
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.keepalive_interval)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
@@ -0,0 +1,185 @@
+import subprocess
+import threading
+import queue
+import select
+import os
+import atexit
+from collections import namedtuple
+
+import Config
+from ProcessSlots import exiftool_slot
+
+# exiftool 单次命令的执行结果，stdout 为原始字节（便于 -b 二进制输出），stderr 为文本
+ExifToolResult = namedtuple('ExifToolResult', ['stdout', 'stderr'])
+
+
+class ExifToolError(Exception):
+    """exiftool 进程异常退出或响应超时"""
+
+
+class ExifToolProcess:
+    """
+    常驻的 exiftool 进程（-stay_open True -@ -）
+
+    每条命令通过 stdin 逐行写入参数并以 -execute{N} 结束，
+    stdout 以 {readyN} 结束，stderr 通过 -echo4 输出同样的结束标记。
+    单个实例不是线程安全的，由 ExifToolPool 保证同一时间只有一个调用方。
+    """
+
+    def __init__(self, executable='exiftool', timeout=60):
+        self.executable = executable
+        self.timeout = timeout
+        self.process = None
+        self.counter = 0
+
+    def start(self):
+        """启动 exiftool 进程（找不到 exiftool 时抛出 FileNotFoundError）"""
+        self.process = subprocess.Popen(
+            [self.executable, '-stay_open', 'True', '-@', '-', '-common_args', '-charset', 'filename=utf8'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        self.counter = 0
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        """通知 exiftool 退出，超时则强制结束"""
+        if self.process is None:
+            return
+        try:
+            if self.process.poll() is None:
+                self.process.stdin.write(b'-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        finally:
+            for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+                if stream:
+                    stream.close()
+            self.process = None
+
+    def execute(self, *args):
+        """
+        执行一条 exiftool 命令
+
+        :param args: exiftool 参数（不含程序名）
+        :return: ExifToolResult
+        """
+        if not self.is_alive():
+            self.start()
+
+        self.counter += 1
+        sentinel = f'{{ready{self.counter}}}'
+        lines = [str(arg) for arg in args] + ['-echo4', sentinel, f'-execute{self.counter}']
+        payload = ''.join(f'{line}\n' for line in lines).encode('utf-8')
+
+        try:
+            self.process.stdin.write(payload)
+            self.process.stdin.flush()
+            stdout = self._read_until(self.process.stdout, sentinel.encode('ascii'))
+            stderr = self._read_until(self.process.stderr, sentinel.encode('ascii'))
+        except (OSError, ExifToolError):
+            # 进程已崩溃或无响应，丢弃后由调用方决定是否重试
+            self.close()
+            raise ExifToolError('exiftool 进程异常退出或无响应')
+
+        return ExifToolResult(stdout, stderr.decode('utf-8', errors='replace'))
+
+    def _read_until(self, stream, sentinel):
+        """从管道中读取数据，直到以结束标记结尾，返回去掉标记后的内容"""
+        fd = stream.fileno()
+        buffer = bytearray()
+        while True:
+            ready, _, _ = select.select([fd], [], [], self.timeout)
+            if not ready:
+                raise ExifToolError('exiftool 响应超时')
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise ExifToolError('exiftool 进程已退出')
+            buffer.extend(chunk)
+            stripped = buffer.rstrip(b'\r\n')
+            if stripped.endswith(sentinel):
+                return bytes(stripped[:-len(sentinel)])
+
+
+class ExifToolPool:
+    """
+    线程安全的 exiftool 常驻进程池
+
+    进程按需启动，最多 size 个；某个进程崩溃时自动重启并重试一次。
+    """
+
+    def __init__(self, size, executable='exiftool', timeout=60):
+        self.size = max(1, size)
+        self.executable = executable
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.closed = False
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle.empty() and self.created < self.size:
+                self.created += 1
+                return ExifToolProcess(self.executable, self.timeout)
+        return self.idle.get()
+
+    def _release(self, worker):
+        if self.closed:
+            worker.close()
+        else:
+            self.idle.put(worker)
+
+    def execute(self, *args):
+        """
+        在空闲进程上执行一条 exiftool 命令
+
+        :param args: exiftool 参数（不含程序名）
+        :return: ExifToolResult
+        """
+        worker = self._acquire()
+        try:
+            # 同一台机器上的所有进程合计限制同时执行的命令数
+            with exiftool_slot():
+                try:
+                    return worker.execute(*args)
+                except ExifToolError:
+                    print("警告：exiftool 进程异常，正在重启并重试")
+                    return worker.execute(*args)
+        finally:
+            self._release(worker)
+
+    def close(self):
+        """关闭池中所有空闲进程"""
+        self.closed = True
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """返回当前进程共享的 exiftool 进程池（首次调用时创建）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExifToolPool(Config.EXIFTOOL_WORKERS, Config.EXIFTOOL_PATH, Config.EXIFTOOL_TIMEOUT)
+            atexit.register(_pool.close)
+        return _pool
+
+
+def execute(*args):
+    """使用共享进程池执行一条 exiftool 命令"""
+    return get_pool().execute(*args)
@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    unique_filename TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    original_filename TEXT NOT NULL,
+    file_hash TEXT,
+    created_at REAL NOT NULL,
+    downloaded_at REAL,
+    accessed_at REAL,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS files_by_user ON files (user_id, created_at);
+CREATE INDEX IF NOT EXISTS files_by_hash ON files (user_id, file_hash);
+CREATE INDEX IF NOT EXISTS files_by_download ON files (downloaded_at);
+CREATE INDEX IF NOT EXISTS files_by_fingerprint ON files (user_id, fingerprint);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    owner INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    timings TEXT,
+    fields TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_user ON jobs (user_id, created_at);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, updated_at);
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_by_update ON uploads (updated_at);
+CREATE TABLE IF NOT EXISTS events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_by_user ON events (user_id, event_id);
+CREATE INDEX IF NOT EXISTS events_by_time ON events (created_at);
+"""
+
+# 旧版本数据库中缺少的列：(表, 列, 定义)
+MIGRATIONS = (
+    ('files', 'downloaded_at', 'REAL'),
+    ('jobs', 'timings', 'TEXT'),
+    ('files', 'accessed_at', 'REAL'),
+    ('files', 'fingerprint', 'TEXT'),
+)
+
+# jobs 表中单独成列的字段，timings 以JSON保存在同名列，其余字段以JSON保存在 fields 列
+JOB_COLUMNS = ('job_id', 'user_id', 'state', 'error', 'owner', 'created_at', 'updated_at')
+
+
+class FileIndex:
+    """
+    用户、输出文件、内容哈希、转换任务、未完成的分块上传和进度事件的持久化索引
+
+    使用 WAL 模式的 SQLite，多个服务进程可以共享同一个索引，重启后状态不丢失。
+    每个线程使用自己的连接。
+    """
+
+    def __init__(self, path):
+        """
+        :param path: 数据库文件路径
+        """
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            for table, column, definition in MIGRATIONS:
+                columns = [row['name'] for row in conn.execute(f'PRAGMA table_info({table})')]
+                if columns and column not in columns:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        """返回当前线程的数据库连接"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    # ---- 用户 ----
+
+    def touch_user(self, user_id):
+        """登记用户并更新最后活动时间"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT INTO users (user_id, created_at, last_seen) VALUES (?, ?, ?) '
+                         'ON CONFLICT (user_id) DO UPDATE SET last_seen = excluded.last_seen',
+                         (user_id, now, now))
+
+    def user_exists(self, user_id):
+        row = self._connect().execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return row is not None
+
+    # ---- 输出文件 ----
+
+    def add_file(self, user_id, original_filename, unique_filename, file_hash, fingerprint=None):
+        """
+        登记一个可供下载的转换结果
+
+        :param user_id: 用户标识
+        :param original_filename: 下载时使用的原始文件名
+        :param unique_filename: 输出目录中的唯一文件名
+        :param file_hash: RAW 文件的内容哈希
+        :param fingerprint: RAW 文件的抽样指纹（上传前预检查用）
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT INTO users (user_id, created_at, last_seen) VALUES (?, ?, ?) '
+                         'ON CONFLICT (user_id) DO UPDATE SET last_seen = excluded.last_seen',
+                         (user_id, now, now))
+            conn.execute('INSERT OR REPLACE INTO files '
+                         '(unique_filename, user_id, original_filename, file_hash, created_at, fingerprint) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (unique_filename, user_id, original_filename, file_hash, now, fingerprint))
+
+    def get_file(self, user_id, unique_filename):
+        """返回用户的一个输出文件记录（按主键查找原始文件名和哈希），不存在时返回None"""
+        row = self._connect().execute('SELECT * FROM files WHERE unique_filename = ? AND user_id = ?',
+                                      (unique_filename, user_id)).fetchone()
+        return dict(row) if row else None
+
+    def find_by_hash(self, user_id, file_hash):
+        """返回用户已有的同内容转换结果的唯一文件名，不存在时返回None"""
+        row = self._connect().execute('SELECT unique_filename FROM files WHERE user_id = ? AND file_hash = ? '
+                                      'ORDER BY created_at DESC LIMIT 1', (user_id, file_hash)).fetchone()
+        return row['unique_filename'] if row else None
+
+    def find_by_fingerprint(self, user_id, fingerprint):
+        """返回用户已有的同抽样指纹的转换结果的唯一文件名，不存在时返回None"""
+        row = self._connect().execute('SELECT unique_filename FROM files WHERE user_id = ? AND fingerprint = ? '
+                                      'ORDER BY created_at DESC LIMIT 1', (user_id, fingerprint)).fetchone()
+        return row['unique_filename'] if row else None
+
+    def user_files(self, user_id):
+        """返回用户的全部输出文件记录（按登记顺序）"""
+        rows = self._connect().execute('SELECT * FROM files WHERE user_id = ? ORDER BY created_at',
+                                       (user_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def set_file_hash(self, unique_filename, file_hash):
+        with self._connect() as conn:
+            conn.execute('UPDATE files SET file_hash = ? WHERE unique_filename = ?', (file_hash, unique_filename))
+
+    def mark_downloaded(self, unique_filename, downloaded_at):
+        """记录文件最近一次被下载的时间"""
+        with self._connect() as conn:
+            conn.execute('UPDATE files SET downloaded_at = ?, accessed_at = ? WHERE unique_filename = ?',
+                         (downloaded_at, downloaded_at, unique_filename))
+
+    def touch_file(self, unique_filename, accessed_at):
+        """记录文件最近一次被访问（如预览）的时间，一分钟内的重复访问不再写入"""
+        with self._connect() as conn:
+            conn.execute('UPDATE files SET accessed_at = ? WHERE unique_filename = ? '
+                         'AND (accessed_at IS NULL OR accessed_at < ?)',
+                         (accessed_at, unique_filename, accessed_at - 60))
+
+    def files_by_access(self):
+        """返回全部输出文件的 (唯一文件名, 最近访问时间)，最久未访问的在前"""
+        rows = self._connect().execute(
+            'SELECT unique_filename, MAX(created_at, COALESCE(accessed_at, 0), COALESCE(downloaded_at, 0)) '
+            'AS last_access FROM files ORDER BY last_access').fetchall()
+        return [(row['unique_filename'], row['last_access']) for row in rows]
+
+    def downloaded_before(self, before):
+        """返回最近一次下载早于 before 的文件名列表"""
+        rows = self._connect().execute('SELECT unique_filename FROM files WHERE downloaded_at < ?',
+                                       (before,)).fetchall()
+        return [row['unique_filename'] for row in rows]
+
+    def remove_file(self, unique_filename):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM files WHERE unique_filename = ?', (unique_filename,))
+
+    def prune_missing(self, output_folder):
+        """
+        删除输出目录中已经不存在的文件记录
+
+        :return: 删除的记录数
+        """
+        rows = self._connect().execute('SELECT unique_filename FROM files').fetchall()
+        missing = [(row['unique_filename'],) for row in rows
+                   if not os.path.exists(os.path.join(output_folder, row['unique_filename']))]
+        if missing:
+            with self._connect() as conn:
+                conn.executemany('DELETE FROM files WHERE unique_filename = ?', missing)
+        return len(missing)
+
+    # ---- 分块上传 ----
+
+    def add_upload(self, upload_id, user_id, filename, size):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT INTO uploads (upload_id, user_id, filename, size, created_at, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (upload_id, user_id, filename, size, now, now))
+
+    def get_upload(self, user_id, upload_id):
+        """返回用户的一个未完成上传，不存在时返回None"""
+        row = self._connect().execute('SELECT * FROM uploads WHERE upload_id = ? AND user_id = ?',
+                                      (upload_id, user_id)).fetchone()
+        return dict(row) if row else None
+
+    def touch_upload(self, upload_id):
+        with self._connect() as conn:
+            conn.execute('UPDATE uploads SET updated_at = ? WHERE upload_id = ?', (time.time(), upload_id))
+
+    def remove_upload(self, upload_id):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM uploads WHERE upload_id = ?', (upload_id,))
+
+    def uploads_before(self, before):
+        """返回最后一次写入早于 before 的上传ID列表"""
+        rows = self._connect().execute('SELECT upload_id FROM uploads WHERE updated_at < ?', (before,)).fetchall()
+        return [row['upload_id'] for row in rows]
+
+    # ---- 进度事件 ----
+
+    def add_event(self, user_id, event, data):
+        """
+        记录一个进度事件
+
+        :return: 事件ID（按时间递增）
+        """
+        with self._connect() as conn:
+            cursor = conn.execute('INSERT INTO events (user_id, event, data, created_at) VALUES (?, ?, ?, ?)',
+                                  (user_id, event, json.dumps(data, ensure_ascii=False), time.time()))
+            return cursor.lastrowid
+
+    def events_after(self, user_id, event_id, limit=100):
+        """返回用户在 event_id 之后的事件：(事件ID, 事件类型, JSON数据) 列表"""
+        rows = self._connect().execute('SELECT event_id, event, data FROM events WHERE user_id = ? AND event_id > ? '
+                                       'ORDER BY event_id LIMIT ?', (user_id, event_id, limit)).fetchall()
+        return [(row['event_id'], row['event'], row['data']) for row in rows]
+
+    def last_event_id(self):
+        row = self._connect().execute('SELECT MAX(event_id) AS event_id FROM events').fetchone()
+        return row['event_id'] or 0
+
+    def prune_events(self, before):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM events WHERE created_at < ?', (before,))
+
+    # ---- 转换任务（JobQueue 的存储接口） ----
+
+    def _row_to_job(self, row):
+        job = json.loads(row['fields'])
+        job.update({column: row[column] for column in JOB_COLUMNS})
+        job['timings'] = json.loads(row['timings'] or '{}')
+        return job
+
+    def add_job(self, job):
+        fields = {key: value for key, value in job.items() if key not in JOB_COLUMNS and key != 'timings'}
+        with self._connect() as conn:
+            conn.execute('INSERT INTO jobs (job_id, user_id, state, error, owner, created_at, updated_at, '
+                         'timings, fields) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         tuple(job.get(column) for column in JOB_COLUMNS) +
+                         (json.dumps(job.get('timings') or {}), json.dumps(fields)))
+
+    def get_job(self, job_id):
+        row = self._connect().execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def user_jobs(self, user_id):
+        rows = self._connect().execute('SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at',
+                                       (user_id,)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def update_job(self, job_id, state, error, updated_at, timings):
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET state = ?, error = ?, updated_at = ?, timings = ? WHERE job_id = ?',
+                         (state, error, updated_at, json.dumps(timings), job_id))
+
+    def prune_jobs(self, states, before):
+        """删除指定状态中最后更新时间早于 before 的任务"""
+        placeholders = ', '.join('?' * len(states))
+        with self._connect() as conn:
+            conn.execute(f'DELETE FROM jobs WHERE state IN ({placeholders}) AND updated_at < ?',
+                         tuple(states) + (before,))
+
+    def unfinished_jobs(self, finished_states):
+        placeholders = ', '.join('?' * len(finished_states))
+        rows = self._connect().execute(f'SELECT * FROM jobs WHERE state NOT IN ({placeholders}) '
+                                       'ORDER BY created_at', tuple(finished_states)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def claim_job(self, job_id, old_owner, new_owner, state, updated_at):
+        """
+        把任务转交给新的进程（仅当任务仍属于 old_owner 时成功）
+
+        :return: 是否接管成功
+        """
+        with self._connect() as conn:
+            cursor = conn.execute('UPDATE jobs SET owner = ?, state = ?, error = NULL, updated_at = ? '
+                                  'WHERE job_id = ? AND owner IS ?',
+                                  (new_owner, state, updated_at, job_id, old_owner))
+            return cursor.rowcount == 1
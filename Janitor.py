@@ -0,0 +1,189 @@
+import os
+import time
+import threading
+
+import Config
+from JobQueue import FINISHED_STATES
+
+
+def _scan(directory):
+    """
+    返回目录中的普通文件 {文件名: (字节数, 最近变化时间)}
+
+    变化时间取修改时间和 ctime 中较晚的一个：从转换缓存硬链接过来的文件保留缓存文件的修改时间，
+    但创建链接会更新 ctime。
+    """
+    files = {}
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return files
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                files[entry.name] = (stat.st_size, max(stat.st_mtime, stat.st_ctime))
+        except FileNotFoundError:
+            continue
+    return files
+
+
+class Janitor:
+    """
+    后台清理线程
+
+    启动时不清空任何目录：索引和磁盘上的文件照常使用，第一次清理时在后台核对两者。
+    之后每隔一段时间：
+    - 删除文件已经不在的索引记录；
+    - 删除已下载但客户端一直没有确认的文件、长时间没有继续的分块上传和过期的进度事件；
+    - 删除超过 OUTPUT_TTL_SECONDS 未访问的输出文件，输出目录超出 OUTPUT_DISK_BUDGET 时按最近访问时间淘汰；
+    - 删除上传目录、暂存区和输出目录中不属于任何文件记录、任务或上传，且超过 ORPHAN_GRACE_SECONDS 未修改的文件。
+    """
+
+    def __init__(self, index, chunk_store, output_folder, upload_folder, remove_output, scratch_folders=()):
+        """
+        :param index: FileIndex
+        :param chunk_store: 分块上传存储（ChunkStore）
+        :param output_folder: 输出目录
+        :param upload_folder: 上传目录
+        :param remove_output: 删除一个输出文件及其索引记录的函数，参数为唯一文件名
+        :param scratch_folders: 暂存区中存放上传和转换中间文件的目录，按上传目录的规则清理
+        """
+        self.index = index
+        self.chunk_store = chunk_store
+        self.output_folder = output_folder
+        self.upload_folder = upload_folder
+        self.remove_output = remove_output
+        self.scratch_folders = list(scratch_folders)
+        self.interval = max(1, min(Config.JANITOR_INTERVAL_SECONDS, Config.DOWNLOAD_RETENTION_SECONDS,
+                                   Config.UPLOAD_PARTIAL_TTL_SECONDS))
+        self.lock = threading.Lock()
+        self.removed = {'downloaded': 0, 'expired': 0, 'evicted': 0, 'orphaned': 0, 'stale_uploads': 0}
+        self.usage = {}
+        self.last_run = None
+        self.last_duration = None
+        self.thread = None
+
+    def start(self):
+        """启动清理线程（重复调用无副作用）"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='janitor', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"清理过期文件时出错: {e}")
+            time.sleep(self.interval)
+
+    def _count(self, reason, count=1):
+        with self.lock:
+            self.removed[reason] += count
+
+    def run_once(self, now=None):
+        """执行一次清理"""
+        now = time.time() if now is None else now
+        started = time.perf_counter()
+
+        removed = self.index.prune_missing(self.output_folder)
+        if removed:
+            print(f"已从索引中移除 {removed} 个不存在的文件")
+
+        for filename in self.index.downloaded_before(now - Config.DOWNLOAD_RETENTION_SECONDS):
+            print(f"删除已下载的文件: {filename}")
+            self.remove_output(filename)
+            self._count('downloaded')
+        for upload_id in self.index.uploads_before(now - Config.UPLOAD_PARTIAL_TTL_SECONDS):
+            print(f"删除未完成的上传: {upload_id}")
+            self.chunk_store.discard(upload_id)
+            self.index.remove_upload(upload_id)
+            self._count('stale_uploads')
+        self.index.prune_events(now - Config.EVENT_RETENTION_SECONDS)
+
+        output_bytes, output_count = self._sweep_output(now)
+        in_use = self._uploads_in_use()
+        upload_bytes, upload_count = self._sweep_uploads(now, self.upload_folder, in_use)
+        scratch_bytes, scratch_count = 0, 0
+        for folder in self.scratch_folders:
+            folder_bytes, folder_count = self._sweep_uploads(now, folder, in_use)
+            scratch_bytes += folder_bytes
+            scratch_count += folder_count
+
+        with self.lock:
+            self.usage = {
+                'output_files': output_count,
+                'output_bytes': output_bytes,
+                'upload_files': upload_count,
+                'upload_bytes': upload_bytes,
+                'scratch_files': scratch_count,
+                'scratch_bytes': scratch_bytes
+            }
+            self.last_run = now
+            self.last_duration = round(time.perf_counter() - started, 3)
+
+    def _sweep_output(self, now):
+        """按TTL和字节预算清理输出目录，返回剩余的 (字节数, 文件数)"""
+        files = _scan(self.output_folder)
+        indexed = self.index.files_by_access()
+        indexed_names = {filename for filename, _ in indexed}
+
+        # 没有索引记录的文件：正在转换的结果很快会登记，超过宽限时间仍未登记的是遗留文件
+        for filename, (_, changed) in list(files.items()):
+            if filename not in indexed_names and now - changed > Config.ORPHAN_GRACE_SECONDS:
+                print(f"删除孤立的输出文件: {filename}")
+                self.remove_output(filename)
+                del files[filename]
+                self._count('orphaned')
+
+        total = sum(size for size, _ in files.values())
+        # 最久未访问的在前
+        for filename, last_access in indexed:
+            if filename not in files:
+                continue
+            if now - last_access > Config.OUTPUT_TTL_SECONDS:
+                print(f"删除超过保留时间的文件: {filename}")
+                reason = 'expired'
+            elif total > Config.OUTPUT_DISK_BUDGET:
+                print(f"输出目录超出预算，删除最久未访问的文件: {filename}")
+                reason = 'evicted'
+            else:
+                break
+            self.remove_output(filename)
+            total -= files.pop(filename)[0]
+            self._count(reason)
+        return total, len(files)
+
+    def _uploads_in_use(self):
+        """仍在使用的上传文件名：未结束任务的上传文件和未完成的分块上传"""
+        in_use = {os.path.basename(job['file_path']) for job in self.index.unfinished_jobs(FINISHED_STATES)
+                  if job.get('file_path')}
+        in_use.update(os.path.basename(self.chunk_store.path(upload_id))
+                      for upload_id in self.index.uploads_before(float('inf')))
+        return in_use
+
+    def _sweep_uploads(self, now, folder, in_use):
+        """删除上传目录（或暂存区目录）中的孤立文件，返回剩余的 (字节数, 文件数)"""
+        files = _scan(folder)
+        for filename, (_, changed) in list(files.items()):
+            if filename in in_use or now - changed <= Config.ORPHAN_GRACE_SECONDS:
+                continue
+            print(f"删除孤立的上传文件: {filename}")
+            try:
+                os.remove(os.path.join(folder, filename))
+            except FileNotFoundError:
+                pass
+            del files[filename]
+            self._count('orphaned')
+        return sum(size for size, _ in files.values()), len(files)
+
+    def stats(self):
+        """返回目录用量、预算和累计清理的文件数"""
+        with self.lock:
+            return dict(self.usage,
+                        output_budget=Config.OUTPUT_DISK_BUDGET,
+                        output_ttl_seconds=Config.OUTPUT_TTL_SECONDS,
+                        removed=dict(self.removed),
+                        last_run=self.last_run,
+                        last_duration=self.last_duration)
@@ -0,0 +1,304 @@
+import os
+import math
+import threading
+import queue
+import time
+import uuid
+from collections import OrderedDict, deque
+
+# 任务状态
+STATE_QUEUED = 'queued'
+STATE_CONVERTING = 'converting'
+STATE_TAGGING = 'tagging'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+FINISHED_STATES = (STATE_DONE, STATE_FAILED)
+
+
+def _process_alive(pid):
+    """判断本机上的进程是否仍在运行"""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class QueueFull(Exception):
+    """等待中的任务数已达上限"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'转换队列已满，请 {retry_after} 秒后重试')
+        self.retry_after = retry_after
+
+
+class FairQueue:
+    """
+    按用户轮转的任务队列
+
+    每个用户的任务按提交顺序排列，取出时各用户轮流，
+    一个用户一次提交大量文件不会让其他用户的文件一直排在后面。
+    接口与 queue.Queue 的 get/get_nowait/qsize 一致。
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.users = OrderedDict()
+        self.size = 0
+
+    def put(self, user_id, item):
+        with self.condition:
+            self.users.setdefault(user_id, deque()).append(item)
+            self.size += 1
+            self.condition.notify()
+
+    def _pop(self):
+        # 取出排在最前面的用户的下一个任务，该用户还有任务时排到最后
+        user_id, items = next(iter(self.users.items()))
+        item = items.popleft()
+        if items:
+            self.users.move_to_end(user_id)
+        else:
+            del self.users[user_id]
+        self.size -= 1
+        return item
+
+    def get(self):
+        with self.condition:
+            while not self.size:
+                self.condition.wait()
+            return self._pop()
+
+    def get_nowait(self):
+        with self.condition:
+            if not self.size:
+                raise queue.Empty
+            return self._pop()
+
+    def qsize(self):
+        with self.condition:
+            return self.size
+
+
+class MemoryJobStore:
+    """进程内的任务存储（单进程使用，重启后丢失）"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def add_job(self, job):
+        with self.lock:
+            self.jobs[job['job_id']] = dict(job)
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def user_jobs(self, user_id):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values() if job['user_id'] == user_id]
+
+    def update_job(self, job_id, state, error, updated_at, timings):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update({'state': state, 'error': error, 'updated_at': updated_at, 'timings': timings})
+
+    def prune_jobs(self, states, before):
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job['state'] in states and job['updated_at'] < before]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+    def unfinished_jobs(self, finished_states):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values() if job['state'] not in finished_states]
+
+    def claim_job(self, job_id, old_owner, new_owner, state, updated_at):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.get('owner') != old_owner:
+                return False
+            job.update({'owner': new_owner, 'state': state, 'error': None, 'updated_at': updated_at})
+            return True
+
+
+class JobQueue:
+    """
+    固定大小的后台转换工作池
+
+    上传请求只负责提交任务，由工作线程取出并调用 handler(jobs) 执行。
+    队列中积压较多时，一个工作线程会一次取出多个任务交给 handler 批量处理。
+    等待中的任务按用户轮流执行，数量达到 max_pending 时 submit 抛出 QueueFull。
+    handler 返回 {job_id: 是否成功}，缺少的任务或抛出异常视为失败。
+    每个任务在 timings 中累计各状态（queued/converting/tagging 等）停留的秒数。
+    任务状态保存在 store 中（默认在进程内存中），每个任务记录提交它的进程号，
+    使用共享存储时，其他进程可以查询状态，也可以接管已退出进程遗留的任务。
+    """
+
+    def __init__(self, handler, workers, retention_seconds=3600, batch_size=1, store=None, listener=None,
+                 max_pending=None):
+        """
+        :param handler: 处理任务的函数，参数为任务字典列表
+        :param workers: 工作线程数
+        :param retention_seconds: 已结束任务的状态保留时间
+        :param batch_size: 每次最多取出的任务数
+        :param store: 任务存储（如 FileIndex），默认为 MemoryJobStore
+        :param listener: 任务状态变化时调用 listener(变化前的任务, 新状态, 错误信息, 变化时间)
+        :param max_pending: 等待中的任务数上限，None 表示不限制
+        """
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.retention_seconds = retention_seconds
+        self.batch_size = max(1, batch_size)
+        self.store = store if store is not None else MemoryJobStore()
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.max_pending = max_pending
+        self.pending = FairQueue()
+        self.threads = []
+        # 最近每个任务的平均处理时间（指数滑动平均），用于估计队列多久能空出位置
+        self.average_seconds = None
+
+    def start(self):
+        """启动工作线程（重复调用无副作用）"""
+        with self.lock:
+            if self.threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"convert-worker-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def is_full(self):
+        """等待中的任务数是否已达上限"""
+        return self.max_pending is not None and self.pending.qsize() >= self.max_pending
+
+    def retry_after(self):
+        """估计队列空出位置所需的秒数（用于 Retry-After）"""
+        backlog = self.pending.qsize() - (self.max_pending or 0) + 1
+        average = self.average_seconds or 1.0
+        return max(1, math.ceil(max(1, backlog) * average / self.workers))
+
+    def submit(self, user_id, enqueue=True, **fields):
+        """
+        提交一个新任务
+
+        :param user_id: 用户标识
+        :param enqueue: 为 False 时只登记任务而不排队执行，由调用方通过 set_state 结束它
+                        （例如等待另一个任务的结果），不受 max_pending 限制
+        :param fields: 任务附带的其他字段（文件名、路径等），timings 为提交前各阶段的耗时
+        :return: 任务字典的副本
+        :raises QueueFull: 等待中的任务数已达上限
+        """
+        if enqueue and self.is_full():
+            raise QueueFull(self.retry_after())
+        now = time.time()
+        job = dict(fields)
+        job['timings'] = dict(fields.get('timings') or {})
+        job.update({
+            'job_id': uuid.uuid4().hex,
+            'user_id': user_id,
+            'state': STATE_QUEUED,
+            'error': None,
+            'owner': os.getpid(),
+            'created_at': now,
+            'updated_at': now
+        })
+        self.store.prune_jobs(FINISHED_STATES, now - self.retention_seconds)
+        self.store.add_job(job)
+        if enqueue:
+            self.start()
+            self.pending.put(user_id, job['job_id'])
+        return dict(job)
+
+    def get(self, job_id):
+        """返回任务字典的副本，不存在时返回None"""
+        return self.store.get_job(job_id)
+
+    def user_jobs(self, user_id):
+        """返回指定用户的全部任务（按提交顺序）"""
+        return self.store.user_jobs(user_id)
+
+    def set_state(self, job_id, state, error=None):
+        """更新任务状态"""
+        now = time.time()
+        previous = self.store.get_job(job_id)
+        if previous is None:
+            return
+        # 累计上一个状态停留的时间
+        timings = dict(previous.get('timings') or {})
+        timings[previous['state']] = round(timings.get(previous['state'], 0) + now - previous['updated_at'], 3)
+        self.store.update_job(job_id, state, error, now, timings)
+        if self.listener is not None:
+            try:
+                self.listener(previous, state, error, now)
+            except Exception as e:
+                print(f"任务状态回调出错: {e}")
+
+    def recover(self, is_valid=None):
+        """
+        接管已退出的进程遗留的未完成任务并重新排队（服务启动时调用）
+
+        :param is_valid: 检查任务能否继续执行的函数（例如上传文件是否仍在），不能继续的任务标记为失败
+        :return: 重新排队的任务数
+        """
+        owner = os.getpid()
+        recovered = 0
+        for job in self.store.unfinished_jobs(FINISHED_STATES):
+            if job['owner'] == owner or _process_alive(job['owner']):
+                continue
+            # 多个进程同时启动时只有一个能接管成功
+            if not self.store.claim_job(job['job_id'], job['owner'], owner, STATE_QUEUED, time.time()):
+                continue
+            if is_valid is not None and not is_valid(job):
+                self.set_state(job['job_id'], STATE_FAILED, '服务重启后无法继续处理')
+                continue
+            self.pending.put(job['user_id'], job['job_id'])
+            recovered += 1
+        if recovered:
+            self.start()
+        return recovered
+
+    def _take_batch(self):
+        """取出一批任务ID：至少一个，积压时按工作线程数平分，最多 batch_size 个"""
+        job_ids = [self.pending.get()]
+        extra = min(self.batch_size - 1, self.pending.qsize() // self.workers)
+        for _ in range(extra):
+            try:
+                job_ids.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return job_ids
+
+    def _worker(self):
+        while True:
+            jobs = [job for job in map(self.get, self._take_batch()) if job is not None]
+            if not jobs:
+                continue
+            started = time.time()
+            try:
+                results = self.handler(jobs)
+            except Exception as e:
+                print(f"处理任务时出错: {e}")
+                for job in jobs:
+                    self.set_state(job['job_id'], STATE_FAILED, str(e))
+                continue
+            per_job = (time.time() - started) / len(jobs)
+            self.average_seconds = per_job if self.average_seconds is None else \
+                0.8 * self.average_seconds + 0.2 * per_job
+            for job in jobs:
+                if results.get(job['job_id']):
+                    self.set_state(job['job_id'], STATE_DONE)
+                else:
+                    self.set_state(job['job_id'], STATE_FAILED, '文件转换失败')
@@ -0,0 +1,166 @@
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+# 各处理阶段耗时的直方图桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = 'webraw_stage_seconds'
+STAGE_FAILURES = 'webraw_stage_failures_total'
+
+
+class Histogram:
+    """累计分布直方图（Prometheus 语义：每个桶统计小于等于上界的观测数）"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class MetricsRegistry:
+    """
+    进程内的计数器、直方图和仪表，按 Prometheus 文本格式导出
+
+    指标以 (名称, 标签) 为键；仪表在导出时调用回调函数取值。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def describe(self, name, kind, help_text):
+        """登记指标的类型（counter/histogram/gauge）和说明"""
+        self.descriptions[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, help_text, callback):
+        """
+        登记一个仪表
+
+        :param callback: 返回当前值的函数
+        """
+        self.describe(name, 'gauge', help_text)
+        self.gauges[name] = callback
+
+    @contextmanager
+    def span(self, stage, expected=(), **labels):
+        """
+        记录一个处理阶段的耗时，抛出异常时同时计入失败次数
+
+        :param expected: 表示正常提前结束的异常类型（如断点续传时的偏移不一致），不计入失败次数和耗时
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except expected:
+            raise
+        except BaseException:
+            self.inc(STAGE_FAILURES, stage=stage, **labels)
+            self.observe(STAGE_SECONDS, time.perf_counter() - started, stage=stage, **labels)
+            raise
+        self.observe(STAGE_SECONDS, time.perf_counter() - started, stage=stage, **labels)
+
+    def render(self):
+        """返回 Prometheus 文本格式的全部指标"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (histogram.buckets, list(histogram.counts), histogram.count, histogram.sum)
+                          for key, histogram in self.histograms.items()}
+        lines = []
+        described = set()
+
+        def header(name, default_kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, help_text = self.descriptions.get(name, (default_kind, name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        for (name, labels), (buckets, counts, count, total) in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+        for name, callback in sorted(self.gauges.items()):
+            try:
+                value = callback()
+            except Exception as e:
+                print(f"读取指标 {name} 失败: {e}")
+                continue
+            header(name, 'gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# 进程内共享的默认指标集
+registry = MetricsRegistry()
+registry.describe(STAGE_SECONDS, 'histogram', '各处理阶段的耗时（秒）')
+registry.describe(STAGE_FAILURES, 'counter', '各处理阶段的失败次数')
+
+
+def span(stage, expected=(), **labels):
+    """在默认指标集中记录一个处理阶段的耗时"""
+    return registry.span(stage, expected, **labels)
+
+
+def timed(stage, check_result=False):
+    """
+    记录函数耗时的装饰器
+
+    :param stage: 阶段名
+    :param check_result: 为True时，函数返回假值也计入失败次数（适用于以 True/False 表示成败的函数）
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                result = func(*args, **kwargs)
+            if check_result and not result:
+                registry.inc(STAGE_FAILURES, stage=stage)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,178 @@
+import os
+import threading
+from collections import OrderedDict
+from DNGToJPG import read_preview, resize_jpeg
+
+# 预览图尺寸档位：最长边像素，None 表示嵌入预览图原尺寸
+VARIANT_FULL = 'full'
+
+
+class PreviewCache:
+    """
+    多尺寸预览图缓存
+
+    以 (内容哈希, 尺寸档位) 为键，内存层保存最近使用的预览图，
+    磁盘层保存在 directory 中；两层分别按各自的字节预算做LRU淘汰。
+    同一个预览图正在生成时，其他请求等待它完成而不重复生成。
+    """
+
+    def __init__(self, directory, variants, memory_budget, disk_budget):
+        """
+        :param directory: 磁盘缓存目录
+        :param variants: {档位名: 最长边像素或None}
+        :param memory_budget: 内存层字节上限
+        :param disk_budget: 磁盘层字节上限
+        """
+        self.directory = directory
+        self.variants = variants
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.generating = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load_disk_index()
+
+    def _load_disk_index(self):
+        """启动时按最近访问时间恢复磁盘层索引"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.jpg'):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_atime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+        self._evict_disk()
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f'{key}.jpg')
+
+    def get(self, content_hash, dng_path, variant=VARIANT_FULL):
+        """
+        获取预览图，未命中时从DNG生成并写入缓存
+
+        :param content_hash: 内容哈希
+        :param dng_path: DNG文件路径（未命中时用于生成）
+        :param variant: 尺寸档位
+        :return: JPEG 字节，生成失败返回None
+        """
+        if variant not in self.variants:
+            raise ValueError(f'未知的预览尺寸: {variant}')
+        key = f'{content_hash}_{variant}'
+
+        while True:
+            data = self._lookup(key)
+            if data is not None:
+                return data
+            with self.lock:
+                pending = self.generating.get(key)
+                if pending is None:
+                    self.generating[key] = threading.Event()
+                    break
+            # 其他线程正在生成，等待后重新查找
+            pending.wait()
+
+        try:
+            data = self._generate(content_hash, dng_path, variant)
+            if data is not None:
+                self.put(key, data)
+            return data
+        finally:
+            with self.lock:
+                self.generating.pop(key).set()
+
+    def warm(self, content_hash, dng_path, variants):
+        """
+        预先生成指定档位的预览图（转换完成后在后台调用）
+
+        :return: 成功生成或已在缓存中的档位列表
+        """
+        return [variant for variant in variants if self.get(content_hash, dng_path, variant) is not None]
+
+    def _lookup(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                return data
+            if key not in self.disk:
+                # 可能由其他服务进程写入磁盘层，纳入本进程的索引
+                try:
+                    size = os.path.getsize(self._disk_path(key))
+                except OSError:
+                    return None
+                self.disk[key] = size
+                self.disk_bytes += size
+            self.disk.move_to_end(key)
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                self.disk_bytes -= self.disk.pop(key, 0)
+            return None
+        with self.lock:
+            self._remember(key, data)
+        return data
+
+    def _generate(self, content_hash, dng_path, variant):
+        """生成预览图；小尺寸档位优先由已缓存的全尺寸预览图缩小，避免再次读取DNG"""
+        max_size = self.variants[variant]
+        if max_size is not None:
+            full = self._lookup(f'{content_hash}_{VARIANT_FULL}')
+            if full is not None:
+                return bytes(resize_jpeg(full, max_size))
+        if not os.path.exists(dng_path):
+            return None
+        return read_preview(dng_path, max_size)
+
+    def put(self, key, data):
+        """写入两层缓存"""
+        path = self._disk_path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.disk_bytes += len(data) - self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+            self._remember(key, data)
+            self._evict_disk()
+
+    def _remember(self, key, data):
+        """放入内存层并按预算淘汰（调用方需持有锁）"""
+        if len(data) > self.memory_budget:
+            return
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_bytes -= len(old)
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.memory_budget:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        """按预算淘汰磁盘层（调用方需持有锁）"""
+        while self.disk_bytes > self.disk_budget and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        """返回缓存使用情况"""
+        with self.lock:
+            return {
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_bytes
+            }
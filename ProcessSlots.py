@@ -0,0 +1,111 @@
+import os
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows 等没有 fcntl 的平台
+    fcntl = None
+
+import Config
+
+# 所有槽位都被占用时重新尝试的间隔，单位秒
+POLL_INTERVAL = 0.02
+
+
+class ProcessSlots:
+    """
+    同一台机器上的并发上限：所有进程和线程合计最多 limit 个调用者同时持有槽位
+
+    每个槽位是 directory 下的一个锁文件，用 flock 占用；持有者退出（包括被杀死）时锁自动释放。
+    没有 fcntl 的平台退化为进程内的信号量。
+    """
+
+    def __init__(self, name, limit, directory=None):
+        """
+        :param name: 槽位名称（同名的槽位在各进程之间共享）
+        :param limit: 槽位数
+        :param directory: 锁文件目录，默认为 Config.PROCESS_SLOT_DIR 或系统临时目录
+        """
+        self.name = name
+        self.limit = max(1, limit)
+        self.directory = directory or Config.PROCESS_SLOT_DIR or os.path.join(tempfile.gettempdir(), 'webraw-slots')
+        self.semaphore = threading.BoundedSemaphore(self.limit)
+        self.next_slot = 0
+        if fcntl is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _try_lock(self, index):
+        """尝试占用一个槽位，成功时返回打开的锁文件描述符"""
+        fd = os.open(os.path.join(self.directory, f'{self.name}.{index}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except OSError:
+            os.close(fd)
+            return None
+
+    @contextmanager
+    def acquire(self):
+        """占用一个槽位直到 with 块结束，没有空闲槽位时等待"""
+        if fcntl is None:
+            with self.semaphore:
+                yield
+            return
+
+        # 先在进程内排队，避免同一进程的线程一起轮询锁文件
+        with self.semaphore:
+            fd = None
+            while fd is None:
+                # 从上次的位置开始尝试，让各槽位轮流使用
+                start = self.next_slot
+                for offset in range(self.limit):
+                    index = (start + offset) % self.limit
+                    fd = self._try_lock(index)
+                    if fd is not None:
+                        self.next_slot = index + 1
+                        break
+                else:
+                    time.sleep(POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                os.close(fd)
+
+
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def get_slots(name, limit):
+    """返回当前进程共享的指定名称的槽位（首次调用时创建）"""
+    with _slots_lock:
+        slots = _slots.get(name)
+        if slots is None:
+            slots = _slots[name] = ProcessSlots(name, limit)
+        return slots
+
+
+def raise_converter_limit(limit):
+    """
+    把本进程和之后启动的子进程的转换器槽位数提高到 limit（命令行的 --jobs 大于配置的上限时）
+
+    需要在第一次占用转换器槽位之前调用。
+    """
+    # 子进程重新导入 Config 时读取环境变量
+    os.environ['WEBRAW_CONVERTER_MAX_PROCESSES'] = str(limit)
+    Config.CONVERTER_MAX_PROCESSES = limit
+    with _slots_lock:
+        _slots.pop('converter', None)
+
+
+def converter_slot():
+    """占用一个转换器进程槽位"""
+    return get_slots('converter', Config.CONVERTER_MAX_PROCESSES).acquire()
+
+
+def exiftool_slot():
+    """占用一个 exiftool 命令槽位"""
+    return get_slots('exiftool', Config.EXIFTOOL_MAX_ACTIVE).acquire()
@@ -0,0 +1,144 @@
+import os
+import time
+import errno
+import shutil
+import threading
+
+import Metrics
+
+Metrics.registry.describe('webraw_scratch_files_total', 'counter',
+                          '按大小选择的中间文件位置（stage=upload/convert，placement=scratch/disk）')
+
+
+def _directory_bytes(directory):
+    total = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue
+    return total
+
+
+class ScratchSpace:
+    """
+    中间文件的暂存区（例如 tmpfs 上的目录）
+
+    上传的RAW（incoming 子目录）、转换器输出的DNG和 exiftool 改写时的临时文件（work 子目录）放在暂存区，
+    只有最终的DNG写入持久存储的输出目录。每个文件按大小单独决定：文件超过 max_file_size，
+    或加上已预留的空间会超出 budget 或暂存区文件系统的剩余空间时，这个文件改用磁盘上的目录。
+    directory 为空时不启用，所有文件都在磁盘上处理。
+    """
+
+    def __init__(self, directory, budget, max_file_size):
+        """
+        :param directory: 暂存区目录，为空表示不启用
+        :param budget: 暂存区最多使用的字节数
+        :param max_file_size: 超过此大小的文件不暂存
+        """
+        self.directory = directory or None
+        self.budget = budget
+        self.max_file_size = max_file_size
+        self.incoming = os.path.join(directory, 'incoming') if directory else None
+        self.work = os.path.join(directory, 'work') if directory else None
+        self.lock = threading.Lock()
+        # 已预留但可能还没有写入的空间：{键: (字节数, 过期时间)}
+        self.reservations = {}
+        if self.directory:
+            os.makedirs(self.incoming, exist_ok=True)
+            os.makedirs(self.work, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def usage(self):
+        """暂存区中已有文件的字节数"""
+        if not self.enabled:
+            return 0
+        return _directory_bytes(self.incoming) + _directory_bytes(self.work)
+
+    def _free_bytes(self):
+        stat = os.statvfs(self.directory)
+        return stat.f_bavail * stat.f_frsize
+
+    def reserve(self, key, file_size, stage, multiple=1, ttl=None):
+        """
+        决定一个文件是否暂存，暂存时为它预留空间
+
+        :param key: 预留的标识，用 release(key) 释放
+        :param file_size: 文件字节数（未知时为None，不暂存）
+        :param stage: 阶段名称（用于统计，如 upload、convert）
+        :param multiple: 预留文件大小的几倍（转换阶段需要容纳DNG和 exiftool 的临时文件）
+        :param ttl: 预留的最长保留秒数（例如可能由其他进程完成的分块上传），None 表示直到 release
+        :return: 暂存返回True，使用磁盘返回False
+        """
+        staged = self._reserve(key, file_size, multiple, ttl)
+        Metrics.registry.inc('webraw_scratch_files_total', stage=stage, placement='scratch' if staged else 'disk')
+        return staged
+
+    def _reserve(self, key, file_size, multiple, ttl):
+        if not self.enabled or file_size is None or file_size > self.max_file_size:
+            return False
+        needed = file_size * multiple
+        now = time.time()
+        with self.lock:
+            reserved = self._reserved(now)
+            try:
+                if self.usage() + reserved + needed > self.budget or self._free_bytes() < reserved + needed:
+                    return False
+            except OSError as e:
+                print(f"警告：无法检查暂存区 {self.directory}：{e}")
+                return False
+            self.reservations[key] = (needed, now + ttl if ttl is not None else float('inf'))
+        return True
+
+    def _reserved(self, now):
+        """丢弃过期的预留，返回仍有效的预留字节数（调用方持有 lock）"""
+        self.reservations = {k: v for k, v in self.reservations.items() if v[1] > now}
+        return sum(size for size, _ in self.reservations.values())
+
+    def release(self, key):
+        """释放预留的空间（文件已写完、已移走或已删除）"""
+        with self.lock:
+            self.reservations.pop(key, None)
+
+    def publish(self, path, final_path):
+        """
+        把暂存区中的结果文件移动到最终位置
+
+        跨文件系统时先复制到目标目录中的临时文件再改名，其他线程不会读到写了一半的文件。
+        """
+        try:
+            os.replace(path, final_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        tmp_path = f'{final_path}.part'
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, final_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.remove(path)
+
+    def stats(self):
+        """返回暂存区的用量和预留"""
+        with self.lock:
+            reserved = self._reserved(time.time())
+        return {
+            'enabled': self.enabled,
+            'directory': self.directory,
+            'bytes': self.usage(),
+            'reserved_bytes': reserved,
+            'budget': self.budget,
+            'max_file_size': self.max_file_size
+        }
@@ -0,0 +1,203 @@
+import os
+import mmap
+import struct
+from collections import namedtuple
+
+# 常用TIFF/DNG标签
+TAG_NEW_SUBFILE_TYPE = 0x00FE
+TAG_IMAGE_WIDTH = 0x0100
+TAG_IMAGE_LENGTH = 0x0101
+TAG_COMPRESSION = 0x0103
+TAG_PHOTOMETRIC = 0x0106
+TAG_STRIP_OFFSETS = 0x0111
+TAG_STRIP_BYTE_COUNTS = 0x0117
+TAG_SUB_IFDS = 0x014A
+TAG_JPEG_INTERCHANGE_FORMAT = 0x0201
+TAG_JPEG_INTERCHANGE_FORMAT_LENGTH = 0x0202
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_XMP = 0x02BC
+TAG_UNIQUE_CAMERA_MODEL = 0xC614
+
+# ASCII 类型
+TYPE_ASCII = 2
+
+# 各TIFF数据类型的单个元素字节数
+TYPE_SIZES = {
+    1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2,
+    9: 4, 10: 8, 11: 4, 12: 8, 13: 4
+}
+
+# IFD 条目：标签、类型、数量、数据所在的文件偏移、条目本身的文件偏移
+IFDEntry = namedtuple('IFDEntry', ['tag', 'type', 'count', 'data_offset', 'entry_offset'])
+
+
+class TiffError(Exception):
+    """文件不是可以处理的TIFF/DNG结构"""
+
+
+def read_header(buf):
+    """
+    解析TIFF文件头
+
+    :param buf: 文件内容（bytes、mmap 等支持切片的对象）
+    :return: (字节序前缀 '<' 或 '>', 第一个IFD的偏移)
+    """
+    if len(buf) < 8:
+        raise TiffError('文件过短，不是TIFF文件')
+    byte_order = bytes(buf[0:2])
+    if byte_order == b'II':
+        endian = '<'
+    elif byte_order == b'MM':
+        endian = '>'
+    else:
+        raise TiffError('不是TIFF文件')
+    magic, first_ifd = struct.unpack(endian + 'HI', buf[2:8])
+    if magic != 42:
+        raise TiffError('不支持的TIFF格式（可能是BigTIFF）')
+    return endian, first_ifd
+
+
+def read_ifd(buf, endian, offset):
+    """
+    读取一个IFD
+
+    :param buf: 文件内容
+    :param endian: 字节序前缀
+    :param offset: IFD 的文件偏移
+    :return: (条目字典 {tag: IFDEntry}, 下一个IFD的偏移)
+    """
+    if offset + 2 > len(buf):
+        raise TiffError(f'IFD偏移超出文件范围: {offset}')
+    (count,) = struct.unpack(endian + 'H', buf[offset:offset + 2])
+    end = offset + 2 + count * 12
+    if end + 4 > len(buf):
+        raise TiffError(f'IFD超出文件范围: {offset}')
+
+    entries = {}
+    for index in range(count):
+        entry_offset = offset + 2 + index * 12
+        tag, value_type, value_count = struct.unpack(endian + 'HHI', buf[entry_offset:entry_offset + 8])
+        size = TYPE_SIZES.get(value_type, 1) * value_count
+        if size <= 4:
+            data_offset = entry_offset + 8
+        else:
+            (data_offset,) = struct.unpack(endian + 'I', buf[entry_offset + 8:entry_offset + 12])
+        entries[tag] = IFDEntry(tag, value_type, value_count, data_offset, entry_offset)
+
+    (next_offset,) = struct.unpack(endian + 'I', buf[end:end + 4])
+    return entries, next_offset
+
+
+def iter_ifds(buf, endian, first_ifd, max_ifds=64):
+    """
+    遍历IFD链及其SubIFDs（深度优先），带循环保护
+
+    :param buf: 文件内容
+    :param endian: 字节序前缀
+    :param first_ifd: 第一个IFD的偏移
+    :param max_ifds: 最多遍历的IFD数量
+    :return: 依次产生 (IFD偏移, 条目字典)
+    """
+    pending = [first_ifd]
+    seen = set()
+    while pending and len(seen) < max_ifds:
+        offset = pending.pop(0)
+        if offset == 0 or offset in seen:
+            continue
+        seen.add(offset)
+        entries, next_offset = read_ifd(buf, endian, offset)
+        yield offset, entries
+        sub_ifds = entries.get(TAG_SUB_IFDS)
+        children = read_values(buf, endian, sub_ifds) if sub_ifds is not None else []
+        pending[0:0] = children + [next_offset]
+
+
+def read_values(buf, endian, entry):
+    """
+    读取条目的数值（SHORT/LONG 类型），返回整数列表
+
+    :param buf: 文件内容
+    :param endian: 字节序前缀
+    :param entry: IFDEntry
+    :raises TiffError: 类型不是整数，或数据超出文件范围
+    """
+    formats = {3: 'H', 4: 'I', 13: 'I'}
+    fmt = formats.get(entry.type)
+    if fmt is None:
+        raise TiffError(f'标签 {entry.tag:#06x} 不是整数类型')
+    size = TYPE_SIZES[entry.type] * entry.count
+    if entry.data_offset + size > len(buf):
+        raise TiffError(f'标签 {entry.tag:#06x} 的数据超出文件范围')
+    data = buf[entry.data_offset:entry.data_offset + size]
+    return list(struct.unpack(endian + fmt * entry.count, data))
+
+
+def read_ascii(buf, entry):
+    """读取ASCII条目的字符串值（去掉结尾的NUL）"""
+    data = bytes(buf[entry.data_offset:entry.data_offset + entry.count])
+    return data.split(b'\0', 1)[0].decode('ascii', errors='replace')
+
+
+def write_ascii_tags(file_path, values):
+    """
+    原地修改IFD0中已存在的ASCII标签
+
+    新值能放进原有空间时直接覆盖（通过mmap写入）；放不下时把新值追加到文件末尾，
+    只改写条目中的数量和偏移。不会重写整个文件。
+
+    :param file_path: TIFF/DNG 文件路径
+    :param values: {tag: 字符串}
+    :raises TiffError: 文件结构不支持原地修改（标签不存在、类型不符、XMP中含有相同字段等）
+    """
+    with open(file_path, 'r+b') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            endian, first_ifd = read_header(buf)
+            entries, _ = read_ifd(buf, endian, first_ifd)
+
+            # XMP 中也有相机型号时交给 exiftool 统一处理，避免两处信息不一致
+            xmp = entries.get(TAG_XMP)
+            if xmp is not None:
+                packet = bytes(buf[xmp.data_offset:xmp.data_offset + xmp.count])
+                if b'tiff:Make' in packet or b'tiff:Model' in packet:
+                    raise TiffError('XMP 中包含相机型号信息')
+
+            patches = []
+            appends = []
+            append_offset = file_size + (file_size & 1)
+            for tag, text in values.items():
+                entry = entries.get(tag)
+                if entry is None:
+                    raise TiffError(f'IFD0 中不存在标签 {tag:#06x}')
+                if entry.type != TYPE_ASCII:
+                    raise TiffError(f'标签 {tag:#06x} 不是ASCII类型')
+
+                encoded = text.encode('ascii') + b'\0'
+                if len(encoded) <= 4:
+                    # 短值直接写入条目的值字段
+                    patches.append((entry, encoded.ljust(4, b'\0'), entry.entry_offset + 8, len(encoded)))
+                elif entry.count > 4 and len(encoded) <= entry.count:
+                    # 原有空间足够，覆盖并用NUL补齐
+                    patches.append((entry, encoded.ljust(entry.count, b'\0'), entry.data_offset, len(encoded)))
+                else:
+                    # 原有空间不足，追加到文件末尾（按字边界对齐）
+                    appends.append((entry, encoded, append_offset))
+                    append_offset += len(encoded) + (len(encoded) & 1)
+
+        if appends:
+            f.seek(file_size)
+            if file_size & 1:
+                f.write(b'\0')
+            for _, encoded, offset in appends:
+                f.write(encoded.ljust(len(encoded) + (len(encoded) & 1), b'\0'))
+            f.flush()
+
+        with mmap.mmap(f.fileno(), 0) as buf:
+            for entry, data, offset, count in patches:
+                buf[offset:offset + len(data)] = data
+                buf[entry.entry_offset + 4:entry.entry_offset + 8] = struct.pack(endian + 'I', count)
+            for entry, encoded, offset in appends:
+                buf[entry.entry_offset + 4:entry.entry_offset + 12] = struct.pack(endian + 'II', len(encoded), offset)
+            buf.flush()
+    return True
@@ -0,0 +1,276 @@
+import os
+import io
+import hashlib
+import tempfile
+import threading
+from flask import Request
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import Config
+
+# 抽样指纹每段的字节数
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+
+def new_hash():
+    """返回用于文件去重的哈希对象（BLAKE2b，128位摘要）"""
+    return hashlib.blake2b(digest_size=16)
+
+
+def calculate_file_hash(file_path):
+    """计算文件的内容哈希（与上传时边写边算的哈希一致）"""
+    hasher = new_hash()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(Config.UPLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def calculate_fingerprint(stream, size):
+    """
+    计算抽样指纹（用于上传前的预检查）：文件大小以及开头、中间、结尾各 64KiB 数据的 SHA-256
+
+    只读取三段数据，耗时与文件大小无关；算法与 static/js/main.js 中的 fileFingerprint 一致。
+
+    :param stream: 可定位的二进制文件对象
+    :param size: 文件字节数
+    """
+    hasher = hashlib.sha256(size.to_bytes(8, 'little'))
+    for offset in (0, max(0, (size - FINGERPRINT_SAMPLE_SIZE) // 2), max(0, size - FINGERPRINT_SAMPLE_SIZE)):
+        stream.seek(offset)
+        hasher.update(stream.read(min(FINGERPRINT_SAMPLE_SIZE, size - offset)))
+    return hasher.hexdigest()
+
+
+def file_fingerprint(file_path):
+    """计算文件的抽样指纹"""
+    with open(file_path, 'rb') as f:
+        return calculate_fingerprint(f, os.fstat(f.fileno()).st_size)
+
+
+class HashingFile(io.BufferedRandom):
+    """
+    上传文件的落盘容器：写入磁盘的同时计算内容哈希
+
+    Werkzeug 解析 multipart 时直接把文件数据写入这里，
+    解析完成后文件已经在上传目录中，哈希也已算好，无需再读一遍。
+    """
+
+    def __init__(self, directory):
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.part')
+        super().__init__(io.FileIO(fd, 'w+b'), buffer_size=Config.UPLOAD_CHUNK_SIZE)
+        self.path = path
+        self.hasher = new_hash()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return super().write(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def persist(self, file_path):
+        """关闭文件并移动到最终位置（同一目录内重命名，不复制数据）"""
+        self.close()
+        os.replace(self.path, file_path)
+
+    def discard(self):
+        """关闭并删除临时文件"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class HashingRequest(Request):
+    """把上传文件直接流式写入 upload_folder 并同时计算哈希的请求类"""
+
+    upload_folder = 'upload'
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingFile(self.upload_folder)
+
+
+def received_hash(file_storage):
+    """
+    返回上传文件的内容哈希
+
+    通过 HashingRequest 接收的文件在写盘时已算好哈希；其他来源的流在这里读一遍后回到开头。
+    """
+    stream = file_storage.stream
+    if isinstance(stream, HashingFile):
+        return stream.hexdigest()
+    hasher = new_hash()
+    for chunk in iter(lambda: stream.read(Config.UPLOAD_CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    stream.seek(0)
+    return hasher.hexdigest()
+
+
+def received_fingerprint(file_storage):
+    """返回上传文件的抽样指纹"""
+    stream = file_storage.stream
+    if isinstance(stream, HashingFile):
+        stream.flush()
+        return file_fingerprint(stream.path)
+    stream.seek(0, os.SEEK_END)
+    fingerprint = calculate_fingerprint(stream, stream.tell())
+    stream.seek(0)
+    return fingerprint
+
+
+def save_upload(file_storage, file_path):
+    """
+    保存上传文件
+
+    :param file_storage: Werkzeug FileStorage
+    :param file_path: 目标路径
+    :return: file_path
+    """
+    stream = file_storage.stream
+    if isinstance(stream, HashingFile):
+        stream.persist(file_path)
+    else:
+        file_storage.save(file_path, buffer_size=Config.UPLOAD_CHUNK_SIZE)
+    return file_path
+
+
+def discard_uploads(files):
+    """
+    删除请求中未被保存的上传临时文件
+
+    :param files: request.files
+    """
+    for _, file_storage in files.items(multi=True):
+        stream = file_storage.stream
+        if isinstance(stream, HashingFile) and not stream.closed:
+            stream.discard()
+
+
+class OffsetMismatch(Exception):
+    """分块的起始位置与服务器已收到的字节数不一致"""
+
+    def __init__(self, offset):
+        super().__init__(f"当前偏移为 {offset}")
+        self.offset = offset
+
+
+class ChunkStore:
+    """
+    分块上传的落盘容器
+
+    每个上传对应上传目录中的一个 .chunks 文件，文件大小就是已收到的字节数（断点续传的偏移）。
+    分块写入时同时更新内存中的哈希；哈希状态不在本进程（重启或由其他进程接收）时，
+    完成上传时重新读一遍已落盘的数据。
+    提供暂存区时，按文件大小把 .chunks 文件放在暂存区的 incoming 目录中。
+    """
+
+    def __init__(self, directory, scratch=None):
+        """
+        :param directory: 上传目录
+        :param scratch: 中间文件暂存区（ScratchSpace，可选）
+        """
+        self.directory = directory
+        self.scratch = scratch if scratch is not None and scratch.enabled else None
+        self.hashers = {}
+        self.lock = threading.Lock()
+
+    def path(self, upload_id):
+        if self.scratch is not None:
+            staged_path = os.path.join(self.scratch.incoming, f'{upload_id}.chunks')
+            if os.path.exists(staged_path):
+                return staged_path
+        return os.path.join(self.directory, f'{upload_id}.chunks')
+
+    def create(self, upload_id, size):
+        """
+        开始一个上传
+
+        :param upload_id: 上传ID
+        :param size: 文件总字节数（决定是否放在暂存区）
+        """
+        directory = self.directory
+        if self.scratch is not None and self.scratch.reserve(upload_id, size, 'upload',
+                                                              ttl=Config.UPLOAD_PARTIAL_TTL_SECONDS):
+            directory = self.scratch.incoming
+        open(os.path.join(directory, f'{upload_id}.chunks'), 'xb').close()
+        with self.lock:
+            self.hashers[upload_id] = (0, new_hash())
+
+    def offset(self, upload_id):
+        """返回已收到的字节数，上传不存在时返回None"""
+        try:
+            return os.path.getsize(self.path(upload_id))
+        except OSError:
+            return None
+
+    def append(self, upload_id, offset, stream, limit):
+        """
+        从 offset 处追加一个分块
+
+        :param upload_id: 上传ID
+        :param offset: 客户端认为的当前偏移
+        :param stream: 分块数据流
+        :param limit: 本次最多写入的字节数
+        :return: 写入后的偏移
+        """
+        with open(self.path(upload_id), 'ab') as f:
+            # 同一上传的分块可能由不同进程同时接收，用文件锁保证顺序
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            current = os.fstat(f.fileno()).st_size
+            if current != offset:
+                raise OffsetMismatch(current)
+            with self.lock:
+                cached = self.hashers.get(upload_id)
+            hasher = cached[1] if cached and cached[0] == current else None
+            written = 0
+            try:
+                for chunk in iter(lambda: stream.read(min(Config.UPLOAD_CHUNK_SIZE, limit - written)), b''):
+                    f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    written += len(chunk)
+            finally:
+                # 连接中途断开时，已写入的部分同样计入偏移，客户端从新的偏移处续传
+                f.flush()
+                with self.lock:
+                    if hasher is not None:
+                        self.hashers[upload_id] = (current + written, hasher)
+                    else:
+                        self.hashers.pop(upload_id, None)
+            return current + written
+
+    def hexdigest(self, upload_id):
+        """返回已收到数据的内容哈希"""
+        with self.lock:
+            cached = self.hashers.get(upload_id)
+        if cached and cached[0] == self.offset(upload_id):
+            return cached[1].hexdigest()
+        return calculate_file_hash(self.path(upload_id))
+
+    def persist(self, upload_id, filename):
+        """
+        把完整的上传改名为 filename（留在接收数据的目录中，不复制数据）
+
+        :return: 保存后的路径
+        """
+        source_path = self.path(upload_id)
+        file_path = os.path.join(os.path.dirname(source_path), filename)
+        os.replace(source_path, file_path)
+        self._forget(upload_id)
+        return file_path
+
+    def discard(self, upload_id):
+        self._forget(upload_id)
+        if os.path.exists(self.path(upload_id)):
+            os.remove(self.path(upload_id))
+
+    def _forget(self, upload_id):
+        with self.lock:
+            self.hashers.pop(upload_id, None)
+        if self.scratch is not None:
+            self.scratch.release(upload_id)
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import errno
+import select
+import struct
+import hashlib
+import ctypes
+import ctypes.util
+
+import Config
+
+# 清单文件的默认文件名（保存在输出目录中）
+MANIFEST_NAME = '.webraw_manifest.json'
+
+# inotify 事件掩码（见 <sys/inotify.h>）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def file_hash(file_path):
+    """计算文件的内容哈希（BLAKE2b，128位摘要，与上传去重使用的哈希一致）"""
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(Config.UPLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class Manifest:
+    """
+    增量处理清单：{RAW绝对路径: {size, mtime, hash, output, failed, failures, failed_at}}
+
+    文件的大小和修改时间与清单一致、且输出文件仍在时视为已处理；
+    大小或修改时间变化但内容哈希不变（例如被 touch 或重新复制）时只更新清单，不再转换。
+    处理失败的文件记录连续失败次数，按指数退避重试（本次启动之前的失败立即重试），
+    失败 max_retries 次后不再重试，直到文件内容变化。
+    """
+
+    def __init__(self, path, retry_seconds=None, max_retries=None):
+        """
+        :param path: 清单文件路径
+        :param retry_seconds: 第一次失败后的重试等待秒数，默认为 Config.WATCH_RETRY_SECONDS
+        :param max_retries: 最多连续失败次数，默认为 Config.WATCH_MAX_RETRIES
+        """
+        self.path = path
+        self.retry_seconds = retry_seconds or Config.WATCH_RETRY_SECONDS
+        self.max_retries = max_retries or Config.WATCH_MAX_RETRIES
+        self.started = time.time()
+        self.entries = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"警告：无法读取清单 {path}，将重新处理所有文件：{e}")
+
+    def save(self):
+        """原子地写入清单文件"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def _matches(self, entry, stat):
+        return entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+    def _retry_due(self, entry):
+        """内容未变化的失败文件是否到了重试时间"""
+        failures = entry.get('failures', 1)
+        if failures >= self.max_retries:
+            return False
+        failed_at = entry.get('failed_at', 0)
+        if failed_at < self.started:
+            return True
+        return time.time() - failed_at >= self.retry_seconds * 2 ** (failures - 1)
+
+    def is_current(self, raw_path, stat):
+        """
+        判断文件是否无需处理
+
+        :param raw_path: RAW文件路径
+        :param stat: 文件的 os.stat 结果
+        """
+        entry = self.entries.get(os.path.abspath(raw_path))
+        if entry is None:
+            return False
+        if entry['failed']:
+            return self._matches(entry, stat) and not self._retry_due(entry)
+        if not os.path.exists(entry['output']):
+            return False
+        if self._matches(entry, stat):
+            return True
+        # 大小或修改时间变化，按内容判断
+        if entry['size'] == stat.st_size and entry['hash'] == file_hash(raw_path):
+            entry['mtime'] = stat.st_mtime
+            return True
+        return False
+
+    def record(self, raw_path, stat, content_hash, output_path, failed=False):
+        """记录一个文件的处理结果（内容未变化时累计连续失败次数）"""
+        raw_path = os.path.abspath(raw_path)
+        previous = self.entries.get(raw_path)
+        failures = 0
+        if failed:
+            failures = 1
+            if previous is not None and previous['failed'] and previous['hash'] == content_hash:
+                failures = previous.get('failures', 1) + 1
+        self.entries[raw_path] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': content_hash,
+            'output': os.path.abspath(output_path),
+            'failed': failed,
+            'failures': failures,
+            'failed_at': time.time() if failed else None
+        }
+
+    def given_up(self):
+        """返回达到重试上限、内容变化之前不再处理的文件列表"""
+        return sorted(path for path, entry in self.entries.items()
+                      if entry['failed'] and entry.get('failures', 1) >= self.max_retries)
+
+
+class InotifyWatcher:
+    """
+    用 inotify（通过 ctypes 调用 libc）监视目录中写入完成或移入的文件
+
+    仅适用于 Linux；不可用时 open() 返回None，调用方改为定时扫描。
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def open(cls, directory_path):
+        """开始监视目录，inotify 不可用时返回None"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            return None
+        fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        if inotify_add_watch(fd, os.fsencode(directory_path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            print(f"警告：无法监视目录 {directory_path}：{os.strerror(ctypes.get_errno())}")
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    def read(self, timeout):
+        """
+        等待事件
+
+        :param timeout: 最长等待秒数
+        :return: (写入完成或移入的文件名集合, 是否发生事件队列溢出)
+        """
+        names = set()
+        overflow = False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return names, overflow
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return names, overflow
+            raise
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif name:
+                names.add(os.fsdecode(name))
+        return names, overflow
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,72 @@
+import io
+import os
+import time
+import zipfile
+
+import Config
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """只写、不可定位的缓冲区，zipfile 写入的数据由生成器逐段取走"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def unique_arcnames(names):
+    """给重名的文件加上序号，例如 a.dng、a (1).dng"""
+    seen = {}
+    result = []
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        count = seen.get(name.lower(), 0)
+        seen[name.lower()] = count + 1
+        result.append(name if count == 0 else f'{stem} ({count}){ext}')
+    return result
+
+
+def _write_zip(buffer, entries, chunk_size):
+    """把文件逐段写入ZIP，每写入一段让出一次，由调用方取走缓冲区中的数据"""
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for path, arcname in entries:
+            info = zipfile.ZipInfo(arcname, time.localtime(os.path.getmtime(path))[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = os.path.getsize(path)
+            with open(path, 'rb') as src, archive.open(info, 'w') as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    dest.write(chunk)
+                    yield
+            yield
+    # 关闭时写入中央目录
+    yield
+
+
+def stream_zip(entries, chunk_size=None):
+    """
+    边读文件边生成ZIP数据流（仅存储，不压缩）
+
+    DNG 数据本身已经压缩过，再压缩收益很小；整个压缩包不会缓存在内存或磁盘中，
+    每个文件的CRC和大小写在文件数据之后的数据描述符里。
+
+    :param entries: (文件路径, 压缩包内的文件名) 列表
+    :param chunk_size: 每次读取的字节数
+    :return: 生成 bytes 的迭代器
+    """
+    buffer = _ChunkBuffer()
+    for _ in _write_zip(buffer, entries, chunk_size or Config.UPLOAD_CHUNK_SIZE):
+        data = buffer.take()
+        if data:
+            yield data
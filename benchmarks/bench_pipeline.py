@@ -0,0 +1,198 @@
+"""
+端到端吞吐量基准测试
+
+使用 fake 转换器后端（可模拟转换耗时）在临时目录中依次测量：
+Apply.process_file、/upload（直到转换任务完成）、/preview 和 /download，
+输出每个阶段的 文件/秒、p50/p99 延迟和进程峰值内存。
+
+用法示例:
+    python3 benchmarks/bench_pipeline.py --files 50 --size-mb 20 --file-ms 200
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    """返回百分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    """进程峰值常驻内存（MB）；Linux 上 ru_maxrss 单位为KB，macOS 上为字节"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def summarize(name, latencies, elapsed):
+    return {
+        'stage': name,
+        'files': len(latencies),
+        'files_per_second': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def make_raw_files(directory, count, size):
+    """生成内容互不相同的伪RAW文件"""
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f'bench_{index:04d}.cr2')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def bench_process_file(raw_paths, output_directory):
+    from Apply import process_file
+    latencies = []
+    start = time.perf_counter()
+    for path in raw_paths:
+        t0 = time.perf_counter()
+        if not process_file(path, output_directory):
+            raise RuntimeError(f'process_file 失败: {path}')
+        latencies.append(time.perf_counter() - t0)
+    return summarize('process_file', latencies, time.perf_counter() - start)
+
+
+def bench_upload(client, raw_paths, user_id, poll_interval):
+    latencies = []
+    start = time.perf_counter()
+    submitted = {}
+    for path in raw_paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        t0 = time.perf_counter()
+        response = client.post('/upload', data={
+            'user_id': user_id,
+            'files': [(io.BytesIO(data), os.path.basename(path))]
+        }, content_type='multipart/form-data')
+        if response.status_code >= 400:
+            raise RuntimeError(f'/upload 返回 {response.status_code}: {response.get_data(as_text=True)}')
+        for job in response.get_json()['jobs']:
+            submitted[job['job_id']] = t0
+
+    # 等待全部转换任务结束，记录从上传开始到完成的延迟
+    while submitted:
+        for job_id, t0 in list(submitted.items()):
+            job = client.get(f'/api/jobs/{job_id}?user_id={user_id}').get_json()
+            if job.get('state') == 'done':
+                latencies.append(time.perf_counter() - t0)
+                del submitted[job_id]
+            elif job.get('state') == 'failed' or 'error' in job and 'state' not in job:
+                raise RuntimeError(f'转换任务失败: {job}')
+        time.sleep(poll_interval)
+    return summarize('upload', latencies, time.perf_counter() - start)
+
+
+def bench_preview(client, files, user_id, size):
+    latencies = []
+    start = time.perf_counter()
+    for item in files:
+        t0 = time.perf_counter()
+        response = client.get(f"/preview/{item['unique_filename']}?token={item['token']}&user_id={user_id}&size={size}")
+        response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError(f'/preview 返回 {response.status_code}')
+        latencies.append(time.perf_counter() - t0)
+    return summarize(f'preview[{size}]', latencies, time.perf_counter() - start)
+
+
+def bench_download(client, files, user_id):
+    latencies = []
+    start = time.perf_counter()
+    for item in files:
+        t0 = time.perf_counter()
+        response = client.get(f"/download/{item['unique_filename']}?token={item['token']}&user_id={user_id}")
+        response.get_data()
+        response.close()
+        if response.status_code != 200:
+            raise RuntimeError(f'/download 返回 {response.status_code}')
+        latencies.append(time.perf_counter() - t0)
+    return summarize('download', latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAW→DNG 流水线端到端基准测试（使用 fake 转换器后端）。")
+    parser.add_argument('--files', type=int, default=20, help='测试文件数（默认20）')
+    parser.add_argument('--size-mb', type=float, default=5, help='每个伪RAW文件的大小，单位MB（默认5）')
+    parser.add_argument('--startup-ms', type=int, default=0, help='模拟的转换器启动耗时，单位毫秒')
+    parser.add_argument('--file-ms', type=int, default=0, help='模拟的单文件转换耗时，单位毫秒')
+    parser.add_argument('--workers', type=int, default=None, help='转换工作线程数（默认取配置）')
+    parser.add_argument('--json', action='store_true', help='以JSON格式输出结果')
+    parser.add_argument('--keep', action='store_true', help='保留临时工作目录')
+    args = parser.parse_args()
+
+    # 必须在导入项目模块之前设置，Config 在导入时读取环境变量
+    os.environ['WEBRAW_CONVERTER_BACKEND'] = 'fake'
+    os.environ['WEBRAW_FAKE_CONVERTER_STARTUP_MS'] = str(args.startup_ms)
+    os.environ['WEBRAW_FAKE_CONVERTER_FILE_MS'] = str(args.file_ms)
+    if args.workers:
+        os.environ['WEBRAW_CONVERSION_WORKERS'] = str(args.workers)
+    sys.path.insert(0, REPO_ROOT)
+
+    work_dir = tempfile.mkdtemp(prefix='webraw-bench-')
+    original_cwd = os.getcwd()
+    os.chdir(work_dir)
+    # 服务器使用相对路径的 upload/、output/ 等目录，模板和静态文件仍从仓库读取
+    try:
+        raw_dir = os.path.join(work_dir, 'raw')
+        cli_output = os.path.join(work_dir, 'cli_output')
+        os.makedirs(raw_dir)
+        os.makedirs(cli_output)
+        raw_paths = make_raw_files(raw_dir, args.files, int(args.size_mb * 1024 * 1024))
+
+        results = []
+        with open(os.devnull, 'w') as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                results.append(bench_process_file(raw_paths, cli_output))
+
+                import run_server
+                client = run_server.app.test_client()
+                user_id = 'bench_user'
+                results.append(bench_upload(client, raw_paths, user_id, poll_interval=0.01))
+                files = client.get(f'/api/files?user_id={user_id}').get_json()['files']
+                files = [item for item in files if item.get('state') == 'done']
+                results.append(bench_preview(client, files, user_id, 'thumb'))
+                results.append(bench_preview(client, files, user_id, 'full'))
+                results.append(bench_download(client, files, user_id))
+            finally:
+                sys.stdout = stdout
+    finally:
+        os.chdir(original_cwd)
+        if args.keep:
+            print(f'工作目录: {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        return
+
+    print(f"{'阶段':<16}{'文件数':>8}{'文件/秒':>12}{'p50(ms)':>12}{'p99(ms)':>12}{'峰值RSS(MB)':>14}")
+    for row in results:
+        print(f"{row['stage']:<16}{row['files']:>8}{row['files_per_second']:>12.2f}"
+              f"{row['p50_ms']:>12.1f}{row['p99_ms']:>12.1f}{row['peak_rss_mb']:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
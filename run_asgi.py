@@ -0,0 +1,99 @@
+"""
+asyncio 服务入口（ASGI）
+
+路由和URL与 run_server.py 完全相同：普通请求交给 Flask 应用在线程池中处理，
+响应数据的发送在事件循环中等待，进度推送（/api/events）直接用 asyncio 实现，
+大量空闲的长连接和慢速下载不占用线程。转换和 exiftool 仍由后台转换工作池执行。
+请求体在事件循环中接收完毕后才交给 Flask，慢速上传同样不占用线程；分块上传的分块保存在内存中，
+之后和 run_server.py 一样按文件大小写入暂存区（Config.SCRATCH_DIR）或上传目录。
+队列已满（429）和分块过大（413）的上传在接收数据之前拒绝（precheck_upload）。
+
+启动：python3 run_asgi.py（需要 pip install uvicorn），
+或使用任意 ASGI 服务器，例如 uvicorn run_asgi:app --host 0.0.0.0 --port 5221
+"""
+import sys
+import json
+from urllib.parse import parse_qs
+
+import Config
+from run_server import app as flask_app, event_bus, job_queue
+from AsgiBridge import AsgiBridge
+
+
+async def _send_json(send, status, data, headers=()):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode('latin-1'))] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+
+
+async def precheck_upload(scope, send):
+    """
+    在接收请求体之前拒绝上传，响应与 run_server 中对应视图的相同
+
+    - POST /upload、/upload/init：转换队列已满时返回 429；
+    - PUT /upload/<upload_id>：缺少 Content-Length 返回 411，超过 Config.UPLOAD_MAX_CHUNK_SIZE 返回 413。
+    其余检查（用户、偏移等）仍由 Flask 视图完成。
+
+    :return: 已发送响应时返回True
+    """
+    method, path = scope['method'], scope['path']
+    if method == 'POST' and path in ('/upload', '/upload/init'):
+        if job_queue.is_full():
+            retry_after = job_queue.retry_after()
+            await _send_json(send, 429, {'error': '服务器繁忙，请稍后重试', 'retry_after': retry_after},
+                             [(b'retry-after', str(retry_after).encode('latin-1'))])
+            return True
+    elif method == 'PUT' and path.startswith('/upload/'):
+        headers = dict(scope.get('headers', []))
+        length = headers.get(b'content-length', b'').decode('latin-1')
+        if not length.isdigit():
+            await _send_json(send, 411, {'error': '缺少 Content-Length'})
+            return True
+        if int(length) > Config.UPLOAD_MAX_CHUNK_SIZE:
+            await _send_json(send, 413, {'error': '分块过大'})
+            return True
+    return False
+
+
+async def stream_events(scope, send):
+    """
+    /api/events 的异步实现，参数和响应与 run_server.stream_events 相同
+
+    等待新事件时不占用线程；客户端断开后在下一次发送（最迟一个保活间隔）时结束。
+    """
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    user_id = query.get('user_id', [None])[0]
+    if not user_id:
+        await _send_json(send, 400, {'error': '缺少用户标识'})
+        return
+
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+    last_event_id = headers.get('last-event-id') or query.get('last_event_id', [None])[0]
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                            (b'cache-control', b'no-cache'),
+                            # 关闭反向代理（nginx）的响应缓冲，事件立即送达
+                            (b'x-accel-buffering', b'no')]})
+    events = event_bus.stream_async(user_id, last_event_id)
+    try:
+        async for text in events:
+            if send.disconnected:
+                return
+            await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+    finally:
+        await events.aclose()
+
+
+app = AsgiBridge(flask_app, routes={('GET', '/api/events'): stream_events}, precheck=precheck_upload)
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("ASGI 模式需要安装 uvicorn：pip3 install uvicorn")
+        sys.exit(1)
+    uvicorn.run(app, host='0.0.0.0', port=5221)
@@ -1,65 +1,83 @@
 import os
+import io
 import uuid
-import hashlib
-import shutil
 import time
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, send_file, render_template, jsonify, send_from_directory
 from werkzeug.utils import secure_filename
-from Apply import process_file
-from DNGToJPG import convert_dng_to_jpg
+from Apply import process_file, CONVERSION_SETTINGS
+from PreviewCache import PreviewCache, VARIANT_FULL
+from ConversionCache import ConversionCache, cache_key, link_or_copy
+from UploadStream import (HashingRequest, ChunkStore, OffsetMismatch, received_hash, received_fingerprint,
+                          file_fingerprint, save_upload, discard_uploads, calculate_file_hash)
+from JobQueue import JobQueue, QueueFull, FINISHED_STATES, STATE_DONE, STATE_FAILED, STATE_CONVERTING, STATE_TAGGING
+from FileIndex import FileIndex
+from Janitor import Janitor
+from ScratchSpace import ScratchSpace
+from EventBus import EventBus, EVENT_RECEIVED, EVENT_HASHED, EVENT_DONE, EVENT_PREVIEW_READY
+import AccessToken
+import Metrics
+from ZipStream import stream_zip, unique_arcnames
+from DNGConverter import convert_many
+from CameraMatching import modify_camera_info_batch
+import Config
 
 app = Flask(__name__)
 
 # 配置上传和输出目录
 UPLOAD_FOLDER = 'upload'
+
+# 上传文件在解析请求时直接写入上传目录并同时计算哈希
+HashingRequest.upload_folder = UPLOAD_FOLDER
+app.request_class = HashingRequest
 OUTPUT_FOLDER = 'output'
+PREVIEW_CACHE_FOLDER = 'preview_cache'
+CONVERSION_CACHE_FOLDER = 'conversion_cache'
+# 上传前预检查（/api/precheck）每次最多查询的文件数
+PRECHECK_MAX_FILES = 1000
 ALLOWED_EXTENSIONS = {'.raw', '.cr2', '.cr3', '.nef', '.arw', '.orf', '.rw2', '.raf'}
 
-# 存储文件访问令牌的字典，格式为 {user_id: {filename: token}}
-file_tokens = {}
-
-# 存储已处理文件的哈希值，格式为 {user_id: {file_hash}}
-processed_files_hash = {}
-
-# 存储用户文件映射，格式为 {user_id: {original_filename: unique_filename}}
-user_files = {}
+# 用户、输出文件（原始文件名、内容哈希）和转换任务的持久化索引，
+# 多个服务进程共享，重启后不丢失
+file_index = FileIndex(Config.INDEX_DB_PATH)
 
-def clear_directories():
-    """清空上传和输出目录"""
-    # 清空上传目录
-    if os.path.exists(UPLOAD_FOLDER):
-        shutil.rmtree(UPLOAD_FOLDER)
+def init_directories():
+    """确保上传和输出目录存在（已有的文件保留，由后台清理线程核对和清理）"""
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    
-    # 清空输出目录
-    if os.path.exists(OUTPUT_FOLDER):
-        shutil.rmtree(OUTPUT_FOLDER)
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-    
-    # 清空文件令牌和哈希值
-    file_tokens.clear()
-    processed_files_hash.clear()
-    user_files.clear()
-    
-    print("已清空上传和输出目录")
 
-# 确保上传和输出目录存在
-clear_directories()
+init_directories()
 
-def calculate_file_hash(file_path):
-    """计算文件的MD5哈希值"""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+# 中间文件暂存区（Config.SCRATCH_DIR，例如 tmpfs）：每个文件按大小决定在暂存区还是磁盘上接收和转换
+scratch = ScratchSpace(Config.SCRATCH_DIR, Config.SCRATCH_BUDGET, Config.SCRATCH_MAX_FILE_SIZE)
 
-def is_file_processed(user_id, file_hash):
-    """检查文件是否已经处理过"""
-    if user_id not in processed_files_hash:
-        processed_files_hash[user_id] = set()
-        return False
-    return file_hash in processed_files_hash[user_id]
+# 按用户推送的进度事件（/api/events）
+event_bus = EventBus(file_index)
+
+# 预览图尺寸档位
+PREVIEW_VARIANTS = {
+    'thumb': Config.PREVIEW_THUMB_SIZE,
+    'medium': Config.PREVIEW_MEDIUM_SIZE,
+    VARIANT_FULL: None
+}
+
+# 预览图缓存（以内容哈希为键，重启后磁盘层仍然有效）
+preview_cache = PreviewCache(PREVIEW_CACHE_FOLDER, PREVIEW_VARIANTS,
+                             Config.PREVIEW_MEMORY_BUDGET, Config.PREVIEW_DISK_BUDGET)
+
+# 转换完成后预先生成的预览图档位，在独立的线程中执行，与下一个文件的转换重叠
+PREVIEW_WARM_VARIANTS = [variant.strip() for variant in Config.PREVIEW_WARM_VARIANTS.split(',')
+                         if variant.strip() in PREVIEW_VARIANTS]
+preview_executor = ThreadPoolExecutor(max_workers=Config.PREVIEW_WORKERS, thread_name_prefix='preview')
+
+def find_processed_file(user_id, file_hash):
+    """返回用户已有的同内容转换结果的文件名，不存在时返回None"""
+    unique_filename = file_index.find_by_hash(user_id, file_hash)
+    if unique_filename and os.path.exists(os.path.join(OUTPUT_FOLDER, unique_filename)):
+        return unique_filename
+    return None
 
 def generate_unique_filename(user_id, original_filename):
     """生成唯一的文件名"""
@@ -72,6 +90,237 @@ def generate_unique_filename(user_id, original_filename):
 def allowed_file(filename):
     return os.path.splitext(filename)[1].lower() in ALLOWED_EXTENSIONS
 
+def warm_previews(user_id, file_hash, dng_filename):
+    """生成预览图放入缓存，完成后推送 preview_ready 事件（在预览线程中执行）"""
+    started = time.time()
+    try:
+        variants = preview_cache.warm(file_hash, os.path.join(OUTPUT_FOLDER, dng_filename), PREVIEW_WARM_VARIANTS)
+    except Exception as e:
+        print(f"预生成预览图时出错: {e}")
+        return
+    if variants:
+        event_bus.publish(user_id, EVENT_PREVIEW_READY, unique_filename=dng_filename, variants=variants,
+                          stage_seconds=round(time.time() - started, 3))
+
+def finish_conversion_job(job):
+    """转换成功后放入全局缓存、登记文件映射，并提交预览图生成"""
+    output_filename = job['unique_filename']
+    # 转换结果放入全局缓存，相同内容的RAW以后不再转换
+    conversion_cache.store(cache_key(job['file_hash'], CONVERSION_SETTINGS),
+                           os.path.join(OUTPUT_FOLDER, output_filename))
+    file_index.add_file(job['user_id'], job['original_dng_filename'], output_filename, job['file_hash'],
+                        job.get('fingerprint'))
+    if PREVIEW_WARM_VARIANTS:
+        preview_executor.submit(warm_previews, job['user_id'], job['file_hash'], output_filename)
+
+def settle_followers(job, succeeded):
+    """领头任务结束后，把转换结果交给等待同一内容的其他用户的任务"""
+    key = cache_key(job['file_hash'], CONVERSION_SETTINGS)
+    with in_flight_lock:
+        entry = in_flight.pop(key, None)
+    if entry is None:
+        return
+    source_path = os.path.join(OUTPUT_FOLDER, job['unique_filename'])
+    for follower in entry['followers']:
+        output_path = os.path.join(OUTPUT_FOLDER, follower['unique_filename'])
+        if succeeded and not conversion_cache.materialize(key, output_path):
+            # 文件超出缓存预算等情况下没有进入缓存，直接复制领头任务的结果
+            try:
+                link_or_copy(source_path, output_path)
+            except OSError as e:
+                print(f"复制转换结果失败: {e}")
+                succeeded = False
+        if succeeded:
+            file_index.add_file(follower['user_id'], follower['original_dng_filename'],
+                                follower['unique_filename'], follower['file_hash'], follower.get('fingerprint'))
+            job_queue.set_state(follower['job_id'], STATE_DONE)
+        else:
+            job_queue.set_state(follower['job_id'], STATE_FAILED, '文件转换失败')
+
+def work_folder(job):
+    """
+    选择任务的转换目录：暂存区有空间时在暂存区中转换和修改相机信息，完成后只把最终的DNG写入输出目录
+
+    预留RAW大小两倍的空间，容纳转换出的DNG和 exiftool 改写时的临时文件。
+    """
+    try:
+        size = os.path.getsize(job['file_path'])
+    except OSError:
+        size = None
+    if scratch.enabled and scratch.reserve(job['job_id'], size, 'convert', multiple=2):
+        return scratch.work
+    return OUTPUT_FOLDER
+
+def publish_output(job, folder):
+    """把暂存区中修改好相机信息的DNG移动到输出目录，返回是否成功"""
+    if folder == OUTPUT_FOLDER:
+        return True
+    try:
+        scratch.publish(os.path.join(folder, job['unique_filename']),
+                        os.path.join(OUTPUT_FOLDER, job['unique_filename']))
+        return True
+    except OSError as e:
+        print(f"移动转换结果到输出目录失败: {e}")
+        return False
+
+def run_conversion_jobs(jobs):
+    """
+    后台执行转换任务。单个任务逐步处理；多个任务时批量调用转换器并合并修改相机信息
+
+    :param jobs: 任务字典列表，包含 user_id、file_path、file_hash、unique_filename、original_dng_filename
+    :return: {job_id: 是否成功}
+    """
+    results = {}
+    folders = {job['job_id']: work_folder(job) for job in jobs}
+    try:
+        if len(jobs) == 1:
+            job = jobs[0]
+            folder = folders[job['job_id']]
+            results[job['job_id']] = process_file(
+                job['file_path'], folder,
+                on_stage=lambda stage: job_queue.set_state(job['job_id'], stage)) and publish_output(job, folder)
+        else:
+            for job in jobs:
+                job_queue.set_state(job['job_id'], STATE_CONVERTING)
+            converted = {}
+            # 在暂存区和输出目录中转换的文件分别调用转换器
+            for folder in set(folders.values()):
+                group = [job['file_path'] for job in jobs if folders[job['job_id']] == folder]
+                converted.update(convert_many(group, folder))
+            produced = [job for job in jobs if converted.get(job['file_path'])]
+            for job in produced:
+                job_queue.set_state(job['job_id'], STATE_TAGGING)
+            tagged = modify_camera_info_batch([converted[job['file_path']] for job in produced])
+            for job in produced:
+                results[job['job_id']] = tagged.get(converted[job['file_path']], False) and \
+                    publish_output(job, folders[job['job_id']])
+
+        for job in jobs:
+            if results.get(job['job_id']):
+                finish_conversion_job(job)
+        return results
+    finally:
+        for job in jobs:
+            settle_followers(job, results.get(job['job_id'], False))
+            # 删除上传的原始文件和暂存区中失败任务的残留文件
+            if os.path.exists(job['file_path']):
+                os.remove(job['file_path'])
+            if folders[job['job_id']] != OUTPUT_FOLDER:
+                staged_path = os.path.join(folders[job['job_id']], job['unique_filename'])
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+                scratch.release(job['job_id'])
+
+# 分块上传的数据直接写入上传目录（或暂存区）
+chunk_store = ChunkStore(UPLOAD_FOLDER, scratch)
+
+# 全局转换缓存（以RAW内容哈希和转换设置为键，所有用户共享）
+conversion_cache = ConversionCache(CONVERSION_CACHE_FOLDER, Config.CONVERSION_CACHE_BUDGET)
+
+# 正在转换的内容：{转换缓存键: {'job': 领头任务, 'followers': [等待同一结果的其他用户的任务]}}
+# 相同内容在转换完成前再次上传时不再转换，而是等待领头任务的结果（限本进程提交的任务）
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+def publish_job_event(job, state, error, now):
+    """把任务状态变化（converting/tagging/done/failed）连同各阶段耗时推送给用户"""
+    Metrics.registry.inc('webraw_jobs_total', state=state)
+    event_bus.publish(
+        job['user_id'], state,
+        job_id=job['job_id'],
+        filename=job['original_dng_filename'],
+        unique_filename=job['unique_filename'],
+        error=error,
+        stage_seconds=round(now - job['updated_at'], 3),
+        total_seconds=round(now - job['created_at'], 3),
+        time=now
+    )
+
+# 后台转换工作池
+job_queue = JobQueue(run_conversion_jobs, Config.CONVERSION_WORKERS, Config.JOB_RETENTION_SECONDS,
+                     batch_size=Config.CONVERTER_BATCH_MAX_FILES, store=file_index,
+                     listener=publish_job_event, max_pending=Config.QUEUE_MAX_PENDING)
+
+# 接管上次运行（或已退出的其他服务进程）未完成的任务，上传文件已不在的任务
+# 和等待其他任务结果的任务标记为失败
+recovered_jobs = job_queue.recover(is_valid=lambda job: job['file_path'] and os.path.exists(job['file_path']))
+if recovered_jobs:
+    print(f"已重新排队 {recovered_jobs} 个未完成的转换任务")
+
+# 本进程的指标（/metrics），多个服务进程时由采集端按实例汇总
+Metrics.registry.describe('webraw_files_total', 'counter', '接收的文件数（按结果 skipped/cached/attached/queued/rejected）')
+Metrics.registry.describe('webraw_jobs_total', 'counter', '转换任务进入各状态的次数')
+Metrics.registry.describe('webraw_upload_bytes_total', 'counter', '接收的上传字节数')
+Metrics.registry.describe('webraw_download_bytes_total', 'counter', '发送的下载字节数')
+Metrics.registry.gauge('webraw_queue_depth', '等待转换的任务数', lambda: job_queue.pending.qsize())
+Metrics.registry.gauge('webraw_preview_cache_bytes', '预览图磁盘缓存字节数',
+                       lambda: preview_cache.stats()['disk_bytes'])
+Metrics.registry.gauge('webraw_conversion_cache_bytes', '转换缓存字节数',
+                       lambda: conversion_cache.stats()['bytes'])
+
+def download_name(record, filename):
+    """返回下载时使用的文件名（原始文件名，扩展名为 .dng）"""
+    original_filename = record['original_filename']
+    if not original_filename:
+        return filename
+    if not original_filename.lower().endswith('.dng'):
+        original_filename = os.path.splitext(original_filename)[0] + '.dng'
+    return original_filename
+
+def remove_output(filename):
+    """下载完成后删除输出文件和索引记录（预览图和转换缓存中的副本由LRU淘汰）"""
+    file_path = os.path.join(os.path.abspath(OUTPUT_FOLDER), filename)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    conversion_cache.release(file_path)
+    file_index.remove_file(filename)
+
+def on_body_closed(response, callback):
+    """
+    在响应体关闭后调用 callback
+
+    send_file 的响应体直接交给服务器的 wsgi.file_wrapper 发送，
+    Werkzeug 不会调用 response.call_on_close 注册的函数，因此挂在响应体的 close 上。
+    """
+    body = response.response
+    close = body.close
+    def close_and_call():
+        try:
+            close()
+        finally:
+            callback()
+    body.close = close_and_call
+
+# 后台清理：按TTL和字节预算清理输出目录，清理孤立文件、过期的分块上传和进度事件
+janitor = Janitor(file_index, chunk_store, OUTPUT_FOLDER, UPLOAD_FOLDER, remove_output,
+                  [scratch.incoming, scratch.work] if scratch.enabled else ())
+janitor.start()
+Metrics.registry.gauge('webraw_output_bytes', '输出目录字节数（最近一次清理时）',
+                       lambda: janitor.stats().get('output_bytes', 0))
+Metrics.registry.gauge('webraw_upload_bytes', '上传目录字节数（最近一次清理时）',
+                       lambda: janitor.stats().get('upload_bytes', 0))
+Metrics.registry.gauge('webraw_scratch_bytes', '暂存区字节数', scratch.usage)
+
+def queue_full_response(retry_after):
+    """转换队列已满时的响应：429，客户端在 Retry-After 秒后重试"""
+    response = jsonify({'error': '服务器繁忙，请稍后重试', 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def job_to_dict(job):
+    """返回任务中可以公开给前端的字段"""
+    return {
+        'job_id': job['job_id'],
+        'filename': job['original_dng_filename'],
+        'unique_filename': job['unique_filename'],
+        'state': job['state'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+        'timings': job.get('timings', {})
+    }
+
 @app.route('/')
 def index():
     # 获取已处理的文件列表
@@ -80,119 +329,464 @@ def index():
 
 @app.route('/api/files', methods=['GET'])
 def get_user_files():
-    """获取用户的文件列表"""
+    """获取用户的文件列表（包含仍在排队或处理中的文件）"""
     user_id = request.args.get('user_id')
     if not user_id:
         return jsonify({'error': '缺少用户标识'}), 400
     
-    if user_id not in user_files:
-        return jsonify({'files': []})
-    
     # 返回用户的文件列表和对应的访问令牌
     user_file_list = []
-    for original_file, unique_file in user_files[user_id].items():
+    for record in file_index.user_files(user_id):
+        unique_file = record['unique_filename']
         if unique_file.endswith('.dng') and os.path.exists(os.path.join(OUTPUT_FOLDER, unique_file)):
-            # 为每个文件生成新的访问令牌
-            if user_id not in file_tokens:
-                file_tokens[user_id] = {}
-            
-            access_token = str(uuid.uuid4())
-            file_tokens[user_id][unique_file] = access_token
-            
+            # 签名令牌在有效期内保持不变，无需保存
             user_file_list.append({
-                'filename': original_file,
+                'filename': record['original_filename'],
                 'unique_filename': unique_file,
-                'token': access_token
+                'token': AccessToken.issue(user_id, unique_file),
+                'state': STATE_DONE
             })
     
+    # 追加尚未完成的任务（排队中、转换中、失败等）
+    for job in job_queue.user_jobs(user_id):
+        if job['state'] != STATE_DONE:
+            item = job_to_dict(job)
+            item['token'] = None
+            user_file_list.append(item)
+    
     return jsonify({'files': user_file_list})
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    # 获取用户标识
-    user_id = request.form.get('user_id')
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """
+    以 Server-Sent Events 推送用户文件的处理进度
+
+    事件类型：received、hashed、converting、tagging、done、failed，数据为JSON（包含各阶段耗时）。
+    重连时浏览器会带上 Last-Event-ID，服务器补发之后的事件。
+    """
+    user_id = request.args.get('user_id')
     if not user_id:
         return jsonify({'error': '缺少用户标识'}), 400
     
-    if 'files' not in request.files:
-        return jsonify({'error': '没有选择文件'}), 400
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
     
-    # 初始化用户的数据结构
-    if user_id not in processed_files_hash:
-        processed_files_hash[user_id] = set()
+    response = app.response_class(event_bus.stream(user_id, last_event_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # 关闭反向代理（nginx）的响应缓冲，事件立即送达
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/precheck', methods=['POST'])
+def precheck_files():
+    """
+    上传前检查：客户端提交文件的抽样指纹，服务器返回哪些文件已经转换或正在处理，客户端只上传其余的文件
+
+    请求体为JSON：{"user_id": ..., "fingerprints": [...]}，每次最多 PRECHECK_MAX_FILES 个。
+    只查询该用户自己的文件和任务。返回 {"results": {指纹: {"status": converted/processing/missing, ...}}}。
+    """
+    data = request.get_json(silent=True) or {}
+    user_id = data.get('user_id')
+    if not user_id:
+        return jsonify({'error': '缺少用户标识'}), 400
     
-    if user_id not in user_files:
-        user_files[user_id] = {}
+    fingerprints = data.get('fingerprints')
+    if not isinstance(fingerprints, list) or len(fingerprints) > PRECHECK_MAX_FILES:
+        return jsonify({'error': f'fingerprints 必须是不超过 {PRECHECK_MAX_FILES} 个指纹的列表'}), 400
     
-    if user_id not in file_tokens:
-        file_tokens[user_id] = {}
+    processing = {job['fingerprint']: job for job in job_queue.user_jobs(user_id)
+                  if job['state'] not in FINISHED_STATES and job.get('fingerprint')}
+    results = {}
+    for fingerprint in fingerprints:
+        if not isinstance(fingerprint, str):
+            continue
+        unique_filename = file_index.find_by_fingerprint(user_id, fingerprint)
+        if unique_filename and os.path.exists(os.path.join(OUTPUT_FOLDER, unique_filename)):
+            results[fingerprint] = {'status': 'converted', 'unique_filename': unique_filename}
+        elif fingerprint in processing:
+            job = processing[fingerprint]
+            results[fingerprint] = {'status': 'processing', 'unique_filename': job['unique_filename'],
+                                    'job_id': job['job_id']}
+        else:
+            results[fingerprint] = {'status': 'missing'}
     
-    files = request.files.getlist('files')
-    processed_files = []
-    file_tokens_list = []
-    skipped_files = []
-    original_to_unique = {}
+    return jsonify({'results': results})
+
+@app.route('/api/storage', methods=['GET'])
+def get_storage_stats():
+    """输出目录、上传目录和各缓存的用量，以及后台清理的统计"""
+    return jsonify({
+        'janitor': janitor.stats(),
+        'scratch': scratch.stats(),
+        'preview_cache': preview_cache.stats(),
+        'conversion_cache': conversion_cache.stats()
+    })
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """查询单个转换任务的状态"""
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'error': '缺少用户标识'}), 400
     
-    for file in files:
-        if file and allowed_file(file.filename):
-            original_filename = secure_filename(file.filename)
-            # 确保原始文件名有.dng扩展名
-            original_dng_filename = original_filename
-            if not original_dng_filename.lower().endswith('.dng'):
-                original_dng_filename = os.path.splitext(original_filename)[0] + '.dng'
-            
-            # 生成唯一的文件名
-            unique_filename = generate_unique_filename(user_id, original_filename)
-            file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-            file.save(file_path)
-            
-            # 计算文件哈希值
-            file_hash = calculate_file_hash(file_path)
-            
-            # 检查文件是否已处理
-            if is_file_processed(user_id, file_hash):
-                output_filename = os.path.splitext(unique_filename)[0] + '.dng'
-                skipped_files.append(original_dng_filename)
-                # 为已处理的文件生成新的访问令牌
-                access_token = str(uuid.uuid4())
-                file_tokens[user_id][output_filename] = access_token
-                processed_files.append(original_dng_filename)
-                file_tokens_list.append(access_token)
-                # 记录原始文件名到唯一文件名的映射
-                original_to_unique[original_dng_filename] = output_filename
-            else:
-                # 处理新文件
-                if process_file(file_path, OUTPUT_FOLDER):
-                    output_filename = os.path.splitext(unique_filename)[0] + '.dng'
-                    # 为每个文件生成唯一的访问令牌
-                    access_token = str(uuid.uuid4())
-                    file_tokens[user_id][output_filename] = access_token
-                    processed_files.append(original_dng_filename)
-                    file_tokens_list.append(access_token)
-                    # 记录已处理的文件哈希值
-                    processed_files_hash[user_id].add(file_hash)
-                    # 记录原始文件名到唯一文件名的映射
-                    original_to_unique[original_dng_filename] = output_filename
-            
-            # 删除上传的原始文件
-            os.remove(file_path)
+    job = job_queue.get(job_id)
+    if job is None or job['user_id'] != user_id:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    return jsonify(job_to_dict(job))
+
+def accept_file(user_id, filename, compute_hash, compute_fingerprint, save):
+    """
+    处理一个已完整接收的上传文件：已有结果时跳过，全局缓存命中时直接得到结果，否则提交转换任务
+
+    :param user_id: 用户标识
+    :param filename: 安全处理后的原始文件名
+    :param compute_hash: 返回文件内容哈希的函数
+    :param compute_fingerprint: 返回文件抽样指纹的函数（记录下来供上传前预检查）
+    :param save: 把上传数据改名为指定文件名并返回保存后路径的函数（仅在需要转换时调用，
+                 文件留在接收数据的目录中，上传目录或暂存区）
+    :return: (结果类型 skipped/cached/attached/queued, 原始DNG文件名, 唯一文件名, 任务字典或None)
+    :raises QueueFull: 需要转换但转换队列已满（上传数据不会被移动）
+    """
+    # 确保原始文件名有.dng扩展名
+    original_dng_filename = filename
+    if not original_dng_filename.lower().endswith('.dng'):
+        original_dng_filename = os.path.splitext(filename)[0] + '.dng'
+    
+    # 生成唯一的文件名
+    unique_filename = generate_unique_filename(user_id, filename)
+    output_filename = os.path.splitext(unique_filename)[0] + '.dng'
+    event_bus.publish(user_id, EVENT_RECEIVED, filename=original_dng_filename)
+    
+    started = time.time()
+    with Metrics.span('hash'):
+        file_hash = compute_hash()
+        fingerprint = compute_fingerprint()
+    hash_seconds = round(time.time() - started, 3)
+    
+    def publish_hashed(status, result_filename, job_id=None):
+        event_bus.publish(user_id, EVENT_HASHED, filename=original_dng_filename, unique_filename=result_filename,
+                          status=status, job_id=job_id, stage_seconds=hash_seconds)
+    
+    # 检查用户是否已有同内容的转换结果
+    existing_filename = find_processed_file(user_id, file_hash)
+    if existing_filename:
+        Metrics.registry.inc('webraw_files_total', result='skipped')
+        publish_hashed('skipped', existing_filename)
+        return 'skipped', original_dng_filename, existing_filename, None
+    
+    if conversion_cache.materialize(cache_key(file_hash, CONVERSION_SETTINGS),
+                                    os.path.join(OUTPUT_FOLDER, output_filename)):
+        # 全局缓存命中，直接得到转换结果
+        file_index.add_file(user_id, original_dng_filename, output_filename, file_hash, fingerprint)
+        Metrics.registry.inc('webraw_files_total', result='cached')
+        publish_hashed('cached', output_filename)
+        event_bus.publish(user_id, EVENT_DONE, filename=original_dng_filename, unique_filename=output_filename,
+                          cached=True)
+        return 'cached', original_dng_filename, output_filename, None
     
-    # 更新用户文件映射
-    for original, unique in original_to_unique.items():
-        user_files[user_id][original] = unique
+    key = cache_key(file_hash, CONVERSION_SETTINGS)
+    with in_flight_lock:
+        entry = in_flight.get(key)
+        if entry is not None:
+            # 相同内容正在转换：同一用户直接使用已有的任务（领头任务或之前登记的等待任务），
+            # 其他用户登记一个等待结果的任务
+            job = next((job for job in [entry['job']] + entry['followers'] if job['user_id'] == user_id), None)
+            if job is None:
+                job = job_queue.submit(
+                    user_id,
+                    enqueue=False,
+                    file_path=None,
+                    file_hash=file_hash,
+                    fingerprint=fingerprint,
+                    unique_filename=output_filename,
+                    original_dng_filename=original_dng_filename,
+                    leader_job_id=entry['job']['job_id'],
+                    timings={'hash': hash_seconds}
+                )
+                entry['followers'].append(job)
+            Metrics.registry.inc('webraw_files_total', result='attached')
+            publish_hashed('attached', job['unique_filename'], job['job_id'])
+            return 'attached', original_dng_filename, job['unique_filename'], job
+        
+        if job_queue.is_full():
+            Metrics.registry.inc('webraw_files_total', result='rejected')
+            raise QueueFull(job_queue.retry_after())
+        
+        file_path = save(unique_filename)
+        # 提交后台转换任务，立即返回任务ID
+        try:
+            job = job_queue.submit(
+                user_id,
+                file_path=file_path,
+                file_hash=file_hash,
+                fingerprint=fingerprint,
+                unique_filename=output_filename,
+                original_dng_filename=original_dng_filename,
+                timings={'hash': hash_seconds}
+            )
+        except QueueFull:
+            # 其他请求同时占满了队列
+            os.remove(file_path)
+            Metrics.registry.inc('webraw_files_total', result='rejected')
+            raise
+        in_flight[key] = {'job': job, 'followers': []}
+    Metrics.registry.inc('webraw_files_total', result='queued')
+    publish_hashed('queued', output_filename, job['job_id'])
+    return 'queued', original_dng_filename, output_filename, job
+
+def upload_summary(results, rejected_files=()):
+    """
+    汇总 accept_file 的结果作为上传接口的响应
+
+    :param results: accept_file 返回值的列表
+    :param rejected_files: 因转换队列已满而没有处理的文件名
+    """
+    jobs = []
+    skipped_files = []
+    cached_files = []
+    original_to_unique = {}
+    for status, original_dng_filename, unique_filename, job in results:
+        if status == 'skipped':
+            skipped_files.append(original_dng_filename)
+        elif status == 'cached':
+            cached_files.append(original_dng_filename)
+        else:
+            jobs.append(job_to_dict(job))
+        original_to_unique[original_dng_filename] = unique_filename
     
-    message = f'成功处理 {len(processed_files)} 个文件'
+    message = f'已接收 {len(jobs)} 个文件，正在后台处理'
+    if cached_files:
+        message += f'，{len(cached_files)} 个文件已有转换结果'
     if skipped_files:
         message += f'，跳过 {len(skipped_files)} 个已处理的文件'
+    if rejected_files:
+        message += f'，{len(rejected_files)} 个文件因服务器繁忙未处理，请稍后重新上传'
     
-    # 返回原始文件名和对应的令牌
-    return jsonify({
+    # 返回任务列表和原始文件名映射
+    return {
         'message': message,
+        'jobs': jobs,
         'processed_files': list(original_to_unique.keys()),
-        'file_tokens': file_tokens_list,
         'skipped_files': skipped_files,
+        'cached_files': cached_files,
+        'rejected_files': list(rejected_files),
         'file_mapping': original_to_unique
-    })
+    }
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    # 转换队列已满时在接收上传数据之前拒绝
+    if job_queue.is_full():
+        return queue_full_response(job_queue.retry_after())
+    
+    # 请求不大且暂存区有空间时，上传数据直接写入暂存区
+    reservation = uuid.uuid4().hex
+    staged = scratch.enabled and scratch.reserve(reservation, request.content_length, 'upload')
+    receive_folder = scratch.incoming if staged else UPLOAD_FOLDER
+    request.upload_folder = receive_folder
+    try:
+        return receive_upload(receive_folder)
+    finally:
+        # 文件已经写完（或已删除），之后按暂存区中的实际大小计算
+        scratch.release(reservation)
+
+def receive_upload(receive_folder):
+    """
+    解析 multipart 请求并处理其中的文件
+
+    :param receive_folder: 上传数据写入的目录（上传目录或暂存区）
+    """
+    # 解析请求体时接收上传数据并计算哈希
+    with Metrics.span('receive'):
+        form = request.form
+    Metrics.registry.inc('webraw_upload_bytes_total', request.content_length or 0)
+    
+    try:
+        # 获取用户标识
+        user_id = form.get('user_id')
+        if not user_id:
+            return jsonify({'error': '缺少用户标识'}), 400
+        
+        if 'files' not in request.files:
+            return jsonify({'error': '没有选择文件'}), 400
+        
+        # 登记用户
+        file_index.touch_user(user_id)
+        
+        results = []
+        rejected_files = []
+        retry_after = None
+        for file in request.files.getlist('files'):
+            if file and allowed_file(file.filename):
+                # 哈希值在接收上传数据时已经算好
+                try:
+                    results.append(accept_file(user_id, secure_filename(file.filename),
+                                               lambda file=file: received_hash(file),
+                                               lambda file=file: received_fingerprint(file),
+                                               lambda filename, file=file: save_upload(
+                                                   file, os.path.join(receive_folder, filename))))
+                except QueueFull as e:
+                    rejected_files.append(file.filename)
+                    retry_after = e.retry_after
+        
+        if rejected_files and not results:
+            return queue_full_response(retry_after)
+        return jsonify(upload_summary(results, rejected_files)), 202
+    finally:
+        # 删除未保存的上传临时文件（提前返回时的全部文件，以及已处理过的、扩展名不支持的或队列已满未处理的）
+        discard_uploads(request.files)
+
+@app.route('/upload/init', methods=['POST'])
+def init_chunked_upload():
+    """
+    开始一个分块上传
+
+    参数：user_id、filename、size（字节数）。返回 upload_id，之后按顺序用 PUT 上传分块。
+    """
+    user_id = request.values.get('user_id')
+    if not user_id:
+        return jsonify({'error': '缺少用户标识'}), 400
+    
+    filename = request.values.get('filename', '')
+    if not allowed_file(filename):
+        return jsonify({'error': f'不支持的文件类型: {filename}'}), 400
+    
+    # 转换队列已满时不开始新的上传
+    if job_queue.is_full():
+        return queue_full_response(job_queue.retry_after())
+    
+    try:
+        size = int(request.values.get('size', ''))
+    except ValueError:
+        size = 0
+    if size <= 0:
+        return jsonify({'error': '无效的文件大小'}), 400
+    
+    file_index.touch_user(user_id)
+    upload_id = uuid.uuid4().hex
+    chunk_store.create(upload_id, size)
+    file_index.add_upload(upload_id, user_id, secure_filename(filename), size)
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': 0,
+        'size': size,
+        'chunk_size': Config.UPLOAD_MAX_CHUNK_SIZE
+    }), 201
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    """查询分块上传已收到的字节数（断点续传的起始位置）"""
+    user_id = request.args.get('user_id')
+    upload = file_index.get_upload(user_id, upload_id) if user_id else None
+    offset = chunk_store.offset(upload_id) if upload else None
+    if offset is None:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    
+    return jsonify({'upload_id': upload_id, 'filename': upload['filename'], 'size': upload['size'], 'offset': offset})
+
+@app.route('/upload/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """
+    上传一个分块，请求体为原始数据
+
+    查询参数 offset 必须等于服务器已收到的字节数，否则返回 409 和当前偏移。
+    """
+    user_id = request.args.get('user_id')
+    upload = file_index.get_upload(user_id, upload_id) if user_id else None
+    if upload is None or chunk_store.offset(upload_id) is None:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return jsonify({'error': '缺少分块偏移'}), 400
+    
+    length = request.content_length
+    if length is None:
+        return jsonify({'error': '缺少 Content-Length'}), 411
+    if length > Config.UPLOAD_MAX_CHUNK_SIZE or offset + length > upload['size']:
+        return jsonify({'error': '分块过大'}), 413
+    
+    try:
+        # 偏移不一致是客户端续传时的正常情况，不计入失败
+        with Metrics.span('upload_chunk', expected=OffsetMismatch):
+            new_offset = chunk_store.append(upload_id, offset, request.stream, length)
+    except OffsetMismatch as e:
+        return jsonify({'error': '分块偏移不一致', 'offset': e.offset}), 409
+    Metrics.registry.inc('webraw_upload_bytes_total', new_offset - offset)
+    
+    file_index.touch_upload(upload_id)
+    return jsonify({'upload_id': upload_id, 'offset': new_offset, 'size': upload['size']})
+
+@app.route('/upload/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """分块全部上传后调用：校验大小，去重并提交转换任务"""
+    user_id = request.values.get('user_id')
+    upload = file_index.get_upload(user_id, upload_id) if user_id else None
+    offset = chunk_store.offset(upload_id) if upload else None
+    if offset is None:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    
+    if offset != upload['size']:
+        return jsonify({'error': '文件尚未上传完整', 'offset': offset}), 409
+    
+    try:
+        result = accept_file(user_id, upload['filename'], lambda: chunk_store.hexdigest(upload_id),
+                             lambda: file_fingerprint(chunk_store.path(upload_id)),
+                             lambda filename: chunk_store.persist(upload_id, filename))
+    except QueueFull as e:
+        # 保留已上传的数据，客户端稍后重新调用 complete
+        file_index.touch_upload(upload_id)
+        return queue_full_response(e.retry_after)
+    # 跳过或缓存命中时数据不再需要
+    chunk_store.discard(upload_id)
+    file_index.remove_upload(upload_id)
+    
+    return jsonify(upload_summary([result])), 202
+
+@app.route('/download/batch', methods=['POST'])
+def download_batch():
+    """
+    把多个文件打包成一个ZIP流式下载
+
+    表单参数：user_id，以及顺序一一对应的多个 filename 和 token。
+    与单个文件下载一样不立即删除：全部数据发送完成后记录下载时间，客户端确认
+    （/download/<filename>/ack）或 DOWNLOAD_RETENTION_SECONDS 秒后由清理线程删除；中途断开的下载不记录。
+    """
+    user_id = request.form.get('user_id')
+    if not user_id:
+        return jsonify({'error': '缺少用户标识'}), 400
+    
+    filenames = request.form.getlist('filename')
+    tokens = request.form.getlist('token')
+    if not filenames or len(filenames) != len(tokens):
+        return jsonify({'error': '缺少文件或访问令牌'}), 400
+    
+    entries = []
+    names = []
+    for filename, token in dict(zip(filenames, tokens)).items():
+        if not AccessToken.verify(user_id, filename, token):
+            return jsonify({'error': f'无效的访问令牌: {filename}'}), 403
+        record = file_index.get_file(user_id, filename)
+        file_path = os.path.join(os.path.abspath(OUTPUT_FOLDER), filename)
+        if record is None or not os.path.exists(file_path):
+            return jsonify({'error': f'文件不存在: {filename}'}), 404
+        entries.append((filename, file_path))
+        names.append(download_name(record, filename))
+    
+    def generate():
+        yield from stream_zip([(file_path, arcname) for (_, file_path), arcname
+                               in zip(entries, unique_arcnames(names))])
+        # 最后一段数据已交给客户端，记录下载时间（保留期后删除，下载失败时可以重新下载）
+        downloaded_at = time.time()
+        for filename, _ in entries:
+            file_index.mark_downloaded(filename, downloaded_at)
+    
+    archive_name = datetime.now().strftime('webraw_%Y%m%d_%H%M%S.zip')
+    response = app.response_class(generate(), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename={archive_name}'
+    return response
 
 @app.route('/download/<filename>')
 def download_file(filename):
@@ -206,67 +800,71 @@ def download_file(filename):
     if not access_token:
         return jsonify({'error': '缺少访问令牌'}), 400
     
-    # 检查用户是否存在
-    if user_id not in file_tokens:
-        return jsonify({'error': '无效的用户标识'}), 403
-    
-    # 验证访问令牌
-    if filename not in file_tokens[user_id] or file_tokens[user_id][filename] != access_token:
+    # 验证访问令牌（签名校验，无需查询）
+    if not AccessToken.verify(user_id, filename, access_token):
         return jsonify({'error': '无效的访问令牌'}), 403
     
+    record = file_index.get_file(user_id, filename)
+    if record is None:
+        return jsonify({'error': '文件不存在'}), 404
+    
     file_path = os.path.join(os.path.abspath(OUTPUT_FOLDER), filename)
     if not os.path.exists(file_path):
         return jsonify({'error': f'文件不存在: {file_path}'}), 404
     
     try:
-        # 获取原始文件名
-        original_filename = None
-        for orig, unique in user_files[user_id].items():
-            if unique == filename:
-                original_filename = orig
-                break
-        
-        # 如果找不到原始文件名，使用唯一文件名
-        if original_filename:
-            # 确保原始文件名有正确的扩展名
-            if not original_filename.lower().endswith('.dng'):
-                original_filename = os.path.splitext(original_filename)[0] + '.dng'
-        else:
-            original_filename = filename
+        # 获取原始文件名（找不到时使用唯一文件名）
+        original_filename = download_name(record, filename)
         
         # 使用send_file发送文件，确保as_attachment=True以强制下载
+        # 按路径发送时由服务器的 wsgi.file_wrapper（如 gunicorn 的 sendfile）零拷贝传输，
+        # conditional=True 支持 ETag/If-None-Match 和 Range 断点续传
         response = send_file(
             file_path, 
             as_attachment=True,
             download_name=original_filename,
-            mimetype='application/octet-stream'  # 强制以二进制流下载
+            mimetype='application/octet-stream',  # 强制以二进制流下载
+            conditional=True,
+            etag=True,
+            max_age=0
         )
         
         # 添加额外的头信息，确保文件被下载而不是在浏览器中打开
         response.headers["Content-Disposition"] = f"attachment; filename={original_filename}"
+        response.headers["Accept-Ranges"] = "bytes"
         
-        # 下载后删除文件和令牌
-        os.remove(file_path)
-        # 删除对应的JPG文件（如果存在）
-        jpg_path = os.path.splitext(file_path)[0] + '.jpg'
-        if os.path.exists(jpg_path):
-            os.remove(jpg_path)
+        # 不立即删除：客户端确认收到（/download/<filename>/ack）后删除，
+        # 否则在最后一次下载 DOWNLOAD_RETENTION_SECONDS 秒后由清理线程删除
+        file_index.mark_downloaded(filename, time.time())
         
-        # 从用户文件映射和令牌中删除
-        if user_id in file_tokens and filename in file_tokens[user_id]:
-            del file_tokens[user_id][filename]
-        
-        # 从用户文件映射中删除
-        for orig, unique in list(user_files[user_id].items()):
-            if unique == filename:
-                del user_files[user_id][orig]
-                break
+        # 响应体发送完毕（或客户端断开）后记录下载耗时
+        started = time.perf_counter()
+        def record_download():
+            Metrics.registry.observe(Metrics.STAGE_SECONDS, time.perf_counter() - started, stage='download')
+            Metrics.registry.inc('webraw_download_bytes_total', response.content_length or 0)
+        on_body_closed(response, record_download)
         
         return response
     except Exception as e:
         print(f"下载文件时出错: {str(e)}")
         return jsonify({'error': f'文件下载错误: {str(e)}'}), 500
 
+@app.route('/download/<filename>/ack', methods=['POST'])
+def acknowledge_download(filename):
+    """客户端确认文件已完整下载，删除文件和索引记录"""
+    user_id = request.values.get('user_id')
+    if not user_id:
+        return jsonify({'error': '缺少用户标识'}), 400
+    
+    if not AccessToken.verify(user_id, filename, request.values.get('token')):
+        return jsonify({'error': '无效的访问令牌'}), 403
+    
+    if file_index.get_file(user_id, filename) is None:
+        return jsonify({'error': '文件不存在'}), 404
+    
+    remove_output(filename)
+    return jsonify({'message': '已删除'})
+
 @app.route('/preview/<filename>')
 def preview_file(filename):
     # 获取用户标识
@@ -274,55 +872,43 @@ def preview_file(filename):
     if not user_id:
         return jsonify({'error': '缺少用户标识'}), 400
     
-    # 检查用户是否存在
-    if user_id not in file_tokens:
-        return jsonify({'error': '无效的用户标识'}), 403
-    
     # 获取原始DNG文件名（如果是JPG预览）
     original_filename = filename
     if filename.lower().endswith('.jpg'):
         original_filename = filename.replace('.jpg', '.dng')
     
-    # 验证访问令牌
-    token = request.args.get('token')
-    if not token or token != file_tokens[user_id].get(original_filename):
+    # 验证访问令牌（签名校验，无需查询）
+    if not AccessToken.verify(user_id, original_filename, request.args.get('token')):
         return jsonify({'error': '无效的访问令牌'}), 403
     
-    # 如果是DNG文件，先转换为JPG
-    if filename.lower().endswith('.dng'):
-        dng_path = os.path.join(OUTPUT_FOLDER, filename)
-        jpg_path = os.path.splitext(dng_path)[0] + '.jpg'
+    # DNG 和 JPG 请求都返回对应DNG的缓存预览图
+    if filename.lower().endswith(('.dng', '.jpg')):
+        variant = request.args.get('size', VARIANT_FULL)
+        if variant not in PREVIEW_VARIANTS:
+            return jsonify({'error': f'不支持的预览尺寸: {variant}'}), 400
         
-        # 如果JPG不存在，则转换
-        if not os.path.exists(jpg_path):
-            if not convert_dng_to_jpg(dng_path, jpg_path):
-                return jsonify({'error': '预览图生成失败'}), 500
+        dng_path = os.path.join(OUTPUT_FOLDER, original_filename)
+        record = file_index.get_file(user_id, original_filename)
+        if record is None or not os.path.exists(dng_path):
+            return jsonify({'error': '找不到对应的DNG文件'}), 404
         
-        # 返回JPG预览图
-        try:
-            return send_from_directory(OUTPUT_FOLDER, os.path.basename(jpg_path), as_attachment=False)
-        except Exception as e:
-            print(f"预览DNG文件时出错: {str(e)}")
-            return jsonify({'error': str(e)}), 500
-    elif filename.lower().endswith('.jpg'):
-        # 直接返回JPG预览图
         try:
-            # 检查JPG文件是否存在，如果不存在，尝试从DNG生成
-            jpg_path = os.path.join(OUTPUT_FOLDER, filename)
-            if not os.path.exists(jpg_path):
-                dng_path = os.path.join(OUTPUT_FOLDER, original_filename)
-                if os.path.exists(dng_path):
-                    if not convert_dng_to_jpg(dng_path, jpg_path):
-                        return jsonify({'error': '预览图生成失败'}), 500
-                else:
-                    return jsonify({'error': '找不到对应的DNG文件'}), 404
+            content_hash = record['file_hash']
+            if content_hash is None:
+                content_hash = calculate_file_hash(dng_path)
+                file_index.set_file_hash(original_filename, content_hash)
             
-            # 使用原始DNG文件名对应的token
-            if token != file_tokens[user_id].get(original_filename):
-                return jsonify({'error': '无效的访问令牌'}), 403
-            return send_from_directory(OUTPUT_FOLDER, filename, as_attachment=False)
+            data = preview_cache.get(content_hash, dng_path, variant)
+            if data is None:
+                return jsonify({'error': '预览图生成失败'}), 500
+            # 预览也算一次访问，推迟清理线程删除该文件
+            file_index.touch_file(original_filename, time.time())
+            
+            response = send_file(io.BytesIO(data), mimetype='image/jpeg', max_age=3600)
+            response.set_etag(f'{content_hash}_{variant}')
+            return response.make_conditional(request)
         except Exception as e:
-            print(f"预览JPG文件时出错: {str(e)}")
+            print(f"预览文件时出错: {str(e)}")
             return jsonify({'error': str(e)}), 500
     else:
         # 其他文件直接返回
@@ -332,5 +918,10 @@ def preview_file(filename):
             print(f"预览其他文件时出错: {str(e)}")
             return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics')
+def metrics():
+    """以 Prometheus 文本格式导出本进程的指标"""
+    return app.response_class(Metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5221, debug=True)
\ No newline at end of file
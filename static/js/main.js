@@ -101,10 +101,23 @@ function loadUserFiles() {
                     document.querySelector('.processed-files').insertBefore(batchDownloadContainer, document.getElementById('fileList'));
                 }
                 
-                // 添加文件到列表
+                // 添加文件到列表（未完成的文件显示处理状态）
+                let hasPending = false;
                 data.files.forEach(file => {
-                    addFileToList(file.filename, file.unique_filename, file.token);
+                    if (file.state && file.state !== 'done') {
+                        addPendingFileToList(file);
+                        if (file.state !== 'failed') {
+                            hasPending = true;
+                        }
+                    } else {
+                        addFileToList(file.filename, file.unique_filename, file.token);
+                    }
                 });
+                
+                // 还有文件在处理时，稍后自动刷新（已连接进度事件流时由事件触发刷新）
+                if (hasPending && !isProgressStreamOpen()) {
+                    scheduleFileListRefresh();
+                }
             } else {
                 // 显示空列表提示
                 if (emptyList) {
@@ -164,13 +177,13 @@ function addFileToList(filename, uniqueFilename, token) {
     const previewImg = document.createElement('img');
     previewImg.className = 'preview-img';
     
-    // 对于DNG文件，使用jpg预览
+    // 对于DNG文件，使用jpg预览（列表中只需要缩略图尺寸）
     let previewUrl;
     if (uniqueFilename.toLowerCase().endsWith('.dng')) {
         const jpgFilename = uniqueFilename.replace('.dng', '.jpg');
-        previewUrl = `/preview/${jpgFilename}?token=${token}&user_id=${userId}`;
+        previewUrl = `/preview/${jpgFilename}?token=${token}&user_id=${userId}&size=thumb`;
     } else {
-        previewUrl = `/preview/${uniqueFilename}?token=${token}&user_id=${userId}`;
+        previewUrl = `/preview/${uniqueFilename}?token=${token}&user_id=${userId}&size=thumb`;
     }
     
     previewImg.src = previewUrl;
@@ -184,7 +197,7 @@ function addFileToList(filename, uniqueFilename, token) {
         
         // 如果是JPG预览加载失败，尝试直接使用DNG预览
         if (uniqueFilename.toLowerCase().endsWith('.dng') && previewUrl.includes('.jpg')) {
-            this.src = `/preview/${uniqueFilename}?token=${token}&user_id=${userId}`;
+            this.src = `/preview/${uniqueFilename}?token=${token}&user_id=${userId}&size=thumb`;
         } else {
             this.src = '/static/img/error.png'; // 可以添加一个默认的错误图片
             this.alt = '预览加载失败';
@@ -237,6 +250,107 @@ function addFileToList(filename, uniqueFilename, token) {
     fileList.appendChild(li);
 }
 
+// 文件处理状态的显示文字
+const FILE_STATE_LABELS = {
+    queued: '排队中',
+    converting: '转换中',
+    tagging: '写入相机信息',
+    failed: '处理失败'
+};
+
+// 添加尚未处理完成的文件到列表
+function addPendingFileToList(file) {
+    const fileList = document.getElementById('fileList');
+    
+    const li = document.createElement('li');
+    li.className = `file-item pending state-${file.state}`;
+    li.dataset.jobId = file.job_id;
+    
+    const fileInfo = document.createElement('div');
+    fileInfo.className = 'file-info';
+    
+    const fileIcon = document.createElement('i');
+    fileIcon.className = file.state === 'failed' ? 'fas fa-exclamation-triangle' : 'fas fa-spinner fa-spin';
+    fileInfo.appendChild(fileIcon);
+    
+    const fileSpan = document.createElement('span');
+    fileSpan.className = 'file-name';
+    fileSpan.textContent = file.filename;
+    fileInfo.appendChild(fileSpan);
+    
+    const stateSpan = document.createElement('span');
+    stateSpan.className = 'file-state';
+    stateSpan.textContent = FILE_STATE_LABELS[file.state] || file.state;
+    if (file.error) {
+        stateSpan.title = file.error;
+    }
+    
+    li.appendChild(fileInfo);
+    li.appendChild(stateSpan);
+    fileList.appendChild(li);
+}
+
+// 处理中的文件列表定时刷新
+let fileListRefreshTimer = null;
+
+function scheduleFileListRefresh(delay = 2000) {
+    if (fileListRefreshTimer) {
+        return;
+    }
+    fileListRefreshTimer = setTimeout(() => {
+        fileListRefreshTimer = null;
+        loadUserFiles();
+    }, delay);
+}
+
+// 处理进度事件流（Server-Sent Events），连接期间不再轮询文件列表
+let progressEvents = null;
+
+function isProgressStreamOpen() {
+    return progressEvents !== null && progressEvents.readyState === EventSource.OPEN;
+}
+
+// 更新列表中处理中文件的状态，列表中没有该文件时返回false
+function updatePendingFileState(jobId, state, error) {
+    const li = document.querySelector(`.file-item.pending[data-job-id="${jobId}"]`);
+    if (!li) {
+        return false;
+    }
+    li.className = `file-item pending state-${state}`;
+    const icon = li.querySelector('.file-info i');
+    if (icon) {
+        icon.className = state === 'failed' ? 'fas fa-exclamation-triangle' : 'fas fa-spinner fa-spin';
+    }
+    const stateSpan = li.querySelector('.file-state');
+    if (stateSpan) {
+        stateSpan.textContent = FILE_STATE_LABELS[state] || state;
+        stateSpan.title = error || '';
+    }
+    return true;
+}
+
+function connectProgressEvents() {
+    if (!window.EventSource || progressEvents) {
+        return;
+    }
+    const userId = getUserInfo().userId;
+    // 断线后浏览器会自动重连，并通过 Last-Event-ID 补收错过的事件
+    progressEvents = new EventSource(`/api/events?user_id=${userId}`);
+    
+    ['converting', 'tagging', 'failed'].forEach(state => {
+        progressEvents.addEventListener(state, event => {
+            const data = JSON.parse(event.data);
+            if (!updatePendingFileState(data.job_id, state, data.error)) {
+                scheduleFileListRefresh(300);
+            }
+        });
+    });
+    
+    // 文件处理完成或预览图已生成：刷新列表以显示下载按钮和预览图（合并短时间内的多个事件）
+    progressEvents.addEventListener('done', () => scheduleFileListRefresh(300));
+    progressEvents.addEventListener('preview_ready', () => scheduleFileListRefresh(300));
+}
+
 // 检查用户鉴权状态，如果未登录则显示登录表单
 function checkAuthStatus() {
     if (!isAuthenticated()) {
@@ -357,6 +471,12 @@ function downloadFile(url, token, buttonElement, originalButtonText) {
             a.click();
             window.URL.revokeObjectURL(downloadUrl);
             
+            // 通知服务器文件已完整收到，服务器随后删除该文件
+            // （未确认时文件会保留一段时间，下载中断可以重新下载）
+            const ackData = new URLSearchParams({ user_id: userId, token: token });
+            fetch(`${url}/ack`, { method: 'POST', body: ackData })
+                .catch(error => console.error('Download ack error:', error));
+            
             // 恢复按钮状态
             if (buttonElement) {
                 buttonElement.innerHTML = originalButtonText;
@@ -422,59 +542,242 @@ function downloadFile(url, token, buttonElement, originalButtonText) {
     xhr.send();
 }
 
-// 批量下载文件的函数
+// 批量下载文件的函数（服务器把选中的文件打包成一个ZIP流式返回）
 function batchDownloadFiles(files) {
     if (files.length === 0) return;
     
+    const userInfo = getUserInfo();
     const batchDownloadBtn = document.getElementById('batch-download-btn');
-    const originalText = batchDownloadBtn.textContent;
-    batchDownloadBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> 下载中...';
-    batchDownloadBtn.disabled = true;
-    
-    let downloadedCount = 0;
     const statusMessage = document.getElementById('status-message');
     
-    files.forEach((filename, index) => {
+    // 使用表单提交，让浏览器直接把ZIP流写入下载文件，而不是先缓存在内存中
+    const form = document.createElement('form');
+    form.method = 'POST';
+    form.action = '/download/batch';
+    form.style.display = 'none';
+    
+    const addField = (name, value) => {
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = name;
+        input.value = value;
+        form.appendChild(input);
+    };
+    addField('user_id', userInfo.userId);
+    
+    const downloadedItems = [];
+    files.forEach(filename => {
         // 查找对应的下载按钮以获取token
         const downloadBtn = Array.from(document.querySelectorAll('.download-btn')).find(
             btn => btn.href.includes(`/download/${filename}`)
         );
         
         if (downloadBtn && downloadBtn.dataset.token) {
-            const token = downloadBtn.dataset.token;
-            const url = `/download/${filename}`;
-            
-            // 延迟下载，避免浏览器阻止多个下载
-            setTimeout(() => {
-                // 使用我们修改后的下载函数
-                downloadFile(url, token, downloadBtn, downloadBtn.innerHTML);
-                downloadedCount++;
-                
-                // 所有文件都已开始下载
-                if (downloadedCount === files.length) {
-                    // 恢复按钮状态
-                    batchDownloadBtn.innerHTML = originalText;
-                    batchDownloadBtn.disabled = false;
-                    
-                    // 清除选择
-                    document.querySelectorAll('.file-item.selected').forEach(item => {
-                        item.classList.remove('selected');
-                    });
-                    selectedFiles = [];
-                    batchDownloadBtn.classList.remove('active');
-                    batchDownloadBtn.textContent = '批量下载';
-                    
-                    // 显示成功消息
-                    statusMessage.textContent = `已开始下载 ${files.length} 个文件`;
-                    statusMessage.className = 'success';
-                    statusMessage.style.display = 'block';
+            addField('filename', filename);
+            addField('token', downloadBtn.dataset.token);
+            downloadedItems.push(downloadBtn.closest('.file-item'));
+        }
+    });
+    
+    if (downloadedItems.length === 0) return;
+    
+    document.body.appendChild(form);
+    form.submit();
+    form.remove();
+    
+    // 下载完成后服务器在保留期过后删除这些文件，从列表中移除
+    downloadedItems.forEach(item => item.remove());
+    const fileCount = document.getElementById('file-count');
+    if (fileCount) {
+        const currentCount = parseInt(fileCount.textContent || '0');
+        fileCount.textContent = Math.max(0, currentCount - downloadedItems.length);
+    }
+    const fileList = document.getElementById('fileList');
+    if (fileList.children.length === 0) {
+        const emptyList = document.querySelector('.empty-list');
+        if (emptyList) {
+            emptyList.style.display = 'block';
+        }
+    }
+    
+    // 清除选择
+    selectedFiles = [];
+    batchDownloadBtn.classList.remove('active');
+    batchDownloadBtn.textContent = '批量下载';
+    
+    // 显示成功消息
+    statusMessage.textContent = `已开始下载 ${downloadedItems.length} 个文件（ZIP压缩包）`;
+    statusMessage.className = 'success';
+    statusMessage.style.display = 'block';
+}
+
+// 分块上传：每个分块失败后的最大重试次数
+const UPLOAD_MAX_RETRIES = 5;
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+// 发送请求并解析JSON，非2xx时抛出带状态码和响应内容的错误
+async function fetchJSON(url, options) {
+    const response = await fetch(url, options);
+    const data = await response.json().catch(() => ({}));
+    if (!response.ok) {
+        const error = new Error(data.error || `HTTP error! status: ${response.status}`);
+        error.status = response.status;
+        error.data = data;
+        error.retryAfter = Number(response.headers.get('Retry-After')) || 1;
+        throw error;
+    }
+    return data;
+}
+
+// 服务器繁忙（429）时按 Retry-After 等待后重试
+async function fetchJSONWhenReady(url, options) {
+    for (let attempt = 0; ; attempt++) {
+        try {
+            return await fetchJSON(url, options);
+        } catch (error) {
+            if (error.status !== 429 || attempt >= UPLOAD_MAX_RETRIES) {
+                throw error;
+            }
+            await sleep(1000 * error.retryAfter);
+        }
+    }
+}
+
+// 抽样指纹：文件大小（8字节小端）以及开头、中间、结尾各64KiB数据的SHA-256，
+// 与服务器 UploadStream.calculate_fingerprint 的算法一致，只读取三段数据
+const FINGERPRINT_SAMPLE_SIZE = 64 * 1024;
+
+async function fileFingerprint(file) {
+    const size = file.size;
+    const header = new Uint8Array(8);
+    new DataView(header.buffer).setBigUint64(0, BigInt(size), true);
+    const offsets = [
+        0,
+        Math.max(0, Math.floor((size - FINGERPRINT_SAMPLE_SIZE) / 2)),
+        Math.max(0, size - FINGERPRINT_SAMPLE_SIZE)
+    ];
+    const parts = [header];
+    for (const offset of offsets) {
+        parts.push(new Uint8Array(await file.slice(offset, offset + FINGERPRINT_SAMPLE_SIZE).arrayBuffer()));
+    }
+    const data = new Uint8Array(parts.reduce((total, part) => total + part.length, 0));
+    let position = 0;
+    for (const part of parts) {
+        data.set(part, position);
+        position += part.length;
+    }
+    const digest = await crypto.subtle.digest('SHA-256', data);
+    return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
+// 上传前检查哪些文件已经转换或正在处理，返回 Map(文件 => 服务器结果)；
+// 浏览器不支持 Web Crypto（非HTTPS页面）或检查失败时返回空Map，全部文件照常上传
+const PRECHECK_BATCH_SIZE = 500;
+
+async function precheckFiles(files, userId) {
+    const existing = new Map();
+    if (!window.crypto || !crypto.subtle) {
+        return existing;
+    }
+    try {
+        for (let start = 0; start < files.length; start += PRECHECK_BATCH_SIZE) {
+            const batch = files.slice(start, start + PRECHECK_BATCH_SIZE);
+            const fingerprints = [];
+            for (const file of batch) {
+                fingerprints.push(await fileFingerprint(file));
+            }
+            const data = await fetchJSON('/api/precheck', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ user_id: userId, fingerprints })
+            });
+            batch.forEach((file, index) => {
+                const result = data.results[fingerprints[index]];
+                if (result && result.status !== 'missing') {
+                    existing.set(file, result);
                 }
-            }, index * 1000); // 每个下载间隔1秒，防止浏览器阻止多个下载
+            });
+        }
+    } catch (error) {
+        console.warn('上传前检查失败，将上传全部文件', error);
+    }
+    return existing;
+}
+
+// 分块上传一个文件，支持断点续传（上传ID保存在localStorage中，刷新页面后可以继续）
+async function uploadFileChunked(file, userId, onProgress) {
+    const resumeKey = `upload:${userId}:${file.name}:${file.size}:${file.lastModified}`;
+    let uploadId = localStorage.getItem(resumeKey);
+    let chunkSize = 8 * 1024 * 1024;
+    let offset = 0;
+    
+    // 查询未完成上传的进度
+    if (uploadId) {
+        try {
+            const status = await fetchJSON(`/upload/${uploadId}?user_id=${userId}`);
+            offset = status.offset;
+        } catch (error) {
+            uploadId = null;
+            localStorage.removeItem(resumeKey);
         }
+    }
+    
+    if (!uploadId) {
+        const init = await fetchJSONWhenReady('/upload/init', {
+            method: 'POST',
+            body: new URLSearchParams({ user_id: userId, filename: file.name, size: file.size })
+        });
+        uploadId = init.upload_id;
+        chunkSize = Math.min(chunkSize, init.chunk_size);
+        localStorage.setItem(resumeKey, uploadId);
+    }
+    
+    let retries = 0;
+    while (offset < file.size) {
+        const chunk = file.slice(offset, offset + chunkSize);
+        try {
+            const result = await fetchJSON(`/upload/${uploadId}?user_id=${userId}&offset=${offset}`, {
+                method: 'PUT',
+                body: chunk
+            });
+            offset = result.offset;
+            retries = 0;
+            onProgress(offset);
+        } catch (error) {
+            if (error.status === 409 && error.data.offset !== undefined) {
+                // 服务器收到的数据与本地不一致，从服务器的偏移继续
+                offset = error.data.offset;
+                continue;
+            }
+            if (error.status && error.status < 500) {
+                throw error;
+            }
+            // 网络错误或服务器错误：等待后查询服务器的偏移并重试
+            retries++;
+            if (retries > UPLOAD_MAX_RETRIES) {
+                throw error;
+            }
+            await sleep(1000 * retries);
+            try {
+                offset = (await fetchJSON(`/upload/${uploadId}?user_id=${userId}`)).offset;
+            } catch (statusError) {
+                // 仍然无法连接，下一轮重试
+            }
+        }
+    }
+    
+    const data = await fetchJSONWhenReady(`/upload/${uploadId}/complete`, {
+        method: 'POST',
+        body: new URLSearchParams({ user_id: userId })
     });
+    localStorage.removeItem(resumeKey);
+    return data;
 }
 
-document.getElementById('uploadForm').addEventListener('submit', function(e) {
+document.getElementById('uploadForm').addEventListener('submit', async function(e) {
     e.preventDefault();
     
     // 检查用户是否已登录
@@ -485,11 +788,8 @@ document.getElementById('uploadForm').addEventListener('submit', function(e) {
     
     const submitBtn = document.getElementById('submitBtn');
     const statusMessage = document.getElementById('status-message');
-    const formData = new FormData(this);
-    
-    // 添加用户ID到表单数据
+    const files = Array.from(document.getElementById('file-upload').files);
     const userInfo = getUserInfo();
-    formData.append('user_id', userInfo.userId);
     
     // 禁用提交按钮
     submitBtn.disabled = true;
@@ -499,50 +799,63 @@ document.getElementById('uploadForm').addEventListener('submit', function(e) {
     statusMessage.style.display = 'none';
     statusMessage.className = '';
     
-    fetch('/upload', {
-        method: 'POST',
-        body: formData
-    })
-    .then(response => {
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
-        }
-        return response.json();
-    })
-    .then(data => {
-        if (data.error) {
-            throw new Error(data.error);
-        }
-        // 显示成功消息
-        statusMessage.textContent = data.message;
-        statusMessage.classList.add('success');
-        statusMessage.style.display = 'block';
-        
-        // 更新文件列表
-        if (data.processed_files && data.processed_files.length > 0) {
-            // 重新加载用户文件列表
-            loadUserFiles();
+    const totalBytes = files.reduce((sum, file) => sum + file.size, 0);
+    let finishedBytes = 0;
+    const counts = { jobs: 0, cached: 0, skipped: 0, failed: 0 };
+    
+    // 已经转换或正在处理的文件不再上传
+    submitBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> 检查文件...';
+    const existing = await precheckFiles(files, userInfo.userId);
+    
+    // 逐个文件上传，每个文件上传完成后服务器立即开始转换
+    for (const [index, file] of files.entries()) {
+        if (existing.has(file)) {
+            counts.skipped++;
+            finishedBytes += file.size;
+            continue;
         }
-    })
-    .catch(error => {
-        // 显示错误消息
-        let errorMessage = '上传处理失败，请重试';
-        if (error.message) {
-            errorMessage = error.message;
+        try {
+            const data = await uploadFileChunked(file, userInfo.userId, offset => {
+                const percent = totalBytes ? Math.floor((finishedBytes + offset) * 100 / totalBytes) : 100;
+                submitBtn.innerHTML = `<i class="fas fa-spinner fa-spin"></i> 上传中 ${index + 1}/${files.length}（${percent}%）`;
+            });
+            counts.jobs += data.jobs.length;
+            counts.cached += data.cached_files.length;
+            counts.skipped += data.skipped_files.length;
+            
+            // 更新文件列表（后台处理中的文件会显示处理状态）
+            if ((data.jobs && data.jobs.length > 0) ||
+                (data.processed_files && data.processed_files.length > 0)) {
+                loadUserFiles();
+            }
+        } catch (error) {
+            counts.failed++;
+            console.error('Error:', file.name, error);
         }
-        statusMessage.textContent = errorMessage;
-        statusMessage.classList.add('error');
-        statusMessage.style.display = 'block';
-        console.error('Error:', error);
-    })
-    .finally(() => {
-        // 重置表单和按钮状态
-        submitBtn.disabled = false;
-        submitBtn.innerHTML = '<i class="fas fa-cog"></i> 上传并处理';
-        document.getElementById('file-upload').value = '';
-        document.getElementById('file-selected').textContent = '未选择文件';
-        document.getElementById('file-selected').style.color = '#7f8c8d';
-    });
+        finishedBytes += file.size;
+    }
+    
+    // 显示结果消息
+    let message = `已接收 ${counts.jobs} 个文件，正在后台处理`;
+    if (counts.cached) {
+        message += `，${counts.cached} 个文件已有转换结果`;
+    }
+    if (counts.skipped) {
+        message += `，跳过 ${counts.skipped} 个已处理的文件`;
+    }
+    if (counts.failed) {
+        message += `，${counts.failed} 个文件上传失败，请重试（已上传的部分会继续使用）`;
+    }
+    statusMessage.textContent = message;
+    statusMessage.classList.add(counts.failed ? 'error' : 'success');
+    statusMessage.style.display = 'block';
+    
+    // 重置表单和按钮状态
+    submitBtn.disabled = false;
+    submitBtn.innerHTML = '<i class="fas fa-cog"></i> 上传并处理';
+    document.getElementById('file-upload').value = '';
+    document.getElementById('file-selected').textContent = '未选择文件';
+    document.getElementById('file-selected').style.color = '#7f8c8d';
 });
 
 // 页面初始化
@@ -550,6 +863,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // 检查用户鉴权状态
     checkAuthStatus();
     
+    // 订阅文件处理进度
+    connectProgressEvents();
+    
     // 更新UI
     updateAuthUI();
 });